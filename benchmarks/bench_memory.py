@@ -0,0 +1,54 @@
+# This script checks that the memory use of the streaming stages of the pipeline does not depend on the
+# length of the time axis: it generates synthetic BASE flux sets of several record lengths (see
+# run_benchmarks.py) and runs the chosen stages on each of them, every stage in a fresh process. The
+# peak memory per stage and record length is printed as a table; it should be (about) the same in each
+# row. By default the single experiment ATEN and all first-year experiments in one pass are run; the
+# latter opens one output file per experiment, so its memory use also shows the cost of each output.
+#
+# Usage: python bench_memory.py [--hours 24 96 192] [--stages ATEN all_experiments] [--shape 390 250]
+#                               [--profile timeseries] [--workdir /tmp/bench_memory] [--json report.json]
+
+##############################################
+########## LOAD NECCESSARY PACKAGES ##########
+##############################################
+import argparse
+import json
+import os
+from Experiments.functions import synthetic
+from Experiments.functions.experiments import FF_LIST
+from Experiments.functions.ncio import STORAGE_PROFILES
+from run_benchmarks import STAGES, time_stage
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Peak memory of the pipeline stages for several record lengths')
+    parser.add_argument('--hours', type=int, nargs='+', default=[24, 96, 192])
+    parser.add_argument('--stages', nargs='+', default=['ATEN', 'all_experiments'], choices=STAGES[3:])
+    parser.add_argument('--sectors', nargs='+', default=FF_LIST, choices=FF_LIST)
+    parser.add_argument('--shape', type=int, nargs=2, default=list(synthetic.SHAPE), metavar=('NLAT', 'NLON'))
+    parser.add_argument('--profile', default=None, choices=list(STORAGE_PROFILES),
+                        help='storage profile of the generated flux fields (see STORAGE_PROFILES in functions/ncio.py)')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--frames', type=int, default=6, help='number of quick-look frames to render')
+    parser.add_argument('--workdir', default='/tmp/bench_memory')
+    parser.add_argument('--json', default=None, help='path of a JSON report of the peak memory')
+    args = parser.parse_args()
+
+    results = {stage: {} for stage in args.stages}
+    for hours in args.hours:
+        # EACH RECORD LENGTH GETS ITS OWN SYNTHETIC DATA, WITH THE ARGUMENTS THAT run_benchmarks.py EXPECTS
+        run_args = argparse.Namespace(**dict(vars(args), hours=hours, workdir=os.path.join(args.workdir, str(hours) + 'h')))
+        os.makedirs(run_args.workdir, exist_ok=True)
+        time_stage('generate', run_args)
+        for stage in args.stages:
+            results[stage][hours] = time_stage(stage, run_args)
+
+    print(format('peak MB', '<16') + ''.join(format(str(hours) + ' h', '>10') for hours in args.hours))
+    for stage, per_hours in results.items():
+        print(format(stage, '<16') + ''.join(format('failed', '>10') if per_hours[hours]['error'] is not None else
+                                             format(per_hours[hours]['peak_rss_mb'], '>10.0f') if per_hours[hours]['ran'] else
+                                             format('skipped', '>10') for hours in args.hours))
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'hours': args.hours, 'shape': args.shape, 'sectors': args.sectors, 'profile': args.profile,
+                       'stages': {stage: [per_hours[hours] for hours in args.hours] for stage, per_hours in results.items()}}, f, indent=1)
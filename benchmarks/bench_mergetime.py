@@ -0,0 +1,109 @@
+# This script compares the native time merger of functions/mergetime.py with the CDO chain that
+# daily_to_single_ctehr.py used before (cdo mergetime, cdo setgrid and an in-place unit conversion),
+# on synthetic daily CTE-HR files. The CDO path is skipped if the cdo Python bindings or the cdo
+# executable are not available.
+#
+# Usage: python bench_mergetime.py [--days 31] [--variables 4] [--processes 4] [--workdir /tmp/bench_mergetime]
+
+##############################################
+########## LOAD NECCESSARY PACKAGES ##########
+##############################################
+import argparse
+import datetime as dt
+import os
+import shutil
+import time
+import netCDF4 as nc
+import numpy as np
+from Experiments.functions.mergetime import merge_daily_files
+
+GRID = """gridtype = lonlat
+yname     = latitude
+xname     = longitude
+xsize    = 250
+ysize    = 390
+xfirst   = -14.9
+xinc     = 0.2
+yfirst   = 33.05
+yinc     = 0.1
+"""
+
+def make_daily_files(workdir, ndays, nvars, shape=(390, 250)):
+    """ Function to write synthetic daily files with hourly fields in micromol m-2 s-1
+    Input:
+        workdir: str: directory of the daily files
+        ndays: int: number of days
+        nvars: int: number of flux variables per file
+        shape: tuple: (latitude, longitude) shape of the grid
+    Returns:
+        list: paths of the daily files """
+    rng = np.random.default_rng(0)
+    paths = []
+    for day in range(ndays):
+        date = dt.datetime(2021, 1, 1) + dt.timedelta(days=day)
+        path = os.path.join(workdir, 'regional.synthetic.' + date.strftime('%Y%m%d') + '.nc')
+        with nc.Dataset(path, 'w') as ds:
+            ds.createDimension('time', None)
+            ds.createDimension('latitude', shape[0])
+            ds.createDimension('longitude', shape[1])
+            time_var = ds.createVariable('time', 'f8', ('time',))
+            time_var.units = 'seconds since 2000-01-01 00:00:00'
+            time_var.calendar = 'standard'
+            time_var[:] = nc.date2num([date + dt.timedelta(hours=h) for h in range(24)], time_var.units, time_var.calendar)
+            for i in range(nvars):
+                var = ds.createVariable('flux_' + str(i), 'f4', ('time', 'latitude', 'longitude'))
+                var.units = 'micromol m-2 s-1'
+                var[:] = rng.standard_normal((24,) + shape).astype(np.float32)
+        paths.append(path)
+    return paths
+
+def run_native(paths, outfile, gridfile, processes):
+    """ Function to time the native merger """
+    start = time.perf_counter()
+    merge_daily_files(paths, outfile, gridfile, processes=processes)
+    return time.perf_counter() - start
+
+def run_cdo(paths, outfile, gridfile, workdir):
+    """ Function to time the CDO chain of the original daily_to_single_ctehr.py, None if CDO is not available """
+    try:
+        from cdo import Cdo
+        cdo = Cdo()
+    except Exception:
+        return None
+    if shutil.which('cdo') is None:
+        return None
+    start = time.perf_counter()
+    tmpfile = cdo.mergetime(input=paths, output=os.path.join(workdir, 'tmp.nc'))
+    cdo.setgrid(gridfile, input=tmpfile, output=outfile)
+    os.remove(tmpfile)
+    with nc.Dataset(outfile, 'r+') as ds:
+        for k, v in ds.variables.items():
+            if v.ndim == 3:
+                ds[k][:] = ds[k][:] * 1e-6
+                ds[k].units = 'mol m-2 s-1'
+    return time.perf_counter() - start
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the native time merger against the CDO chain')
+    parser.add_argument('--days', type=int, default=31)
+    parser.add_argument('--variables', type=int, default=4)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--workdir', default='/tmp/bench_mergetime')
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    gridfile = os.path.join(args.workdir, 'europe.grid')
+    with open(gridfile, 'w') as f:
+        f.write(GRID)
+    paths = make_daily_files(args.workdir, args.days, args.variables)
+    size = sum(os.path.getsize(path) for path in paths) / 1e6
+
+    native = run_native(paths, os.path.join(args.workdir, 'native.nc'), gridfile, args.processes)
+    print('native: ' + format(native, '.2f') + ' s, ' + format(size / native, '.1f') + ' MB/s, ' + format(24 * args.days / native, '.1f') + ' hours/s')
+    cdo_time = run_cdo(paths, os.path.join(args.workdir, 'cdo.nc'), gridfile, args.workdir)
+    if cdo_time is None:
+        print('cdo: not available, skipped')
+    else:
+        print('cdo:    ' + format(cdo_time, '.2f') + ' s, ' + format(size / cdo_time, '.1f') + ' MB/s, ' + format(24 * args.days / cdo_time, '.1f') + ' hours/s')
+        with nc.Dataset(os.path.join(args.workdir, 'native.nc')) as a, nc.Dataset(os.path.join(args.workdir, 'cdo.nc')) as b:
+            print('outputs equal: ' + str(all(np.array_equal(a[name][:], b[name][:]) for name in a.variables if a[name].ndim == 3)))
@@ -0,0 +1,111 @@
+# This script compares the storage profiles of functions/ncio.py (STORAGE_PROFILES) and the netCDF
+# default storage on a synthetic flux field: the time to write the field in daily chunks, the file
+# size, and the read latency of the two dominant access patterns: whole hourly maps (perturbation,
+# plotting) and long time series of single cells (sampling by a transport model), plus daily
+# blocks of 50x50 cells. The file cache is not dropped between writing and reading, so the read
+# latencies are those of a warm cache unless the files are larger than the memory of the node. Each
+# profile is written and read in a fresh process, and the peak memory of that process (the time
+# chunks of the field plus the chunk caches of the netCDF library) is reported with the timings.
+#
+# Usage: python bench_storage.py [--hours 744] [--reads 20] [--workdir /tmp/bench_storage]
+
+##############################################
+########## LOAD NECCESSARY PACKAGES ##########
+##############################################
+import argparse
+import multiprocessing
+import os
+import resource
+import time
+import netCDF4 as nc
+import numpy as np
+from Experiments.functions.ncio import CHUNK_SIZE, STORAGE_PROFILES, iter_time_chunks, get_storage_options, set_chunk_cache, get_stream_chunk_size
+
+def make_field(t, shape=(390, 250)):
+    """ Function to make a time chunk of a synthetic hourly flux field with a diurnal cycle and spatial structure, in mol m-2 s-1
+    Input:
+        t: slice: hourly time steps of the chunk
+        shape: tuple: (latitude, longitude) shape of the grid
+    Returns:
+        np.ndarray: (time, latitude, longitude) float32 field """
+    rng = np.random.default_rng(0)
+    y, x = np.meshgrid(np.linspace(0, 3, shape[0]), np.linspace(0, 5, shape[1]), indexing='ij')
+    pattern = (1e-6 * (np.sin(y) * np.cos(x) + 0.1 * rng.standard_normal(shape))).astype(np.float32)
+    cycle = (1 + 0.5 * np.sin(2 * np.pi * np.arange(t.start, t.stop) / 24)).astype(np.float32)
+    return pattern[None] * cycle[:, None, None]
+
+def write_file(path, ntime, profile, shape=(390, 250)):
+    """ Function to write a field in daily chunks, rounded up to whole chunks of the profile as in the perturbation engine
+    Input:
+        path: str: path of the file
+        ntime: int: number of hourly time steps
+        profile: str: name of a profile in STORAGE_PROFILES (None: netCDF defaults)
+        shape: tuple: (latitude, longitude) shape of the grid
+    Returns:
+        float: write time in seconds """
+    start = time.perf_counter()
+    with nc.Dataset(path, 'w', format='NETCDF4') as ds:
+        ds.createDimension('time', None)
+        ds.createDimension('latitude', shape[0])
+        ds.createDimension('longitude', shape[1])
+        sizes = {'time': None, 'latitude': shape[0], 'longitude': shape[1]}
+        dimensions = ('time', 'latitude', 'longitude')
+        options = get_storage_options(dimensions, sizes, profile) if profile is not None else {}
+        var = ds.createVariable('flux_ff_exchange_prior', 'f4', dimensions, **options)
+        if options:
+            set_chunk_cache(var)
+        for t in iter_time_chunks(ntime, get_stream_chunk_size([var], CHUNK_SIZE)):
+            var[t] = make_field(t, shape)
+    return time.perf_counter() - start
+
+def read_latency(path, pattern, nreads, rng):
+    """ Function to measure the mean latency of reads of one access pattern
+    Input:
+        path: str: path to the file
+        pattern: str: 'map' (one hourly map), 'timeseries' (all hours of one cell) or 'block' (a day of 50x50 cells)
+        nreads: int: number of reads at random positions
+        rng: np.random.Generator: random generator of the positions
+    Returns:
+        float: mean latency in milliseconds """
+    with nc.Dataset(path, 'r') as ds:
+        var = ds.variables['flux_ff_exchange_prior']
+        ntime, nlat, nlon = var.shape
+        start = time.perf_counter()
+        for _ in range(nreads):
+            if pattern == 'map':
+                var[rng.integers(ntime)]
+            elif pattern == 'timeseries':
+                var[:, rng.integers(nlat), rng.integers(nlon)]
+            else:
+                t, row, col = rng.integers(max(ntime - 24, 1)), rng.integers(nlat - 50), rng.integers(nlon - 50)
+                var[t:t + 24, row:row + 50, col:col + 50]
+        return 1e3 * (time.perf_counter() - start) / nreads
+
+def _profile_worker(name, args, queue):
+    """ Function to write and read the file of one profile in a fresh process and report the timings and the peak memory """
+    path = os.path.join(args.workdir, name + '.nc')
+    write = write_file(path, args.hours, None if name == 'default' else name)
+    rng = np.random.default_rng(1)
+    latencies = [read_latency(path, pattern, args.reads, rng) for pattern in ('map', 'timeseries', 'block')]
+    # ru_maxrss IS IN KILOBYTES ON LINUX
+    queue.put((write, os.path.getsize(path) / 1e6, latencies, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the netCDF storage profiles of the flux fields')
+    parser.add_argument('--hours', type=int, default=744)
+    parser.add_argument('--reads', type=int, default=20)
+    parser.add_argument('--workdir', default='/tmp/bench_storage')
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    print(format('profile', '<12') + format('write s', '>9') + format('size MB', '>9') +
+          format('map ms', '>10') + format('series ms', '>11') + format('block ms', '>10') + format('peak MB', '>10'))
+    context = multiprocessing.get_context('spawn')
+    for name in ['default'] + list(STORAGE_PROFILES):
+        queue = context.Queue()
+        process = context.Process(target=_profile_worker, args=(name, args, queue))
+        process.start()
+        write, size, latencies, peak = queue.get()
+        process.join()
+        print(format(name, '<12') + format(write, '>9.2f') + format(size, '>9.1f') + format(latencies[0], '>10.1f') +
+              format(latencies[1], '>11.1f') + format(latencies[2], '>10.1f') + format(peak, '>10.0f'), flush=True)
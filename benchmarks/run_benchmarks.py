@@ -0,0 +1,221 @@
+# This script runs the whole PARIS pipeline on synthetic CTE-HR data (functions/synthetic.py) and times
+# each stage: generating the data, merging the daily files per stream (daily_to_single_ctehr.py),
+# combining the streams into paris_input.nc (combine_for_paris.py), each experiment of the first
+# modelling year and all of them in one pass (paris_all_experiments.py), and the diagnostics
+# (verification, country totals, quick-look plots, export, regridding and monthly aggregation). Every
+# stage runs in a fresh process, so the reported peak memory (the maximum resident set size of the
+# stage process and its worker processes) belongs to that stage only. Throughput is given in hours of
+# flux data processed per second. The progress messages of each stage are written to {workdir}/{stage}.log,
+# with the traceback of a stage that fails; failed stages are reported and the other stages still run.
+# The aggregation and the CDL template of paris_input.nc need ncgen: without it the aggregation is
+# skipped and paris_input.nc gets the synthetic layout instead. With --profile the flux fields of the
+# BASE flux set and paris_input.nc (and so of the perturbed flux sets) are stored with a profile of
+# STORAGE_PROFILES (functions/ncio.py); run it with each profile to compare their cost in the pipeline.
+#
+# Usage: python run_benchmarks.py [--hours 168] [--sectors A_Public_power B_Industry ...] [--shape 390 250] [--profile timeseries]
+#                                 [--processes 4] [--stages merge combine ...] [--workdir /tmp/bench_pipeline] [--json report.json]
+
+##############################################
+########## LOAD NECCESSARY PACKAGES ##########
+##############################################
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import time
+import traceback
+from glob import glob
+from queue import Empty
+from Experiments.functions import synthetic
+from Experiments.functions.experiments import EXPERIMENTS, FF_LIST
+from Experiments.functions.ncio import STORAGE_PROFILES
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'templates', 'cdl_template')
+YR1_EXPERIMENTS = ['ATEN', 'PTEN', 'HFRA', 'HGER', 'DFIN']
+STAGES = ['generate', 'merge', 'combine'] + YR1_EXPERIMENTS + ['all_experiments', 'verify', 'zonalstats', 'quicklook', 'export', 'regrid', 'aggregate']
+
+def get_paths(workdir):
+    """ Function to get the paths of the benchmark files in the working directory """
+    return {'daily': os.path.join(workdir, 'output'), 'merged': os.path.join(workdir, 'PARIS_OUTPUT'),
+            'grid': os.path.join(workdir, 'europe.grid'), 'base': os.path.join(workdir, 'paris_ctehr_yr1_BASE.nc'),
+            'input': os.path.join(workdir, 'paris_input.nc'), 'mask': os.path.join(workdir, 'countrymask.nc'),
+            'landuse': os.path.join(workdir, 'landuse.nc'), 'lu_cache': os.path.join(workdir, 'lu_cache'),
+            'experiments': os.path.join(workdir, 'experiments'), 'diagnostics': os.path.join(workdir, 'diagnostics')}
+
+def get_experiments(sectors):
+    """ Function to get the yr1 experiments that can be run on a BASE flux set with the given sectors """
+    variables = set(sectors) | {'cement', 'combustion', 'flux_ff_exchange_prior'} | set(synthetic.BASE_VARIABLES.values())
+    return [code for code in YR1_EXPERIMENTS if EXPERIMENTS[code]['variable'] in variables]
+
+def run_stage(stage, args):
+    """ Function to run one stage of the pipeline on the synthetic data
+    Input:
+        stage: str: name of the stage, see STAGES
+        args: argparse.Namespace: the arguments of the benchmark
+    Returns:
+        bool: False if the stage was skipped """
+    paths = get_paths(args.workdir)
+    shape = tuple(args.shape)
+    synthetic.use_synthetic_landuse(paths['landuse'], paths['lu_cache'])
+    experiments = get_experiments(args.sectors)
+    experiment_path = lambda code: os.path.join(paths['experiments'], 'paris_ctehr_perturbedflux_yr1_' + code + '.nc')
+
+    if stage == 'generate':
+        ndays = -(-args.hours // 24)
+        synthetic.write_daily_files(paths['daily'], ndays, shape)
+        synthetic.write_grid_file(paths['grid'], shape)
+        synthetic.write_base_file(paths['base'], args.hours, shape, args.sectors, profile=args.profile)
+        synthetic.write_synthetic_masks(paths['mask'], shape)
+        synthetic.write_synthetic_landuse(paths['landuse'], shape)
+
+    elif stage == 'merge':
+        from Experiments.functions.mergetime import merge_daily_files
+        os.makedirs(paths['merged'], exist_ok=True)
+        for stream in synthetic.STREAMS:
+            infiles = sorted(glob(os.path.join(paths['daily'], '*', stream + '*')))
+            merge_daily_files(infiles, os.path.join(paths['merged'], 'paris_input_' + stream + '.nc'), paths['grid'], processes=args.processes)
+
+    elif stage == 'combine':
+        from Experiments.functions.combine import get_stream_variables, combine_streams
+        from Experiments.functions.ncio import create_from_cdl
+        cdlpath = os.path.join(TEMPLATE_DIR, 'paris_input.cdl')
+        if shutil.which('ncgen') and shape == synthetic.SHAPE:
+            template = create_from_cdl(cdlpath, paths['input'], profile=args.profile)
+        else:
+            template = synthetic.create_base_layout(paths['input'], shape=shape, profile=args.profile)
+        varnames = list(synthetic.BASE_VARIABLES) + ['anthropogenic']
+        outnames = list(synthetic.BASE_VARIABLES.values()) + ['flux_ff_exchange_prior']
+        with template:
+            streams = []
+            for stream in synthetic.STREAMS:
+                path = os.path.join(paths['merged'], 'paris_input_' + stream + '.nc')
+                streams.append({'path': path, 'variables': get_stream_variables(path, varnames, outnames, copy_all=stream == 'ff_emissions_CO2')})
+            combine_streams(template, streams, processes=args.processes)
+
+    elif stage in YR1_EXPERIMENTS or stage == 'all_experiments':
+        from Experiments.functions.perturbation import perturb_experiment, perturb_experiments
+        os.makedirs(paths['experiments'], exist_ok=True)
+        if stage == 'all_experiments':
+            perturb_experiments(paths['base'], {code: experiment_path(code) for code in experiments}, mask_path=paths['mask'])
+        elif stage in experiments:
+            perturb_experiment(paths['base'], experiment_path(stage), stage, mask_path=paths['mask'])
+        else:
+            return False
+
+    elif stage == 'verify':
+        from Experiments.functions.verify import verify_experiment
+        for code in experiments:
+            verify_experiment(paths['base'], experiment_path(code), code, mask_path=paths['mask'])
+
+    elif stage == 'zonalstats':
+        from Experiments.functions.zonalstats import write_zonal_stats
+        os.makedirs(paths['diagnostics'], exist_ok=True)
+        write_zonal_stats(paths['base'], os.path.join(paths['diagnostics'], 'BASE'), mask_path=paths['mask'])
+
+    elif stage == 'quicklook':
+        if 'ATEN' not in experiments:
+            return False
+        from Experiments.functions.quicklook import render_quicklook
+        render_quicklook(paths['base'], experiment_path('ATEN'), 'combustion', os.path.join(paths['diagnostics'], 'quicklook'), 'ATEN',
+                         times=range(min(args.hours, args.frames)), processes=args.processes)
+
+    elif stage == 'export':
+        from Experiments.functions.export import export_raw
+        export_raw(paths['base'], os.path.join(paths['diagnostics'], 'BASE_raw'))
+
+    elif stage == 'regrid':
+        from Experiments.functions.regrid import regrid_flux_set
+        from Experiments.functions.rasterize import LON_BOUNDS, LAT_BOUNDS
+        regrid_flux_set(paths['base'], os.path.join(paths['diagnostics'], 'BASE_1x1.nc'), LON_BOUNDS, LAT_BOUNDS, 1.0, 1.0,
+                        cache_dir=os.path.join(args.workdir, 'regrid_cache'), gridfile=paths['grid'])
+
+    elif stage == 'aggregate':
+        from Experiments.functions.aggregate import aggregate_flux_set
+        if not shutil.which('ncgen') or shape != synthetic.SHAPE:
+            return False
+        aggregate_flux_set(paths['base'], os.path.join(paths['diagnostics'], 'BASE_monthly.nc'),
+                           cdlpath=os.path.join(TEMPLATE_DIR, 'paris_protocol.cdl'))
+    return True
+
+def _stage_worker(stage, args, queue):
+    """ Function to run a stage in a fresh process and report its wall time, CPU time and peak memory, or its error """
+    # THE PROGRESS MESSAGES OF THE STAGE (AND ITS WORKER PROCESSES) GO TO {workdir}/{stage}.log
+    log = open(os.path.join(args.workdir, stage + '.log'), 'w')
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+    result = {'stage': stage, 'ran': False, 'error': None}
+    start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        result['ran'] = run_stage(stage, args)
+    except BaseException as error:
+        result['error'] = type(error).__name__ + ': ' + str(error)
+        traceback.print_exc()
+    finally:
+        seconds, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+        # ru_maxrss IS IN KILOBYTES ON LINUX; THE CHILDREN ARE THE WORKER PROCESSES OF THE STAGE
+        peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        queue.put(dict(result, seconds=seconds, cpu_seconds=cpu, peak_rss_mb=peak / 1024.))
+
+def time_stage(stage, args):
+    """ Function to time a stage in a fresh (spawned) process. A stage that raises an error, or whose process
+    is killed (e.g. by the out-of-memory killer), is reported as failed instead of stopping the benchmark.
+    Input:
+        stage: str: name of the stage, see STAGES
+        args: argparse.Namespace: the arguments of the benchmark
+    Returns:
+        dict: stage, ran, error (None if the stage did not fail), seconds, cpu_seconds, peak_rss_mb and hours_per_second """
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_stage_worker, args=(stage, args, queue))
+    start = time.perf_counter()
+    process.start()
+    result = None
+    while result is None:
+        try:
+            result = queue.get(timeout=1)
+        except Empty:
+            if not process.is_alive() and queue.empty():
+                # THE PROCESS ENDED WITHOUT A RESULT: IT WAS KILLED BEFORE IT COULD REPORT
+                result = {'stage': stage, 'ran': False, 'error': 'process exited with code ' + str(process.exitcode),
+                          'seconds': time.perf_counter() - start, 'cpu_seconds': None, 'peak_rss_mb': None}
+    process.join()
+    ok = result['ran'] and result['error'] is None
+    result['hours_per_second'] = args.hours / result['seconds'] if ok and result['seconds'] > 0 else None
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of the PARIS pipeline on synthetic CTE-HR data')
+    parser.add_argument('--hours', type=int, default=168)
+    parser.add_argument('--sectors', nargs='+', default=FF_LIST, choices=FF_LIST)
+    parser.add_argument('--shape', type=int, nargs=2, default=list(synthetic.SHAPE), metavar=('NLAT', 'NLON'))
+    parser.add_argument('--profile', default=None, choices=list(STORAGE_PROFILES),
+                        help='storage profile of the generated flux fields (see STORAGE_PROFILES in functions/ncio.py)')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--frames', type=int, default=6, help='number of quick-look frames to render')
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--workdir', default='/tmp/bench_pipeline')
+    parser.add_argument('--json', default=None, help='path of a JSON report of the timings')
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    results = []
+    print(format('stage', '<16') + format('wall s', '>9') + format('cpu s', '>9') + format('hours/s', '>10') + format('peak MB', '>10'))
+    for stage in [stage for stage in STAGES if stage in args.stages]:
+        result = time_stage(stage, args)
+        results.append(result)
+        if result['error'] is not None:
+            print(format(stage, '<16') + format('failed', '>9') + '  ' + result['error'] + ' (see ' + os.path.join(args.workdir, stage + '.log') + ')', flush=True)
+            continue
+        if not result['ran']:
+            print(format(stage, '<16') + format('skipped', '>9'))
+            continue
+        print(format(stage, '<16') + format(result['seconds'], '>9.2f') + format(result['cpu_seconds'], '>9.2f') +
+              format(result['hours_per_second'], '>10.1f') + format(result['peak_rss_mb'], '>10.0f'), flush=True)
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'hours': args.hours, 'shape': args.shape, 'sectors': args.sectors, 'profile': args.profile, 'stages': results}, f, indent=1)
+    if any(result['error'] is not None for result in results):
+        raise SystemExit(1)
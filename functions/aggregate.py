@@ -0,0 +1,113 @@
+# This file contains functions to aggregate an hourly BASE or perturbed flux set (full file or overlay)
+# to monthly (or daily or weekly) mean fluxes in the layout of the paris_protocol.cdl template. The
+# hourly file is streamed once in time chunks. Because the time axis is sorted, only the running sum
+# of the current period is kept per variable: when a period ends its mean is written to the output
+# file and the sum is reset, so memory use does not depend on the length of the time axis.
+
+##############################################
+########## LOAD NECCESSARY PACKAGES ##########
+##############################################
+import os
+import re
+import netCDF4 as nc
+import numpy as np
+import pandas as pd
+from Experiments.functions.ncio import CHUNK_SIZE, iter_time_chunks, create_from_cdl
+from Experiments.functions.overlay import open_flux_set
+
+PROTOCOL_CDL = '/projects/0/ctdas/PARIS/templates/cdl_template/paris_protocol.cdl'
+
+# Pandas period frequency of each aggregation frequency (weeks start on Monday)
+FREQUENCIES = {'monthly': 'M', 'weekly': 'W-SUN', 'daily': 'D'}
+
+# Variables of the protocol file that are filled from the hourly flux sets
+PRIOR_VARIABLES = ['flux_ff_exchange_prior', 'flux_ocean_exchange_prior', 'flux_bio_exchange_prior', 'flux_fire_exchange_prior']
+
+def get_period_labels(time_var, frequency='monthly'):
+    """ Function to label each time step with the period (month, week or day) it belongs to
+    Input:
+        time_var: nc.Variable: time variable with CF units, sorted in time
+        frequency: str: 'monthly', 'weekly' or 'daily'
+    Returns:
+        tuple: (np.ndarray with the period index of each time step, list with the start date of each period) """
+    dates = nc.num2date(time_var[:], time_var.units, getattr(time_var, 'calendar', 'standard'),
+                        only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+    periods = pd.DatetimeIndex(dates).to_period(FREQUENCIES[frequency])
+    labels, uniques = pd.factorize(periods)
+    if np.any(np.diff(labels) < 0):
+        raise ValueError('The time axis of ' + time_var.group().filepath() + ' is not sorted')
+    return labels, list(uniques.start_time.to_pydatetime())
+
+def create_protocol_file(path, nperiods, frequency='monthly', cdlpath=PROTOCOL_CDL, profile=None):
+    """ Function to create an empty file in the protocol layout, with the length of the time axis and the
+    frequency attribute set for the aggregation
+    Input:
+        path: str: path of the new file
+        nperiods: int: number of periods (time steps) of the file
+        frequency: str: 'monthly', 'weekly' or 'daily'
+        cdlpath: str: path to the paris_protocol.cdl template
+        profile: str or dict: storage profile of the flux fields (see STORAGE_PROFILES in functions/ncio.py)
+    Returns:
+        nc.Dataset: the new dataset, opened in append mode """
+    with open(cdlpath) as f:
+        cdl = f.read()
+    cdl = re.sub(r'\btime = \d+ ;', 'time = ' + str(nperiods) + ' ;', cdl, count=1)
+    cdl = re.sub(r':frequency = "[^"]*"', ':frequency = "' + frequency + '"', cdl)
+    tmp_path = path + '.cdl'
+    with open(tmp_path, 'w') as f:
+        f.write(cdl)
+    try:
+        return create_from_cdl(tmp_path, path, profile)
+    finally:
+        os.remove(tmp_path)
+
+def aggregate_flux_set(path, out_path, frequency='monthly', variables=None, chunk_size=CHUNK_SIZE, cdlpath=PROTOCOL_CDL, profile=None):
+    """ Function to aggregate an hourly flux set to mean fluxes per period in the protocol layout, in one pass
+    Input:
+        path: str: path to the hourly BASE or perturbed flux set (or overlay file)
+        out_path: str: path of the protocol file to create
+        frequency: str: 'monthly' (as in the protocol), 'weekly' or 'daily'
+        variables: list: names of the variables to aggregate (default: the prior fluxes in PRIOR_VARIABLES)
+        chunk_size: int: number of time steps read at once
+        cdlpath: str: path to the paris_protocol.cdl template
+        profile: str or dict: storage profile of the flux fields (see STORAGE_PROFILES in functions/ncio.py)
+    Returns:
+        np.ndarray: number of hourly time steps in each period """
+    src, read_chunk, datasets = open_flux_set(path)
+    try:
+        labels, starts = get_period_labels(src.variables['time'], frequency)
+        if variables is None:
+            variables = [name for name in PRIOR_VARIABLES if name in src.variables]
+        counts = np.bincount(labels, minlength=len(starts))
+
+        with create_protocol_file(out_path, len(starts), frequency, cdlpath, profile) as dst:
+            dst.variables['latitude'][:] = src.variables['latitude'][:]
+            dst.variables['longitude'][:] = src.variables['longitude'][:]
+            time_var = dst.variables['time']
+            time_var[:] = nc.date2num(starts, time_var.units, getattr(time_var, 'calendar', 'standard'))
+            for name in variables:
+                if 'comment' in src.variables[name].ncattrs():
+                    dst.variables[name].comment = src.variables[name].comment
+
+            # RUNNING SUM OF THE CURRENT PERIOD, WRITTEN AS A MEAN WHEN THE NEXT PERIOD STARTS
+            sums = {name: np.zeros(src.variables[name].shape[1:]) for name in variables}
+            period = labels[0]
+            for t in iter_time_chunks(len(labels), chunk_size):
+                print('Working on ... ' + out_path + ', time steps ' + str(t.start) + ' to ' + str(t.stop))
+                chunk = {name: read_chunk(name, t) for name in variables}
+                chunk_labels = labels[t]
+                bounds = [0] + list(np.flatnonzero(np.diff(chunk_labels)) + 1) + [len(chunk_labels)]
+                for start, stop in zip(bounds[:-1], bounds[1:]):
+                    if chunk_labels[start] != period:
+                        for name in variables:
+                            dst.variables[name][period] = sums[name] / counts[period]
+                            sums[name][:] = 0
+                        period = chunk_labels[start]
+                    for name in variables:
+                        sums[name] += chunk[name][start:stop].sum(axis=0, dtype=np.float64)
+            for name in variables:
+                dst.variables[name][period] = sums[name] / counts[period]
+    finally:
+        for dataset in datasets:
+            dataset.close()
+    return counts
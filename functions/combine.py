@@ -0,0 +1,108 @@
+# This file contains functions to combine the merged CTE-HR flux streams (nep, ff_emissions_CO2,
+# ocean and fire) into the single paris_input.nc file derived from the CDL template. The streams
+# are copied in bounded time chunks: the chunks of all streams are read concurrently in a process
+# pool (the netCDF library is not thread-safe) and written in order by the main process, which is
+# the only one that has the output file open. Every source file is opened per chunk and closed again.
+
+##############################################
+########## LOAD NECCESSARY PACKAGES ##########
+##############################################
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import zip_longest
+import netCDF4 as nc
+from Experiments.functions.ncio import CHUNK_SIZE, iter_time_chunks
+from Experiments.functions.mergetime import MAX_PROCESSES, READ_AHEAD, iter_read_ahead
+from Experiments.functions.instrument import stage, record_io
+
+def get_stream_variables(path, varnames, outnames, copy_all=False):
+    """ Function to get the variables of a stream file and their names in paris_input.nc. The flux of the
+    stream is the last variable of the file and is renamed, other variables keep their names.
+    Input:
+        path: str: path to the merged stream file
+        varnames: list: names of the fluxes in the stream files (e.g. 'nep', 'anthropogenic')
+        outnames: list: names of these fluxes in paris_input.nc (e.g. 'flux_bio_exchange_prior')
+        copy_all: bool: if True, also copy all other variables of the stream (time, latitude, longitude and the
+            sectors of the fossil fuel stream)
+    Returns:
+        list: (name in the stream file, name in paris_input.nc) of each variable to copy """
+    with nc.Dataset(path, 'r') as src:
+        sectorname = list(src.variables.keys())[-1]
+        new_varname = outnames[varnames.index(sectorname)]
+        others = [(name, name) for name in src.variables if name != sectorname] if copy_all else []
+    return others + [(sectorname, new_varname)]
+
+def read_stream_chunk(path, names, t):
+    """ Function to read a time chunk of variables from a stream file
+    Input:
+        path: str: path to the stream file
+        names: list: names of the time-dependent variables to read
+        t: slice: time steps of the chunk
+    Returns:
+        dict: values of each variable """
+    with nc.Dataset(path, 'r') as src:
+        return {name: src.variables[name][t] for name in names}
+
+def _read_worker(args):
+    """ Function to unpack the arguments of read_stream_chunk() in the process pool """
+    return read_stream_chunk(*args)
+
+def get_chunks(ntime, time_slices, chunk_size=CHUNK_SIZE):
+    """ Function to split time slices of a file into chunks of bounded length
+    Input:
+        ntime: int: length of the time axis of the file
+        time_slices: list: slices of time steps to copy (slice(None) for all)
+        chunk_size: int: maximum number of time steps per chunk
+    Returns:
+        list: slices of at most chunk_size time steps """
+    chunks = []
+    for time_slice in time_slices:
+        start, stop, _ = time_slice.indices(ntime)
+        chunks += [slice(start + t.start, start + t.stop) for t in iter_time_chunks(max(stop - start, 0), chunk_size)]
+    return chunks
+
+def combine_streams(dst, streams, chunk_size=CHUNK_SIZE, processes=None, ahead=None, copy_static=True):
+    """ Function to copy the variables of several stream files into one open output file, in time chunks that
+    are read concurrently from all streams and written by the calling process only
+    Input:
+        dst: nc.Dataset: output file (e.g. created from the paris_input.cdl template), opened in write or append mode
+        streams: list: per stream a dict with 'path', 'variables' (pairs from get_stream_variables()) and optionally
+            'time_slices' (list of slices of time steps to copy, default: all)
+        chunk_size: int: number of time steps read at once per stream
+        processes: int: number of reading processes (default: one per stream, at most the number of CPUs and MAX_PROCESSES)
+        ahead: int: number of chunks read ahead of the writer, and so at most held in memory (default: READ_AHEAD,
+            see functions/mergetime.py)
+        copy_static: bool: if True, also copy the variables without a time dimension (latitude, longitude)
+    Returns:
+        int: number of time chunks written """
+    per_stream = []
+    for stream in streams:
+        with nc.Dataset(stream['path'], 'r') as src:
+            ntime = len(src.dimensions['time'])
+            fields = [(name, new_name) for name, new_name in stream['variables'] if src.variables[name].dimensions[:1] == ('time',)]
+            if copy_static:
+                for name, new_name in stream['variables']:
+                    if (name, new_name) not in fields:
+                        dst.variables[new_name][:] = src.variables[name][:]
+        chunks = get_chunks(ntime, stream.get('time_slices', [slice(None)]), chunk_size)
+        per_stream.append([((stream['path'], [name for name, _ in fields], t), (fields, t)) for t in chunks])
+
+    # INTERLEAVE THE CHUNKS OF THE STREAMS, SO THAT ALL STREAMS ARE READ AT THE SAME TIME
+    order = [item for group in zip_longest(*per_stream) for item in group if item is not None]
+    if not order:
+        return 0
+    processes = processes if processes is not None else min(len(streams), os.cpu_count(), MAX_PROCESSES)
+    ahead = ahead if ahead is not None else READ_AHEAD
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        results = iter_read_ahead(pool, [task for task, _ in order], ahead, worker=_read_worker)
+        for (path, _, _), (fields, t) in order:
+            print('Working on ... time steps ' + str(t.start) + ' to ' + str(t.stop) + ' of ' + ', '.join(new_name for _, new_name in fields))
+            # THE CHUNKS ARE READ BY THE WORKERS, THIS STAGE IS THE TIME SPENT WAITING FOR THEM
+            with stage('read', file=path, start=t.start, stop=t.stop):
+                values = next(results)
+            record_io(path, 'read', sum(chunk.nbytes for chunk in values.values()))
+            for name, new_name in fields:
+                with stage('write', new_name):
+                    dst.variables[new_name][t] = values[name]
+                record_io(dst.filepath(), 'write', values[name].nbytes)
+    return len(order)
@@ -0,0 +1,259 @@
+# This file contains functions to create a Monte Carlo ensemble of perturbation scenarios in a single
+# pass over the BASE flux set. Each member scales each sector in each region (the countries of the
+# mask file plus OTHER, the cells outside all countries) by its own factor: a (member x region x
+# sector) scale tensor, drawn with a seeded random generator around the factors of existing
+# experiments (e.g. ATEN, HFRA, HGER). A member scales a grid cell by 1 + the sum over the regions of
+# the fraction of the cell in the region times (factor - 1), as the perturbation engine does for a
+# single country, and the totals that depend on the sectors are updated by the change of the sectors.
+# Each time chunk of the BASE file is read once and used for all members:
+# - members: the scale fields of all members are made once with one sparse product of the region
+#   weights and the scale tensor, and the perturbed sectors and totals of all members are written to
+#   one file with a member dimension (the unperturbed variables are not repeated, see base_file).
+# - summary: the total per region, member and time step (mol) is calculated without making the
+#   perturbed fields. With the area-weighted region weights A and the region fractions W the total
+#   of region r is BASE total + sum_s G[r, s] (factor[s] - 1), with G[r, s] = sum over the cells of
+#   A[r] W[s] flux, so one sparse product per chunk gives the totals of all members.
+
+##############################################
+########## LOAD NECCESSARY PACKAGES ##########
+##############################################
+import os
+import netCDF4 as nc
+import numpy as np
+import scipy.sparse as sp
+from Experiments.functions.experiments import EXPERIMENTS, TOTALS, dependent_totals
+from Experiments.functions.masks import MASK_PATH, load_mask_registry
+from Experiments.functions.ncio import CHUNK_SIZE, STORAGE_PROFILES, iter_time_chunks, get_storage_options, set_chunk_cache
+from Experiments.functions.zonalstats import get_area_weights, get_timestep_seconds
+from Experiments.functions.instrument import stage, record_io
+
+# Name of the region of the cells outside all countries of the mask file
+OTHER_REGION = 'OTHER'
+
+# Standard deviation of the logarithm of the scale factors around their centre
+ENSEMBLE_SIGMA = 0.1
+
+# Number of members perturbed at once when writing all members (bounds the memory use per time chunk)
+MEMBER_BLOCK = 4
+
+def get_region_weights(registry):
+    """ Function to get the fraction of each grid cell in each region: the countries of a mask registry and OTHER
+    Input:
+        registry: dict: result of load_mask_registry()
+    Returns:
+        tuple: (list of region names, sp.csr_matrix (region, grid cell) fractions) """
+    weights = registry['weights']
+    other = np.clip(1. - np.asarray(weights.sum(axis=0)).ravel(), 0., 1.)
+    return registry['codes'] + [OTHER_REGION], sp.vstack([weights, sp.csr_matrix(other.reshape(1, -1))], format='csr')
+
+def get_sector_totals(sectors):
+    """ Function to get the totals that have to be updated when the sectors of an ensemble are scaled
+    Input:
+        sectors: list: names of the scaled variables
+    Returns:
+        list: names of the totals, in the order of TOTALS """
+    for sector in sectors:
+        overlap = set(dependent_totals(sector)).intersection(sectors)
+        if overlap:
+            raise ValueError(sector + ' and its total(s) ' + ', '.join(sorted(overlap)) + ' can not both be scaled')
+    needed = set().union(*[dependent_totals(sector) for sector in sectors])
+    return [total for total in TOTALS if total in needed]
+
+def get_center(regions, sectors, experimentcodes=()):
+    """ Function to get the scale factors of existing experiments as a (region x sector) array, around which the
+    members are drawn. An experiment that scales a total (e.g. combustion in ATEN) scales all sectors of that total.
+    Input:
+        regions: list: region names from get_region_weights()
+        sectors: list: names of the scaled variables
+        experimentcodes: list: names of experiments in EXPERIMENTS (default: none, all factors 1)
+    Returns:
+        np.ndarray: (region, sector) scale factors """
+    center = np.ones((len(regions), len(sectors)))
+    for code in experimentcodes:
+        experiment = EXPERIMENTS[code]
+        if experiment.get('landuse') or experiment.get('percentile') is not None:
+            raise ValueError('Experiment ' + code + ' has a land-use or percentile filter, which is not a country x sector scale factor')
+        columns = [k for k, sector in enumerate(sectors) if sector == experiment['variable'] or experiment['variable'] in dependent_totals(sector)]
+        if not columns:
+            raise ValueError('Experiment ' + code + ' perturbs ' + experiment['variable'] + ', which is not (made of) one of the sectors ' + ', '.join(sectors))
+        countries = experiment.get('country')
+        rows = list(range(len(regions))) if not countries else [regions.index(country) for country in np.atleast_1d(countries)]
+        center[np.ix_(rows, columns)] *= experiment['factor']
+    return center
+
+def draw_scales(nmembers, regions, sectors, seed=0, sigma=ENSEMBLE_SIGMA, experimentcodes=()):
+    """ Function to draw the scale factors of the members: log-normally distributed around the factors of
+    the experiments, independently per member, region and sector
+    Input:
+        nmembers: int: number of members
+        regions: list: region names from get_region_weights()
+        sectors: list: names of the scaled variables
+        seed: int: seed of the random generator, the same seed gives the same ensemble
+        sigma: float: standard deviation of the logarithm of the factors (0: all members equal to the center)
+        experimentcodes: list: names of experiments in EXPERIMENTS, see get_center()
+    Returns:
+        np.ndarray: (member, region, sector) scale factors """
+    rng = np.random.default_rng(seed)
+    center = get_center(regions, sectors, experimentcodes)
+    return center[None] * np.exp(sigma * rng.standard_normal((nmembers, len(regions), len(sectors))))
+
+def create_ensemble_file(base, path, scales, regions, sectors, variables, member_dims, attrs, profile=None):
+    """ Function to create the output file of an ensemble, with the scale factors of the members
+    Input:
+        base: nc.Dataset: the BASE flux set
+        path: str: path of the new file
+        scales: np.ndarray: (member, region, sector) scale factors
+        regions, sectors: list: names of the regions and of the scaled variables
+        variables: list: names of the output variables
+        member_dims: tuple: dimensions of the output variables
+        attrs: dict: global attributes added to those of the BASE flux set
+        profile: str or dict: storage profile of the fields (see STORAGE_PROFILES in functions/ncio.py, the members
+            are chunked one by one), None for the unchunked summary variables
+    Returns:
+        nc.Dataset: the new dataset, opened in write mode """
+    dst = nc.Dataset(path, 'w', format='NETCDF4')
+    dst.setncatts({name: base.getncattr(name) for name in base.ncattrs()})
+    dst.setncatts(attrs)
+    sizes = {'time': None, 'member': scales.shape[0], 'region': len(regions), 'sector': len(sectors)}
+    for name in ('time', 'member', 'region', 'sector'):
+        dst.createDimension(name, sizes[name])
+    coordinates = ['time']
+    if 'latitude' in member_dims:
+        sizes.update(latitude=len(base.dimensions['latitude']), longitude=len(base.dimensions['longitude']))
+        dst.createDimension('latitude', sizes['latitude'])
+        dst.createDimension('longitude', sizes['longitude'])
+        coordinates += ['latitude', 'longitude']
+    for name in coordinates:
+        var = base.variables[name]
+        new_var = dst.createVariable(name, var.dtype, var.dimensions)
+        new_var.setncatts({key: var.getncattr(key) for key in var.ncattrs() if key != '_FillValue'})
+        new_var[:] = var[:]
+
+    dst.createVariable('region', str, ('region',))[:] = np.array(regions, dtype=object)
+    dst.createVariable('sector', str, ('sector',))[:] = np.array(sectors, dtype=object)
+    scale = dst.createVariable('scale_factor', 'f8', ('member', 'region', 'sector'))
+    scale.long_name = 'scale factor of each sector in each region for each member'
+    scale[:] = scales
+
+    options = {}
+    if profile is not None:
+        profile = dict(STORAGE_PROFILES[profile] if isinstance(profile, str) else profile)
+        profile['chunks'] = dict(profile['chunks'], member=1)
+        options = get_storage_options(member_dims, sizes, profile)
+    for name in variables:
+        var = base.variables[name]
+        new_var = dst.createVariable(name, 'f4' if 'latitude' in member_dims else 'f8', member_dims, **options)
+        new_var.setncatts({key: var.getncattr(key) for key in var.ncattrs() if key not in ('_FillValue', 'units')})
+        new_var.units = var.units if 'latitude' in member_dims else 'mol'
+        if options:
+            set_chunk_cache(new_var)
+    return dst
+
+def run_ensemble(base_path, sectors, scales, members_path=None, summary_path=None, chunk_size=CHUNK_SIZE, mask_path=MASK_PATH,
+                 member_block=MEMBER_BLOCK, profile='map', area=None, attrs=None):
+    """ Function to apply the scale factors of all members of an ensemble in a single pass over the BASE flux set
+    Input:
+        base_path: str: path to the BASE flux set
+        sectors: list: names of the scaled variables (e.g. FF_LIST + ['cement'])
+        scales: np.ndarray: (member, region, sector) scale factors, e.g. from draw_scales(), with the regions of
+            get_region_weights()
+        members_path: str: path of the file with the perturbed sectors and totals of all members (None: not written)
+        summary_path: str: path of the file with the total per time step, member and region in mol (None: not written)
+        chunk_size: int: number of time steps read at once
+        mask_path: str: path to the fractional country mask file
+        member_block: int: number of members perturbed at once when writing all members
+        profile: str or dict: storage profile of the perturbed fields (see STORAGE_PROFILES in functions/ncio.py)
+        area: np.ndarray: (latitude, longitude) area of each grid cell in m2 for the summary (default: the area of the mask file)
+        attrs: dict: global attributes of the output files (e.g. the seed of the scale factors) """
+    registry = load_mask_registry(mask_path)
+    regions, weights = get_region_weights(registry)
+    totals = get_sector_totals(sectors)
+    variables = list(sectors) + totals
+    nmembers = scales.shape[0]
+    if scales.shape != (nmembers, len(regions), len(sectors)):
+        raise ValueError('The scale factors have shape ' + str(scales.shape) + ', expected (member, ' + str(len(regions)) + ', ' + str(len(sectors)) + ')')
+    deviation = scales - 1.
+    attrs = dict(attrs or {}, base_file=os.path.abspath(base_path), ensemble_sectors=', '.join(sectors))
+
+    fields = None
+    if members_path is not None:
+        # (CELL, MEMBER, SECTOR) SCALE FIELDS OF ALL MEMBERS: ONE SPARSE PRODUCT OF THE REGION FRACTIONS AND THE SCALE TENSOR
+        fields = 1. + (weights.T @ deviation.transpose(1, 0, 2).reshape(len(regions), -1)).reshape(-1, nmembers, len(sectors))
+    if summary_path is not None:
+        # AREA-WEIGHTED REGION WEIGHTS AND, FOR EACH PAIR OF REGIONS (r, s), THE PRODUCT OF THE AREA IN r AND THE FRACTION IN s
+        country_area = get_area_weights(registry, area)
+        cell_area = np.asarray(area if area is not None else registry['area'], dtype=np.float64).reshape(1, -1)
+        area_weights = sp.vstack([country_area, weights[-1].multiply(cell_area)], format='csr')
+        pairs = sp.vstack([weights.multiply(area_weights[r]) for r in range(len(regions))], format='csr')
+
+    with nc.Dataset(base_path, 'r') as base:
+        base.set_auto_mask(False)
+        ntime = len(base.dimensions['time'])
+        shape = base.variables[sectors[0]].shape[1:]
+        outs = {}
+        try:
+            if members_path is not None:
+                outs['members'] = create_ensemble_file(base, members_path, scales, regions, sectors, variables,
+                                                       ('time', 'member', 'latitude', 'longitude'), attrs, profile)
+            if summary_path is not None:
+                outs['summary'] = create_ensemble_file(base, summary_path, scales, regions, sectors, variables,
+                                                       ('time', 'member', 'region'), attrs)
+                seconds = get_timestep_seconds(base.variables['time'])
+
+            for t in iter_time_chunks(ntime, chunk_size):
+                print('Working on ... ensemble of ' + str(nmembers) + ' members, time steps ' + str(t.start) + ' to ' + str(t.stop))
+                data = {}
+                for name in variables:
+                    with stage('read', name):
+                        data[name] = np.asarray(base.variables[name][t], dtype=np.float64).reshape(t.stop - t.start, -1)
+                    record_io(base_path, 'read', data[name].size * base.variables[name].dtype.itemsize)
+
+                if summary_path is not None:
+                    with stage('ensemble_summary'):
+                        summary = {name: (area_weights @ data[name].T).T[:, None, :] for name in variables}
+                        for k, sector in enumerate(sectors):
+                            # (TIME, REGION, REGION) PAIR TOTALS, TIMES THE (MEMBER, REGION) DEVIATIONS OF THE FACTORS
+                            pair_totals = (pairs @ data[sector].T).T.reshape(-1, len(regions), len(regions))
+                            delta = np.einsum('trs,ms->tmr', pair_totals, deviation[:, :, k])
+                            for name in [sector] + dependent_totals(sector):
+                                summary[name] = summary[name] + delta
+                    for name in variables:
+                        outs['summary'].variables[name][t] = summary[name] * seconds[t][:, None, None]
+
+                if members_path is not None:
+                    for start in range(0, nmembers, member_block):
+                        block = slice(start, min(start + member_block, nmembers))
+                        with stage('ensemble_members'):
+                            result = {name: np.repeat(data[name][:, None, :], block.stop - block.start, axis=1) for name in totals}
+                            for k, sector in enumerate(sectors):
+                                perturbed = data[sector][:, None, :] * fields[:, block, k].T[None]
+                                for total in dependent_totals(sector):
+                                    result[total] += perturbed - data[sector][:, None, :]
+                                result[sector] = perturbed
+                        for name in variables:
+                            values = result[name].reshape((t.stop - t.start, block.stop - block.start) + shape).astype(np.float32)
+                            with stage('write', name):
+                                outs['members'].variables[name][t, block] = values
+                            record_io(members_path, 'write', values.nbytes)
+        finally:
+            for out in outs.values():
+                out.close()
+
+def generate_ensemble(base_path, nmembers, sectors, experimentcodes=(), seed=0, sigma=ENSEMBLE_SIGMA, members_path=None, summary_path=None,
+                      chunk_size=CHUNK_SIZE, mask_path=MASK_PATH, member_block=MEMBER_BLOCK, profile='map', area=None):
+    """ Function to draw a seeded ensemble around existing experiments and apply it in a single pass over the BASE flux set
+    Input:
+        base_path: str: path to the BASE flux set
+        nmembers: int: number of members
+        sectors: list: names of the scaled variables (e.g. FF_LIST + ['cement'])
+        experimentcodes: list: names of the experiments in EXPERIMENTS around which the factors are drawn (e.g. ['HFRA', 'HGER'])
+        seed: int: seed of the random generator
+        sigma: float: standard deviation of the logarithm of the factors
+        other arguments: see run_ensemble()
+    Returns:
+        np.ndarray: (member, region, sector) scale factors of the members """
+    regions, _ = get_region_weights(load_mask_registry(mask_path))
+    scales = draw_scales(nmembers, regions, sectors, seed, sigma, experimentcodes)
+    attrs = {'ensemble_seed': seed, 'ensemble_sigma': sigma, 'ensemble_experiments': ', '.join(experimentcodes)}
+    run_ensemble(base_path, sectors, scales, members_path, summary_path, chunk_size, mask_path, member_block, profile, area, attrs)
+    return scales
@@ -0,0 +1,73 @@
+# This file contains the definitions of the flux perturbation experiments of the PARIS WP6
+# verification games. Adding a new experiment only requires adding an entry to EXPERIMENTS.
+
+# Sectors that together make up the 'combustion' variable of the BASE flux set
+FF_LIST = [
+    'A_Public_power',
+    'B_Industry',
+    'C_Other_stationary_combustion_consumer',
+    'F_On-road',
+    'H_Aviation',
+    'I_Off-road',
+    'G_Shipping'
+]
+
+# Variables that are the sum of other variables, in the order in which they have to be updated
+TOTALS = {
+    'combustion': FF_LIST,
+    'flux_ff_exchange_prior': ['combustion', 'cement'],
+}
+
+# Each experiment scales one variable of the BASE flux set by 'factor'. Optional keys:
+#   country: ISO code (or list of ISO codes) of the fractional country mask(s) that restrict the perturbation
+#            (weighted by the mask fraction)
+#   landuse: list of CORINE PFT classes that restricts the perturbation
+#   percentile: only perturb values above this percentile of the non-zero values of the variable
+#   percentile_groupby: 'global' (default), 'timestep', 'month' or 'country', see functions/quantiles.py
+#   percentile_method: 'exact' (default) or 'sketch', see functions/quantiles.py
+EXPERIMENTS = {
+    # Anthropogenic combustion emissions over the entire domain enhanced by 10%
+    'ATEN': {
+        'variable': 'combustion',
+        'factor': 1.1,
+    },
+    # Emissions of the top 10% emitters of the public power sector removed
+    'PTEN': {
+        'variable': 'A_Public_power',
+        'factor': 0.0,
+        'percentile': 90,
+    },
+    # Industry emissions of France halved
+    'HFRA': {
+        'variable': 'B_Industry',
+        'factor': 0.5,
+        'country': 'FRA',
+    },
+    # On-road transport emissions of Germany halved
+    'HGER': {
+        'variable': 'F_On-road',
+        'factor': 0.5,
+        'country': 'DEU',
+    },
+    # NEE over Finnish forests: nep + 2 * nep * FIN_mask, as in the original paris_DFIN.py
+    'DFIN': {
+        'variable': 'flux_bio_exchange_prior',
+        'factor': 3.0,
+        'country': 'FIN',
+        'landuse': [2, 5, 8],
+    },
+}
+
+def dependent_totals(variable):
+    """ Function to find the totals that have to be updated when a variable is perturbed
+    Input:
+        variable: str: name of the perturbed variable
+    Returns:
+        list: names of the affected totals, in the order in which they have to be updated """
+    changed = {variable}
+    totals = []
+    for total, parts in TOTALS.items():
+        if changed.intersection(parts):
+            totals.append(total)
+            changed.add(total)
+    return totals
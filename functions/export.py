@@ -0,0 +1,165 @@
+# This file contains functions to export a BASE or perturbed flux set (full file or overlay) for random
+# access by many concurrent processes, e.g. the footprint convolution of a transport model. Two layouts
+# are supported:
+# - raw: a directory with one uncompressed C-ordered binary file per variable ({name}.bin, time x latitude
+#   x longitude), the coordinates as .npy files and a small index.json with the dtype, shape, fill value
+#   and attributes of each variable. The reader maps these files with np.memmap, so a process only reads
+#   the hours and cells it touches, as zero-copy NumPy views without any HDF5 lock.
+# - zarr: a chunked Zarr store (the zarr package is optional and only imported when needed).
+# Both are written by streaming the netCDF file in bounded time chunks.
+
+##############################################
+########## LOAD NECCESSARY PACKAGES ##########
+##############################################
+import json
+import os
+import numpy as np
+from Experiments.functions.ncio import CHUNK_SIZE, iter_time_chunks, is_field, get_storage_options
+from Experiments.functions.overlay import open_flux_set
+
+INDEX_FILE = 'index.json'
+COORDINATES = ['time', 'latitude', 'longitude']
+
+def get_attrs(var):
+    """ Function to get the attributes of a netCDF variable as JSON-serializable values """
+    attrs = {}
+    for key in var.ncattrs():
+        value = var.getncattr(key)
+        attrs[key] = value.tolist() if isinstance(value, (np.ndarray, np.generic)) else value
+    return attrs
+
+def export_raw(path, out_dir, variables=None, chunk_size=CHUNK_SIZE):
+    """ Function to export a flux set to the raw memory-mappable layout
+    Input:
+        path: str: path to the BASE or perturbed flux set (or overlay file)
+        out_dir: str: directory of the export, created if it does not exist
+        variables: list: names of the flux fields to export (default: all)
+        chunk_size: int: number of time steps read at once
+    Returns:
+        dict: the index of the export """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    src, read_chunk, datasets = open_flux_set(path)
+    try:
+        if variables is None:
+            variables = [name for name, var in src.variables.items() if is_field(var)]
+        index = {'source': os.path.abspath(path), 'layout': 'raw', 'attrs': get_attrs(src), 'coordinates': {}, 'variables': {}}
+        for name in COORDINATES:
+            np.save(os.path.join(out_dir, name + '.npy'), src.variables[name][:])
+            index['coordinates'][name] = {'file': name + '.npy', 'attrs': get_attrs(src.variables[name])}
+
+        arrays = {}
+        for name in variables:
+            var = src.variables[name]
+            attrs = get_attrs(var)
+            index['variables'][name] = {'file': name + '.bin', 'dtype': var.dtype.str, 'shape': list(var.shape),
+                                        'fill_value': attrs.pop('_FillValue', None), 'attrs': attrs}
+            arrays[name] = np.memmap(os.path.join(out_dir, name + '.bin'), dtype=var.dtype, mode='w+', shape=var.shape)
+
+        for t in iter_time_chunks(len(src.dimensions['time']), chunk_size):
+            print('Working on ... ' + out_dir + ', time steps ' + str(t.start) + ' to ' + str(t.stop))
+            for name in variables:
+                arrays[name][t] = read_chunk(name, t)
+        for array in arrays.values():
+            array.flush()
+    finally:
+        for dataset in datasets:
+            dataset.close()
+
+    # THE INDEX IS WRITTEN LAST, SO AN INCOMPLETE EXPORT HAS NO INDEX
+    with open(os.path.join(out_dir, INDEX_FILE), 'w') as f:
+        json.dump(index, f, indent=1)
+    return index
+
+def export_zarr(path, out_path, variables=None, chunk_size=CHUNK_SIZE, profile='balanced'):
+    """ Function to export a flux set to a chunked Zarr store (needs the zarr package)
+    Input:
+        path: str: path to the BASE or perturbed flux set (or overlay file)
+        out_path: str: path of the Zarr store, overwritten if it exists
+        variables: list: names of the flux fields to export (default: all)
+        chunk_size: int: number of time steps read at once
+        profile: str or dict: storage profile that sets the chunk shape (see STORAGE_PROFILES in functions/ncio.py)
+    Returns:
+        zarr.Group: the Zarr store """
+    import zarr
+
+    src, read_chunk, datasets = open_flux_set(path)
+    try:
+        if variables is None:
+            variables = [name for name, var in src.variables.items() if is_field(var)]
+        group = zarr.open_group(out_path, mode='w')
+        group.attrs.update(get_attrs(src))
+        create = group.create_array if hasattr(group, 'create_array') else group.create_dataset
+        sizes = {name: len(dim) for name, dim in src.dimensions.items()}
+
+        for name in COORDINATES:
+            values = src.variables[name][:]
+            array = create(name, shape=values.shape, dtype=values.dtype)
+            array[:] = values
+            array.attrs.update(get_attrs(src.variables[name]))
+        arrays = {}
+        for name in variables:
+            var = src.variables[name]
+            attrs = get_attrs(var)
+            chunks = tuple(get_storage_options(var.dimensions, sizes, profile)['chunksizes'])
+            arrays[name] = create(name, shape=var.shape, chunks=chunks, dtype=var.dtype, fill_value=attrs.pop('_FillValue', None))
+            arrays[name].attrs.update(attrs)
+
+        for t in iter_time_chunks(len(src.dimensions['time']), chunk_size):
+            print('Working on ... ' + out_path + ', time steps ' + str(t.start) + ' to ' + str(t.stop))
+            for name in variables:
+                arrays[name][t] = read_chunk(name, t)
+    finally:
+        for dataset in datasets:
+            dataset.close()
+    return group
+
+def export_flux_set(path, out_path, layout='raw', variables=None, chunk_size=CHUNK_SIZE):
+    """ Function to export a flux set to the raw memory-mappable layout or a Zarr store
+    Input:
+        path: str: path to the BASE or perturbed flux set (or overlay file)
+        out_path: str: directory of the export or path of the Zarr store
+        layout: str: 'raw' or 'zarr'
+        variables: list: names of the flux fields to export (default: all)
+        chunk_size: int: number of time steps read at once """
+    if layout == 'raw':
+        export_raw(path, out_path, variables, chunk_size)
+    elif layout == 'zarr':
+        export_zarr(path, out_path, variables, chunk_size)
+    else:
+        raise ValueError('Unknown export layout ' + str(layout) + ', use raw or zarr')
+
+def open_export(path):
+    """ Function to open an exported flux set for reading. Nothing is read until the arrays are indexed.
+    Input:
+        path: str: directory of a raw export or path of a Zarr store
+    Returns:
+        dict: 'attrs' (global attributes), 'coordinates' and 'variables' (per name an array indexed as
+        [time, latitude, longitude]: a read-only np.memmap for the raw layout, a zarr.Array for Zarr) and
+        'index' (the index of a raw export, None for Zarr) """
+    index_path = os.path.join(path, INDEX_FILE)
+    if not os.path.exists(index_path):
+        import zarr
+        group = zarr.open_group(path, mode='r')
+        names = list(group.array_keys())
+        return {'attrs': dict(group.attrs), 'index': None,
+                'coordinates': {name: group[name][:] for name in COORDINATES},
+                'variables': {name: group[name] for name in names if name not in COORDINATES}}
+
+    with open(index_path) as f:
+        index = json.load(f)
+    coordinates = {name: np.load(os.path.join(path, entry['file']), mmap_mode='r') for name, entry in index['coordinates'].items()}
+    variables = {name: np.memmap(os.path.join(path, entry['file']), dtype=np.dtype(entry['dtype']), mode='r', shape=tuple(entry['shape']))
+                 for name, entry in index['variables'].items()}
+    return {'attrs': index['attrs'], 'index': index, 'coordinates': coordinates, 'variables': variables}
+
+def read_export(path, name, t=slice(None), rows=slice(None), cols=slice(None)):
+    """ Function to read part of a variable of an exported flux set
+    Input:
+        path: str: directory of a raw export or path of a Zarr store
+        name: str: name of the variable
+        t: slice or int: time steps to read
+        rows, cols: slice or int: latitude and longitude indices to read
+    Returns:
+        np.ndarray: the requested values (a view of the mapped file for the raw layout) """
+    return open_export(path)['variables'][name][t, rows, cols]
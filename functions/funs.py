@@ -5,33 +5,111 @@
 ##############################################
 ########## LOAD NECCESSARY PACKAGES ##########
 ##############################################
+import hashlib
+import os
 import netCDF4 as nc
 import numpy as np
-from scipy import stats
+
+LU_PATH = '/projects/0/ctdas/NRT/data/SiB/CORINE_PFT_EUROPA_NRT.nc'
+# Directory of the cache of the aggregated land use (None: no cache), set by the scripts that use get_lu()
+LU_CACHE_DIR = None
+
+def block_view(arr, new_shape):
+    """ Function to group the cells of the last two axes of an array into blocks that each cover one
+    cell of a coarser grid
+    Input:
+        arr: np.ndarray: original array, the last two axes should be a multiple of new_shape
+        new_shape: tuple: (ny, nx) shape of the coarser grid
+    Returns:
+        np.ndarray: view of shape (..., ny, nx, cells per block) """
+    ny, nx = new_shape[-2], new_shape[-1]
+    by, bx = arr.shape[-2] // ny, arr.shape[-1] // nx
+    lead = arr.shape[:-2]
+    blocks = arr.reshape(lead + (ny, by, nx, bx))
+    blocks = np.moveaxis(blocks, len(lead) + 2, len(lead) + 1)
+    return blocks.reshape(lead + (ny, nx, by * bx))
+
+def block_counts(arr, new_shape):
+    """ Function to count how often each (integer) class occurs in each block. Masked cells (e.g. the _FillValue
+    of a netCDF variable) and NaN cells are not counted, and the classes are numbered by np.unique, so that a large
+    class value (e.g. a fill value of 255) does not make the counts array larger.
+    Input:
+        arr: np.ndarray or np.ma.MaskedArray: original array of integer classes
+        new_shape: tuple: (ny, nx) shape of the coarser grid
+    Returns:
+        tuple: (np.ndarray of shape (..., ny, nx, nclass) with the counts, np.ndarray of the nclass classes) """
+    data = np.ma.getdata(arr)
+    valid = ~np.ma.getmaskarray(arr)
+    if np.issubdtype(data.dtype, np.floating):
+        valid &= ~np.isnan(data)
+    blocks = block_view(data, new_shape)
+    flat = blocks.reshape(-1, blocks.shape[-1])
+    valid = block_view(valid, new_shape).reshape(flat.shape)
+    classes, class_ids = np.unique(flat[valid], return_inverse=True)
+    block_ids = np.nonzero(valid)[0]
+    counts = np.bincount(block_ids * len(classes) + class_ids.ravel(), minlength=len(flat) * len(classes))
+    return counts.reshape(blocks.shape[:-1] + (len(classes),)), classes
+
+def block_mode(arr, new_shape):
+    """ Function to find the most common class in each block of cells, for aggregating a categorical
+    array (e.g. land use) to a coarser grid. Ties are resolved to the smallest class, as in scipy.stats.mode.
+    Blocks without any valid cell keep the value of their first cell (e.g. the fill value).
+    Input:
+        arr: np.ndarray or np.ma.MaskedArray: original array of integer classes, the last two axes should be a multiple of new_shape
+        new_shape: tuple: (ny, nx) shape of the coarser grid
+    Returns:
+        np.ndarray: most common class per coarse grid cell, shape (..., ny, nx) """
+    counts, classes = block_counts(arr, new_shape)
+    empty = counts.sum(axis=-1) == 0
+    if not empty.any():
+        return classes[counts.argmax(axis=-1)]
+    first = block_view(np.ma.getdata(arr), new_shape)[..., 0]
+    if not len(classes):
+        return first
+    return np.where(empty, first, classes[counts.argmax(axis=-1)])
 
 def median2d(arr, new_shape):
-    """ Function to average any given shape, which is a multiple of the domain size, to the domain size
+    """ Function to aggregate any given shape, which is a multiple of the domain size, to the domain size
+    by taking the most common value of each block (see block_mode)
     Input:
-        arr: np.ndarray: original array to be averaged
-        new_shape: tuple: shape to be averaged to
+        arr: np.ndarray: original array to be aggregated, 2D or 3D with time as the first axis
+        new_shape: tuple: shape to be aggregated to
     Returns:
-        np.ndarray: averaged arr"""
-    shape = (new_shape[0], arr.shape[-2] // new_shape[-2],
-             new_shape[1], arr.shape[-1] // new_shape[-1])
-    if len(arr.shape) == 3: # If time is included:
-        shape = (len(arr),) + shape
-        
-    a = stats.mode(arr.reshape(shape), axis=1)[0]
-    b = stats.mode(a, axis=3)[0]
-    return b.squeeze()
-def get_lu(flux_array):
+        np.ndarray: aggregated arr"""
+    return block_mode(arr, new_shape).squeeze()
+
+def get_lu(flux_array, lu_path=None, cache_dir=None):
     """ Function to extract the landuse given any given shape. The shape should be a multiplication of 
     0.05 x 0.05 degrees, so a shape with a 0.1 x 0.2 gridcell size would be possible, but a 0.0825 x 0.125 wouldn't be.   
+    The aggregated landuse is cached on disk, keyed by the landuse file (path, size and modification time)
+    and the target shape, so it only has to be computed once per grid.
+    Input:
+        flux_array: np.ndarray or nc.Variable: (time, latitude, longitude) field, only its shape is used
+        lu_path: str: path to the landuse file (default: LU_PATH, read when called)
+        cache_dir: str: directory of the cache (default: LU_CACHE_DIR, read when called), False to disable the cache
+            (as does LU_CACHE_DIR = None)
     Returns:
         returns the landuse array from the landuse dataset  of any given shape overlapping with the 
         extent of this landuse dataset """
-    with nc.Dataset('/projects/0/ctdas/NRT/data/SiB/CORINE_PFT_EUROPA_NRT.nc') as ds:
+    lu_path = lu_path if lu_path is not None else LU_PATH
+    cache_dir = cache_dir if cache_dir is not None else LU_CACHE_DIR
+    new_shape = tuple(flux_array.shape[1:])
+    stat = os.stat(lu_path)
+    key = '|'.join([os.path.abspath(lu_path), str(stat.st_size), str(stat.st_mtime_ns), str(new_shape), 'block_mode_valid'])
+    cache_file = None
+    if cache_dir:
+        cache_file = os.path.join(cache_dir, 'landuse_' + hashlib.sha1(key.encode()).hexdigest() + '.npy')
+        if os.path.exists(cache_file):
+            return np.load(cache_file)
+
+    with nc.Dataset(lu_path) as ds:
         lu = ds['landuse'][:]
         lu = np.flipud(lu)
-    lu = median2d(lu, flux_array.shape[1:])  
-    return lu
\ No newline at end of file
+    lu = median2d(lu, new_shape)
+
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = cache_file + '.' + str(os.getpid()) + '.tmp.npy'
+        np.save(tmp_file, lu)
+        os.replace(tmp_file, cache_file)
+    return lu
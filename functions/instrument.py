@@ -0,0 +1,188 @@
+# This file contains a light-weight instrumentation layer for the pipeline scripts. A script starts a
+# run with start_run() and ends it with finish_run(); the library functions wrap their stages in
+# `with stage(name, variable):` blocks and report the bytes they read from and write to each file with
+# record_io(). For every stage the wall time, the CPU time of the process, the bytes read and written
+# by the process (rchar/wchar of /proc/self/io, where available) and the peak resident memory are
+# written as one JSON line to the log of the run, and summed per stage and variable into the JSON
+# report of the run. Nested stages are also counted in their parent. In the process pools (e.g. of
+# functions/mergetime.py) the reads happen in the workers: the 'read' stages of the main process then
+# measure the time it waits for them, which is the time the run is bound by reading.
+# Without a started run stage() and record_io() do nothing, so the library functions can be used
+# without instrumentation. Stages listed in profile_stages of start_run() are also profiled with
+# cProfile (one {stage}.prof file per stage name, for pstats or snakeviz). For sampling profilers the
+# process id is logged at the start of the run, so that e.g. 'py-spy record --pid <pid>' can be attached.
+# The scripts in yr1 write the JSON-lines log (.log.jsonl) and the JSON report (.json) of their run next
+# to their output, and list the stages to profile in profile_stages at the top of the script (none by default).
+
+##############################################
+########## LOAD NECCESSARY PACKAGES ##########
+##############################################
+import cProfile
+import datetime as dt
+import json
+import os
+import resource
+import socket
+import sys
+import time
+from contextlib import contextmanager
+
+# The current run of this process, set by start_run()
+_RUN = None
+
+def read_proc_io():
+    """ Function to read the number of bytes this process has read and written so far, including reads that were
+    served from the page cache
+    Returns:
+        tuple: (bytes read, bytes written), (0, 0) where /proc/self/io is not available """
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(':', 1) for line in f if ':' in line)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """ Function to get the peak resident memory of this process (or of its terminated child processes)
+    Input:
+        who: int: resource.RUSAGE_SELF or resource.RUSAGE_CHILDREN
+    Returns:
+        float: peak resident set size in MB """
+    # ru_maxrss IS IN KILOBYTES ON LINUX AND IN BYTES ON MACOS
+    return resource.getrusage(who).ru_maxrss / (1024. ** 2 if sys.platform == 'darwin' else 1024.)
+
+def emit(record):
+    """ Function to write a record as one JSON line to the log of the current run (if it has one) """
+    if _RUN is not None and _RUN['log'] is not None:
+        _RUN['log'].write(json.dumps(dict(record, time=time.time())) + '\n')
+        _RUN['log'].flush()
+
+def start_run(name, log_path=None, report_path=None, profile_dir=None, profile_stages=()):
+    """ Function to start the instrumentation of a run of a script in this process
+    Input:
+        name: str: name of the run (e.g. the name of the script)
+        log_path: str: path of the JSON-lines log with one record per stage, appended to (None: no log)
+        report_path: str: path of the JSON report written by finish_run() (None: no report file)
+        profile_dir: str: directory of the cProfile statistics (default: the directory of the report)
+        profile_stages: list: names of the stages to profile with cProfile
+    Returns:
+        dict: the run """
+    global _RUN
+    if profile_dir is None and report_path is not None:
+        profile_dir = os.path.dirname(os.path.abspath(report_path))
+    _RUN = {
+        'name': name,
+        'start_time': dt.datetime.now().isoformat(timespec='seconds'),
+        'wall': time.perf_counter(),
+        'cpu': time.process_time(),
+        'io': read_proc_io(),
+        'log': open(log_path, 'a') if log_path is not None else None,
+        'report_path': report_path,
+        'profile_dir': profile_dir,
+        'profile_stages': set(profile_stages),
+        'profilers': {},
+        'profiling': False,
+        'stages': {},
+        'files': {},
+    }
+    emit({'event': 'start', 'run': name, 'pid': os.getpid(), 'host': socket.gethostname()})
+    return _RUN
+
+@contextmanager
+def stage(name, variable=None, **fields):
+    """ Function (context manager) to instrument a stage of the current run; does nothing without a run
+    Input:
+        name: str: name of the stage (e.g. 'read', 'perturb', 'write')
+        variable: str: variable (or experiment, stream) the stage works on; the report sums per name and variable
+        fields: extra JSON-serializable values that are only written to the log (e.g. the file or time steps) """
+    run = _RUN
+    if run is None:
+        yield
+        return
+
+    profiler = None
+    if name in run['profile_stages'] and not run['profiling']:
+        # ONE PROFILER PER STAGE NAME, ENABLED FOR EACH OCCURRENCE OF THE STAGE; NESTED PROFILED STAGES ARE PART OF THE OUTER ONE
+        profiler = run['profilers'].setdefault(name, cProfile.Profile())
+        run['profiling'] = True
+        profiler.enable()
+    wall, cpu, (read, written) = time.perf_counter(), time.process_time(), read_proc_io()
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        read_now, written_now = read_proc_io()
+        if profiler is not None:
+            profiler.disable()
+            run['profiling'] = False
+        record = {'wall_seconds': wall, 'cpu_seconds': cpu, 'read_bytes': read_now - read, 'write_bytes': written_now - written}
+        peak = peak_rss_mb()
+        emit(dict({'event': 'stage', 'stage': name, 'variable': variable, 'peak_rss_mb': peak, 'failed': failed}, **record, **fields))
+
+        totals = run['stages'].setdefault(name if variable is None else name + ':' + str(variable),
+                                          {'stage': name, 'variable': variable, 'count': 0, 'wall_seconds': 0., 'cpu_seconds': 0.,
+                                           'read_bytes': 0, 'write_bytes': 0, 'peak_rss_mb': 0.})
+        totals['count'] += 1
+        for key, value in record.items():
+            totals[key] += value
+        totals['peak_rss_mb'] = max(totals['peak_rss_mb'], peak)
+
+def record_io(path, mode, nbytes):
+    """ Function to add the (uncompressed) number of bytes read from or written to a file to the current run;
+    does nothing without a run
+    Input:
+        path: str: path of the file
+        mode: str: 'read' or 'write'
+        nbytes: int: number of bytes (e.g. the nbytes of the array that was read or written) """
+    if _RUN is None:
+        return
+    counts = _RUN['files'].setdefault(os.path.abspath(path), {'read_bytes': 0, 'write_bytes': 0, 'reads': 0, 'writes': 0})
+    counts[mode + '_bytes'] += int(nbytes)
+    counts[mode + 's'] += 1
+
+def finish_run(report_path=None):
+    """ Function to end the current run: write its JSON report and the cProfile statistics of the profiled stages
+    Input:
+        report_path: str: path of the JSON report (default: report_path of start_run())
+    Returns:
+        dict: the report (None if no run was started) """
+    global _RUN
+    run = _RUN
+    if run is None:
+        return None
+    report_path = report_path if report_path is not None else run['report_path']
+    read, written = read_proc_io()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    report = {
+        'run': run['name'],
+        'host': socket.gethostname(),
+        'pid': os.getpid(),
+        'start_time': run['start_time'],
+        'wall_seconds': time.perf_counter() - run['wall'],
+        'cpu_seconds': time.process_time() - run['cpu'],
+        'children_cpu_seconds': children.ru_utime + children.ru_stime,
+        'read_bytes': read - run['io'][0],
+        'write_bytes': written - run['io'][1],
+        'peak_rss_mb': peak_rss_mb(),
+        'children_peak_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN),
+        'stages': sorted(run['stages'].values(), key=lambda totals: -totals['wall_seconds']),
+        'files': {path: dict(counts, size=os.path.getsize(path) if os.path.exists(path) else None) for path, counts in run['files'].items()},
+        'profiles': {},
+    }
+    for name, profiler in run['profilers'].items():
+        os.makedirs(run['profile_dir'] or '.', exist_ok=True)
+        report['profiles'][name] = os.path.join(run['profile_dir'] or '.', run['name'] + '.' + name + '.prof')
+        profiler.dump_stats(report['profiles'][name])
+
+    emit({'event': 'finish', 'run': run['name'], 'wall_seconds': report['wall_seconds'], 'peak_rss_mb': report['peak_rss_mb']})
+    if run['log'] is not None:
+        run['log'].close()
+    if report_path is not None:
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=1)
+    _RUN = None
+    return report
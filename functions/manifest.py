@@ -0,0 +1,131 @@
+# This file contains functions to keep a manifest of the input files of the BASE flux set build,
+# so that it can be kept up to date incrementally. A manifest is a JSON file next to a merged
+# file with a record per input file (path, size, modification time, optional checksum, time
+# range and position in the merged file). Every update of the merged file increases the revision
+# of the manifest, and the records that were (re)written get that revision, so that a later step
+# (combine_for_paris.py) can find the time steps that changed since it last read the file.
+
+##############################################
+########## LOAD NECCESSARY PACKAGES ##########
+##############################################
+import hashlib
+import json
+import os
+import netCDF4 as nc
+
+def file_checksum(path, blocksize=2 ** 20):
+    """ Function to calculate the SHA-1 checksum of a file
+    Input:
+        path: str: path to the file
+        blocksize: int: number of bytes read at once
+    Returns:
+        str: hexadecimal checksum """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def file_record(path, checksum=False):
+    """ Function to describe an input file
+    Input:
+        path: str: path to the netCDF file
+        checksum: bool: if True, also store the SHA-1 checksum of the file (slower, but independent of the modification time)
+    Returns:
+        dict: path, size, mtime_ns, checksum (or None), time_start and time_stop (ISO dates) and ntime """
+    stat = os.stat(path)
+    with nc.Dataset(path, 'r') as src:
+        time_var = src.variables['time']
+        dates = nc.num2date(time_var[[0, -1]], time_var.units, getattr(time_var, 'calendar', 'standard'))
+        ntime = len(time_var)
+    return {
+        'path': os.path.abspath(path),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'checksum': file_checksum(path) if checksum else None,
+        'time_start': dates[0].isoformat(),
+        'time_stop': dates[-1].isoformat(),
+        'ntime': ntime,
+    }
+
+def is_changed(record, path, checksum=False):
+    """ Function to check whether a file differs from its manifest record
+    Input:
+        record: dict: record from file_record(), or None if the file is not in the manifest
+        path: str: path to the file
+        checksum: bool: if True, compare checksums instead of size and modification time
+    Returns:
+        bool: True if the file is new or changed """
+    if record is None:
+        return True
+    stat = os.stat(path)
+    if stat.st_size != record['size']:
+        return True
+    if checksum and record.get('checksum') is not None:
+        return file_checksum(path) != record['checksum']
+    return stat.st_mtime_ns != record['mtime_ns']
+
+def load_manifest(path):
+    """ Function to read a manifest
+    Input:
+        path: str: path to the JSON manifest
+    Returns:
+        dict: 'revision' and 'files' (record per absolute input path), empty if the manifest does not exist """
+    if not os.path.exists(path):
+        return {'revision': 0, 'files': {}}
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(manifest, path):
+    """ Function to write a manifest, replacing the old one only when it is complete
+    Input:
+        manifest: dict: manifest from load_manifest()
+        path: str: path to the JSON manifest """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, path)
+
+def changed_files(manifest, paths, checksum=False):
+    """ Function to find the input files that are new or changed since the manifest was written
+    Input:
+        manifest: dict: manifest from load_manifest()
+        paths: list: paths to the input files
+        checksum: bool: see is_changed()
+    Returns:
+        list: paths of the new or changed files, in the order of paths """
+    return [path for path in paths if is_changed(manifest['files'].get(os.path.abspath(path)), path, checksum)]
+
+def record_files(manifest, paths, positions, checksum=False):
+    """ Function to add or update the records of files that were written to the merged file, as a new revision
+    Input:
+        manifest: dict: manifest from load_manifest(), updated in place
+        paths: list: paths to the input files that were written
+        positions: list: index of the first time step of each file in the merged file
+        checksum: bool: see file_record()
+    Returns:
+        dict: the manifest """
+    manifest['revision'] += 1
+    for path, position in zip(paths, positions):
+        record = file_record(path, checksum)
+        record['index'] = int(position)
+        record['revision'] = manifest['revision']
+        manifest['files'][record['path']] = record
+    return manifest
+
+def changed_time_steps(manifest, since_revision):
+    """ Function to find the time steps of a merged file that were written after a given revision
+    Input:
+        manifest: dict: manifest of the merged file
+        since_revision: int: revision that was last read (0: all time steps)
+    Returns:
+        list: sorted, non-overlapping slices of time steps in the merged file """
+    ranges = sorted((record['index'], record['index'] + record['ntime']) for record in manifest['files'].values()
+                    if record['revision'] > since_revision)
+    slices = []
+    for start, stop in ranges:
+        if slices and start <= slices[-1].stop:
+            slices[-1] = slice(slices[-1].start, max(stop, slices[-1].stop))
+        else:
+            slices.append(slice(start, stop))
+    return slices
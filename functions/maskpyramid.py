@@ -0,0 +1,194 @@
+# This file contains functions to build a pyramid of fractional country mask files at several
+# resolutions. The country geometries are only rasterized once, at the finest resolution (see
+# functions/rasterize.py), and each coarser grid whose cells are made of an integer number of
+# fine grid cells is derived from it by area-weighted block aggregation. This keeps all
+# resolutions consistent: the area of each country (sum of fraction x cell area) is the same
+# on every level of the pyramid.
+
+##############################################
+########## LOAD NECCESSARY PACKAGES ##########
+##############################################
+import os
+from datetime import datetime
+import netCDF4 as nc
+import numpy as np
+from Experiments.functions.funs import block_view
+from Experiments.functions.rasterize import LON_BOUNDS, LAT_BOUNDS, get_grid, bboxarea, rasterize_countries, load_country_geometries
+
+# (res_lon, res_lat) of the coarser levels derived from the finest (0.05 degree) mask file
+PYRAMID_RESOLUTIONS = [(0.2, 0.1), (0.5, 0.5), (1.0, 1.0)]
+
+def get_mask_filename(res_lon, res_lat):
+    """ Function to get the name of a mask file, following paris_countrymask_0.2x0.1deg_2D.nc
+    Input:
+        res_lon: float: longitude resolution in degrees
+        res_lat: float: latitude resolution in degrees
+    Returns:
+        str: file name """
+    if res_lon == res_lat:
+        return 'paris_countrymask_' + str(res_lon) + 'deg_2D.nc'
+    return 'paris_countrymask_' + str(res_lon) + 'x' + str(res_lat) + 'deg_2D.nc'
+
+def get_block_shape(shape, res_lon, res_lat, fine_res_lon, fine_res_lat):
+    """ Function to find the shape of a coarser grid that is made of blocks of fine grid cells
+    Input:
+        shape: tuple: (latitude, longitude) shape of the fine grid
+        res_lon, res_lat: float: resolution of the coarse grid in degrees
+        fine_res_lon, fine_res_lat: float: resolution of the fine grid in degrees
+    Returns:
+        tuple: (latitude, longitude) shape of the coarse grid """
+    factors = []
+    for n, res, fine_res in ((shape[0], res_lat, fine_res_lat), (shape[1], res_lon, fine_res_lon)):
+        factor = int(round(res / fine_res))
+        if not np.isclose(factor * fine_res, res) or n % factor != 0:
+            raise ValueError('A ' + str(res_lon) + 'x' + str(res_lat) + ' degree grid can not be made of blocks of the ' +
+                             str(fine_res_lon) + 'x' + str(fine_res_lat) + ' degree grid of shape ' + str(shape))
+        factors.append(factor)
+    return shape[0] // factors[0], shape[1] // factors[1]
+
+def aggregate_fraction(frac, area, new_shape):
+    """ Function to aggregate a fractional mask to a coarser grid, weighting each fine grid cell by its area
+    Input:
+        frac: np.ndarray: (latitude, longitude) fraction of each fine grid cell inside the country (NaN is read as 0)
+        area: np.ndarray: (latitude, longitude) area of each fine grid cell
+        new_shape: tuple: (latitude, longitude) shape of the coarse grid, see get_block_shape()
+    Returns:
+        np.ndarray: (latitude, longitude) fraction of each coarse grid cell inside the country """
+    covered = block_view(np.nan_to_num(frac) * area, new_shape).sum(axis=-1)
+    return covered / block_view(area, new_shape).sum(axis=-1)
+
+def write_mask_file(path, frac_list, codes, names, timezones, area, lon_bounds=LON_BOUNDS, lat_bounds=LAT_BOUNDS, res_lon=0.2, res_lat=0.1, area_comment=None):
+    """ Function to write fractional country masks to a netCDF file in the format of paris_countrymask_0.2x0.1deg_2D.nc
+    Input:
+        path: str: path of the mask file, overwritten if it exists
+        frac_list: list or generator: (latitude, longitude) fractional mask of each country
+        codes: list: ISO code of each country
+        names: list: full name of each country
+        timezones: list: timezone abbreviation of each country
+        area: np.ndarray: (latitude, longitude) area of each grid cell in m2
+        lon_bounds, lat_bounds: list: edges of the grid
+        res_lon, res_lat: float: resolution of the grid in degrees
+        area_comment: str: description of how the area was calculated """
+    lons, lats = get_grid(lon_bounds, lat_bounds, res_lon, res_lat)
+    if os.path.exists(path):
+        os.remove(path)
+
+    with nc.Dataset(path, mode='w', format='NETCDF4') as mask_nc:
+        # Initialize netCDF dimensions
+        mask_nc.createDimension('longitude', len(lons))
+        mask_nc.createDimension('latitude', len(lats))
+        mask_nc.createDimension('countrynumber', len(codes))
+
+        mask_nc.description = "Fractional country masks for European countries based on the 10m Natural Earth data set. Multiply with flux sets to retain only country-specific flux fields"
+        mask_nc.geospatial_lat_resolution = str(res_lat) + " degree"
+        mask_nc.geospatial_lon_resolution = str(res_lon) + " degree"
+        mask_nc.creation_date = datetime.today().strftime('%Y-%m-%d')
+        mask_nc.institution = "Wageningen University, department of Meteorology and Air Quality, Wageningen, the Netherlands"
+        mask_nc.contact = "Daan Kivits; daan.kivits@wur.nl"
+
+        # Initialize netCDF variables
+        longitude = mask_nc.createVariable('longitude', 'f4', ('longitude'), zlib=True)
+        longitude.standard_name = "longitude"
+        longitude.axis = "X"
+        longitude.units = "degrees_east"
+        longitude[:] = lons
+
+        latitude = mask_nc.createVariable('latitude', 'f4', ('latitude'), zlib=True)
+        latitude.standard_name = "latitude"
+        latitude.axis = "Y"
+        latitude.units = "degrees_north"
+        latitude[:] = lats
+
+        areavar = mask_nc.createVariable('area', 'f4', ('latitude', 'longitude'))
+        areavar.long_name = "variable area per gridcell"
+        areavar.comment = area_comment if area_comment is not None else "area is calculated based on a spherical earth of 6371 km, assuming a perfect sphere"
+        areavar.units = "m^2"
+        areavar[:, :] = area
+
+        countryname = mask_nc.createVariable('country_name', str, ('countrynumber'))
+        countryname.long_name = "full country name"
+        countryname.comment = "ISO standard full country name"
+
+        countryabbrev = mask_nc.createVariable('country_abbrev', str, ('countrynumber'))
+        countryabbrev.long_name = "abbreviation of country name"
+        countryabbrev.comment = "ISO standard abbreviation of country codes"
+
+        countrytimezone = mask_nc.createVariable('country_abbrev_timezone', str, ('countrynumber'))
+        countrytimezone.long_name = "abbreviation of country-specific timezone"
+        countrytimezone.comment = "ISO standard abbreviation of country-specific timezone"
+
+        countryarea = mask_nc.createVariable('country_area', 'f4', ('countrynumber'), zlib=True)
+        countryarea.long_name = "total area of each country in the fractional country mask"
+        countryarea.comment = "sum of the fraction of each grid cell inside the country times the area of the grid cell"
+        countryarea.units = "m^2"
+
+        for country_index, frac in enumerate(frac_list):
+            print('WORKING ON ... ' + names[country_index], flush=True)
+            countryname[country_index] = names[country_index]
+            countryabbrev[country_index] = codes[country_index]
+            countrytimezone[country_index] = timezones[country_index]
+
+            countrymask = mask_nc.createVariable(codes[country_index], 'f4', ('latitude', 'longitude'), zlib=True)
+            countrymask.long_name = "fractional country mask for " + names[country_index]
+            countrymask[:, :] = frac
+            countryarea[country_index] = np.nansum(np.asarray(area, dtype=np.float64) * frac)
+
+def rasterize_mask_file(countrylist, path, res_lon=0.05, res_lat=0.05, natural_earth_res=10, processes=None):
+    """ Function to create the finest level of the pyramid by rasterizing the Natural Earth country geometries
+    Input:
+        countrylist: pd.DataFrame: country list with 'code' and 'timezone' columns, as in country_list.csv
+        path: str: path of the mask file
+        res_lon, res_lat: float: resolution of the grid in degrees
+        natural_earth_res: int: resolution of the Natural Earth data set (10, 50 or 110 m)
+        processes: int: number of worker processes, see rasterize_countries() """
+    geometries, names = load_country_geometries(countrylist, natural_earth_res)
+    frac_list = rasterize_countries(geometries, LON_BOUNDS, LAT_BOUNDS, res_lon, res_lat, processes)
+    area = bboxarea(LON_BOUNDS, LAT_BOUNDS, res_lon, res_lat)
+    write_mask_file(path, frac_list, list(countrylist['code']), names, list(countrylist['timezone']), area,
+                    LON_BOUNDS, LAT_BOUNDS, res_lon, res_lat)
+
+def derive_mask_file(src_path, path, res_lon, res_lat):
+    """ Function to derive a coarser mask file from a finer one by area-weighted block aggregation, one country at a time
+    Input:
+        src_path: str: path of the fine mask file
+        path: str: path of the coarse mask file
+        res_lon, res_lat: float: resolution of the coarse grid in degrees, an integer multiple of the fine resolution """
+    with nc.Dataset(src_path, 'r') as src:
+        lons = src.variables['longitude'][:].astype(np.float64)
+        lats = src.variables['latitude'][:].astype(np.float64)
+        # THE COORDINATES ARE STORED AS FLOAT32, SO THE RESOLUTION IS TAKEN OVER THE FULL AXIS AND ROUNDED
+        fine_res_lon = float(np.round((lons[-1] - lons[0]) / (len(lons) - 1), 4))
+        fine_res_lat = float(np.round((lats[-1] - lats[0]) / (len(lats) - 1), 4))
+        lon_bounds = [float(np.round(lons[0], 4)), float(np.round(lons[0] + len(lons) * fine_res_lon, 4))]
+        lat_bounds = [float(np.round(lats[0], 4)), float(np.round(lats[0] + len(lats) * fine_res_lat, 4))]
+
+        area = src.variables['area'][:, :].filled(0).astype(np.float64)
+        new_shape = get_block_shape(area.shape, res_lon, res_lat, fine_res_lon, fine_res_lat)
+        codes = [str(code) for code in src.variables['country_abbrev'][:]]
+        names = [str(name) for name in src.variables['country_name'][:]]
+        if 'country_abbrev_timezone' in src.variables:
+            timezones = [str(timezone) for timezone in src.variables['country_abbrev_timezone'][:]]
+        else:
+            timezones = [''] * len(codes)
+
+        # THE COARSE CELL AREA IS THE SUM OF THE FINE CELL AREAS, SO THAT THE COUNTRY AREAS ARE PRESERVED
+        coarse_area = block_view(area, new_shape).sum(axis=-1)
+        frac_list = (aggregate_fraction(src.variables[code][:, :].filled(0), area, new_shape) for code in codes)
+        write_mask_file(path, frac_list, codes, names, timezones, coarse_area, lon_bounds, lat_bounds, res_lon, res_lat,
+                        area_comment='area is the sum of the areas of the grid cells of ' + os.path.basename(src_path))
+
+def build_pyramid(src_path, out_dir, resolutions=PYRAMID_RESOLUTIONS):
+    """ Function to derive the coarser levels of the mask pyramid from the finest mask file
+    Input:
+        src_path: str: path of the finest mask file (e.g. paris_countrymask_0.05deg_2D.nc)
+        out_dir: str: directory to write the coarser mask files to
+        resolutions: list: (res_lon, res_lat) of each coarser level
+    Returns:
+        list: paths of the coarser mask files """
+    paths = []
+    for res_lon, res_lat in resolutions:
+        path = os.path.join(out_dir, get_mask_filename(res_lon, res_lat))
+        print('Working on ' + path + ' ... ', flush=True)
+        derive_mask_file(src_path, path, res_lon, res_lat)
+        paths.append(path)
+    return paths
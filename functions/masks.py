@@ -0,0 +1,153 @@
+# This file contains functions used by the flux perturbation scripts to load the fractional
+# country masks created by templates/landmask/extract_countrymasks_Europe.ipynb. All masks of a
+# mask file are held in a registry: one sparse (country x grid cell) matrix with the fraction of
+# each grid cell inside each country, the index raster of the dominant country and the cell area.
+# Registries are loaded once per mask file and cached (see MASK_CACHE_SIZE).
+
+##############################################
+########## LOAD NECCESSARY PACKAGES ##########
+##############################################
+import os
+from functools import lru_cache
+import netCDF4 as nc
+import numpy as np
+import scipy.sparse as sp
+
+MASK_PATH = '/projects/0/ctdas/PARIS/Experiments/landmask/paris_countrymask_0.2x0.1deg_2D.nc'
+
+# Number of mask registries (e.g. different resolutions) kept in memory, least recently used are evicted
+MASK_CACHE_SIZE = 4
+
+def get_bbox(mask):
+    """ Function to find the tight bounding box of the non-zero cells of a mask
+    Input:
+        mask: np.ndarray: 2D (latitude, longitude) mask
+    Returns:
+        tuple: (row_start, row_stop, col_start, col_stop), the full domain if the mask is empty """
+    rows = np.flatnonzero(np.any(mask != 0, axis=1))
+    cols = np.flatnonzero(np.any(mask != 0, axis=0))
+    if rows.size == 0:
+        return (0, mask.shape[0], 0, mask.shape[1])
+    return (int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1)
+
+@lru_cache(maxsize=MASK_CACHE_SIZE)
+def _read_registry(mask_path, mtime_ns, size):
+    """ Function to read all country masks of a mask file into a registry. Cached on the path, the
+    modification time and the size of the file, so that a rewritten mask file is read again.
+    Input:
+        mask_path: str: absolute path to the fractional country mask file
+        mtime_ns: int: modification time of the file
+        size: int: size of the file in bytes
+    Returns:
+        dict: registry, see load_mask_registry() """
+    with nc.Dataset(mask_path, 'r') as mask:
+        codes = [str(code) for code in mask.variables['country_abbrev'][:]]
+        shape = mask.variables[codes[0]].shape
+        rows = []
+        for code in codes:
+            # MASKED (_FillValue) AND NaN CELLS ARE OUTSIDE THE COUNTRY: MASKS STORED WITH NaN AS FILL HAVE NO _FillValue
+            fraction = np.ma.filled(mask.variables[code][:, :], 0).astype(np.float64)
+            rows.append(sp.csr_matrix(np.where(np.isfinite(fraction), fraction, 0.).reshape(1, -1)))
+        area = None
+        if 'area' in mask.variables:
+            area = np.ma.filled(mask.variables['area'][:, :], 0).astype(np.float64)
+            area = np.where(np.isfinite(area), area, 0.)
+
+    weights = sp.vstack(rows, format='csr')
+    weights.eliminate_zeros()
+    dominant = np.full(weights.shape[1], -1)
+    best = np.zeros(weights.shape[1])
+    for i, code in enumerate(codes):
+        cells = weights.indices[weights.indptr[i]:weights.indptr[i + 1]]
+        values = weights.data[weights.indptr[i]:weights.indptr[i + 1]]
+        larger = values > best[cells]
+        dominant[cells[larger]] = i
+        best[cells[larger]] = values[larger]
+
+    bboxes = {}
+    for i, code in enumerate(codes):
+        cells = weights.indices[weights.indptr[i]:weights.indptr[i + 1]]
+        if cells.size == 0:
+            bboxes[code] = (0, shape[0], 0, shape[1])
+            continue
+        rows_i, cols_i = np.unravel_index(cells, shape)
+        bboxes[code] = (int(rows_i.min()), int(rows_i.max()) + 1, int(cols_i.min()), int(cols_i.max()) + 1)
+
+    registry = {
+        'path': mask_path,
+        'codes': codes,
+        'index': {code: i for i, code in enumerate(codes)},
+        'shape': shape,
+        'weights': weights,
+        'dominant': dominant.reshape(shape),
+        'bboxes': bboxes,
+        'area': area,
+    }
+    for value in (registry['dominant'], registry['area'], weights.data, weights.indices, weights.indptr):
+        if value is not None:
+            value.flags.writeable = False
+    return registry
+
+def load_mask_registry(mask_path=MASK_PATH):
+    """ Function to load the registry of all country masks of a mask file, read only once per file
+    Input:
+        mask_path: str: path to the fractional country mask file
+    Returns:
+        dict: 'codes' (list of ISO codes), 'index' (row of each ISO code), 'shape' (latitude, longitude),
+        'weights' (sparse CSR (country, grid cell) matrix with the fraction of each grid cell inside each
+        country), 'dominant' (2D index of the country with the largest fraction, -1 outside all countries),
+        'bboxes' (bounding box of each country) and 'area' (2D cell area, None if not in the file).
+        The arrays are shared between callers and read-only. """
+    mask_path = os.path.abspath(mask_path)
+    stat = os.stat(mask_path)
+    return _read_registry(mask_path, stat.st_mtime_ns, stat.st_size)
+
+def get_country_weights(registry, codes, window=None):
+    """ Function to get the combined fractional mask of one or more countries from a registry
+    Input:
+        registry: dict: result of load_mask_registry()
+        codes: str or list: ISO code(s) of the countries. The fractions of multiple countries are added,
+            which gives their union as the country masks do not overlap.
+        window: tuple: (row_start, row_stop, col_start, col_stop) part of the domain (default: all)
+    Returns:
+        np.ndarray: 2D (latitude, longitude) array with the fraction of each grid cell inside the countries """
+    if isinstance(codes, str):
+        codes = [codes]
+    rows = [registry['index'][code] for code in codes]
+    fractions = np.asarray(registry['weights'][rows].sum(axis=0)).reshape(registry['shape'])
+    fractions = np.minimum(fractions, 1).astype(np.float32)
+    if window is not None:
+        fractions = fractions[window[0]:window[1], window[2]:window[3]]
+    return fractions
+
+def load_country_mask(code, mask_path=MASK_PATH, window=None):
+    """ Function to load the fractional country mask of a single country
+    Input:
+        code: str: ISO code of the country, as used in country_list.csv (e.g. 'DEU'), or a list of codes
+        mask_path: str: path to the fractional country mask file
+        window: tuple: (row_start, row_stop, col_start, col_stop) part of the domain to load (default: all)
+    Returns:
+        np.ndarray: 2D (latitude, longitude) array with the fraction of each grid cell inside the country """
+    return get_country_weights(load_mask_registry(mask_path), code, window)
+
+def load_country_bbox(code, mask_path=MASK_PATH):
+    """ Function to find the bounding box of a country in the fractional country mask file
+    Input:
+        code: str: ISO code of the country, as used in country_list.csv (e.g. 'DEU'), or a list of codes
+        mask_path: str: path to the fractional country mask file
+    Returns:
+        tuple: (row_start, row_stop, col_start, col_stop) of the cells with a non-zero country fraction """
+    registry = load_mask_registry(mask_path)
+    if isinstance(code, str):
+        return registry['bboxes'][code]
+    return get_bbox(get_country_weights(registry, code))
+
+def load_country_index(mask_path=MASK_PATH):
+    """ Function to create a raster with the index of the dominant country of each grid cell
+    Input:
+        mask_path: str: path to the fractional country mask file
+    Returns:
+        tuple: (2D np.ndarray with the index of the country with the largest fraction in each grid cell,
+        -1 for cells outside all countries, list of ISO codes of the countries) """
+    registry = load_mask_registry(mask_path)
+    return registry['dominant'], registry['codes']
@@ -0,0 +1,308 @@
+# This file contains functions to merge the daily CTE-HR output files of one flux stream into a
+# single file along the time axis, as done before with 'cdo mergetime' followed by 'cdo setgrid'
+# and an in-place unit conversion. The grid definition (a CDO grid description file such as
+# europe.grid) and the unit conversion are applied while the daily files are copied, so the
+# output is written in one pass without temporary files. The daily files are read ahead in a
+# process pool (the netCDF library is not thread-safe) and written in time order by the main process.
+
+##############################################
+########## LOAD NECCESSARY PACKAGES ##########
+##############################################
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import netCDF4 as nc
+import numpy as np
+from Experiments.functions.manifest import load_manifest, save_manifest, changed_files, record_files
+from Experiments.functions.instrument import stage, record_io
+
+# CTE-HR fluxes are in micromol m-2 s-1, the PARIS files in mol m-2 s-1
+UNIT_FACTOR = 1e-6
+UNITS = 'mol m-2 s-1'
+
+# Default maximum number of reading processes: the merge is bound by reading the files, not by the CPU
+MAX_PROCESSES = 4
+
+# Default number of files (or time chunks) read ahead of the writer, which bounds the data held in memory
+# independently of the number of CPUs of the node
+READ_AHEAD = 4
+
+def read_griddes(path):
+    """ Function to read a CDO grid description file (e.g. europe.grid)
+    Input:
+        path: str: path to the grid description file
+    Returns:
+        dict: the keys of the file (gridtype, xname, yname, xsize, ysize, xfirst, xinc, yfirst, yinc), numbers
+        converted to int or float """
+    griddes = {}
+    with open(path) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if '=' not in line:
+                continue
+            key, value = [part.strip() for part in line.split('=', 1)]
+            for convert in (int, float):
+                try:
+                    value = convert(value)
+                    break
+                except ValueError:
+                    pass
+            griddes[key] = value
+    return griddes
+
+def grid_coordinates(griddes):
+    """ Function to calculate the coordinates of a regular lon/lat grid description
+    Input:
+        griddes: dict: result of read_griddes()
+    Returns:
+        tuple: (1D np.ndarray of longitudes, 1D np.ndarray of latitudes) """
+    if griddes.get('gridtype', 'lonlat') != 'lonlat':
+        raise ValueError('Only lonlat grid descriptions are supported, not ' + str(griddes['gridtype']))
+    lons = griddes['xfirst'] + np.arange(griddes['xsize']) * griddes['xinc']
+    lats = griddes['yfirst'] + np.arange(griddes['ysize']) * griddes['yinc']
+    return lons, lats
+
+def get_time_range(path):
+    """ Function to read the time axis of a daily file
+    Input:
+        path: str: path to the daily file
+    Returns:
+        tuple: (first date, number of time steps) """
+    with nc.Dataset(path, 'r') as src:
+        time_var = src.variables['time']
+        first = nc.num2date(time_var[0], time_var.units, getattr(time_var, 'calendar', 'standard'))
+        return first, len(time_var)
+
+def get_time_values(path, time_units, calendar):
+    """ Function to read the time axis of a daily file in the time units of the merged file
+    Input:
+        path: str: path to the daily file
+        time_units: str: CF time units of the merged file
+        calendar: str: calendar of the merged file
+    Returns:
+        np.ndarray: time values of all time steps of the daily file """
+    with nc.Dataset(path, 'r') as src:
+        time_var = src.variables['time']
+        dates = nc.num2date(time_var[:], time_var.units, getattr(time_var, 'calendar', 'standard'))
+        return np.atleast_1d(nc.date2num(dates, time_units, calendar))
+
+def read_daily_file(path, time_units, calendar, factor=UNIT_FACTOR):
+    """ Function to read all time-dependent fields of a daily file, converting the units and the time axis
+    Input:
+        path: str: path to the daily file
+        time_units: str: CF time units of the merged file
+        calendar: str: calendar of the merged file
+        factor: float: unit conversion factor of the fields
+    Returns:
+        tuple: (time values in time_units, dict with the converted (time, latitude, longitude) field of each variable) """
+    with nc.Dataset(path, 'r') as src:
+        time_var = src.variables['time']
+        dates = nc.num2date(time_var[:], time_var.units, getattr(time_var, 'calendar', 'standard'))
+        times = nc.date2num(dates, time_units, calendar)
+        fields = {}
+        for name, var in src.variables.items():
+            if var.ndim == 3 and var.dimensions[0] == 'time':
+                # MASKED (FILL) VALUES STAY MASKED AND ARE WRITTEN AS THE FILL VALUE OF THE MERGED FILE
+                values = var[:]
+                fields[name] = (values * factor).astype(values.dtype)
+        return times, fields
+
+def _read_worker(args):
+    """ Function to unpack the arguments of read_daily_file() in the process pool """
+    return read_daily_file(*args)
+
+def iter_read_ahead(pool, tasks, ahead, worker=_read_worker):
+    """ Function to run tasks in a process pool in order, with at most 'ahead' results waiting in memory
+    Input:
+        pool: ProcessPoolExecutor: the process pool
+        tasks: list: arguments of the worker per task (e.g. per daily file)
+        ahead: int: number of tasks run ahead of the writer
+        worker: function: top-level function called with the arguments of each task (default: _read_worker())
+    Returns:
+        generator of the results of the worker (default: read_daily_file()), in the order of tasks """
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.submit(worker, task))
+        if len(pending) >= ahead:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def create_merged_file(template_path, outfile, griddes, attrs=None, variable_attrs=None):
+    """ Function to create the merged file, with the structure of a daily file on the grid of a grid description
+    Input:
+        template_path: str: path to the (first) daily file
+        outfile: str: path of the merged file
+        griddes: dict: result of read_griddes()
+        attrs: dict: global attributes added to those of the daily file
+        variable_attrs: dict: per variable name, attributes added to those of the daily file
+    Returns:
+        nc.Dataset: the merged file, opened in write mode """
+    lons, lats = grid_coordinates(griddes)
+    xname, yname = griddes.get('xname', 'lon'), griddes.get('yname', 'lat')
+    with nc.Dataset(template_path, 'r') as src:
+        dst = nc.Dataset(outfile, 'w', format=src.data_model)
+        dst.setncatts({name: src.getncattr(name) for name in src.ncattrs()})
+        dst.setncatts(attrs or {})
+        dst.createDimension('time', None)
+        dst.createDimension(yname, len(lats))
+        dst.createDimension(xname, len(lons))
+
+        time_src = src.variables['time']
+        time = dst.createVariable('time', time_src.dtype, ('time',))
+        time.setncatts({key: time_src.getncattr(key) for key in time_src.ncattrs() if key != '_FillValue'})
+
+        longitude = dst.createVariable(xname, 'f8', (xname,))
+        longitude.standard_name = 'longitude'
+        longitude.long_name = 'longitude'
+        longitude.units = 'degrees_east'
+        longitude.axis = 'X'
+        longitude[:] = lons
+        latitude = dst.createVariable(yname, 'f8', (yname,))
+        latitude.standard_name = 'latitude'
+        latitude.long_name = 'latitude'
+        latitude.units = 'degrees_north'
+        latitude.axis = 'Y'
+        latitude[:] = lats
+
+        for name, var in src.variables.items():
+            if not (var.ndim == 3 and var.dimensions[0] == 'time'):
+                continue
+            if var.shape[1:] != (len(lats), len(lons)):
+                raise ValueError(name + ' in ' + template_path + ' has shape ' + str(var.shape[1:]) +
+                                 ', the grid description has shape ' + str((len(lats), len(lons))))
+            fill_value = var.getncattr('_FillValue') if '_FillValue' in var.ncattrs() else None
+            new_var = dst.createVariable(name, var.dtype, ('time', yname, xname), fill_value=fill_value)
+            new_var.setncatts({key: var.getncattr(key) for key in var.ncattrs() if key != '_FillValue'})
+            new_var.units = UNITS
+            new_var.setncatts((variable_attrs or {}).get(name, {}))
+    return dst
+
+def merge_daily_files(infiles, outfile, gridfile, attrs=None, variable_attrs=None, factor=UNIT_FACTOR, processes=None, ahead=None):
+    """ Function to merge daily CTE-HR files along the time axis into one file on the grid of a grid description,
+    converting the units of all time-dependent fields, in a single write pass
+    Input:
+        infiles: list: paths to the daily files, sorted in time by this function
+        outfile: str: path of the merged file, overwritten if it exists
+        gridfile: str: path to the CDO grid description file (e.g. europe.grid)
+        attrs: dict: global attributes of the merged file, added to those of the daily files
+        variable_attrs: dict: per variable name, attributes of the merged file (e.g. a long_name)
+        factor: float: unit conversion factor of the fields (default: micromol to mol)
+        processes: int: number of processes reading the daily files (default: the number of CPUs, at most MAX_PROCESSES)
+        ahead: int: number of daily files read ahead of the writer, and so at most held in memory (default: READ_AHEAD)
+    Returns:
+        int: number of time steps in the merged file """
+    griddes = read_griddes(gridfile)
+    starts = [get_time_range(path) for path in infiles]
+    order = sorted(range(len(infiles)), key=lambda i: starts[i][0])
+    infiles = [infiles[i] for i in order]
+
+    dst = create_merged_file(infiles[0], outfile, griddes, attrs, variable_attrs)
+    try:
+        positions = np.cumsum([0] + [ntime for _, ntime in sorted(starts)])
+        write_daily_files(dst, infiles, positions[:-1], factor, processes, ahead)
+    finally:
+        dst.close()
+    return int(positions[-1])
+
+def write_daily_files(dst, infiles, positions, factor=UNIT_FACTOR, processes=None, ahead=None):
+    """ Function to write daily files into an open merged file at given time positions
+    Input:
+        dst: nc.Dataset: the merged file, opened in write or append mode
+        infiles: list: paths to the daily files
+        positions: list: index in the merged file of the first time step of each daily file
+        factor: float: unit conversion factor of the fields
+        processes: int: number of processes reading the daily files (default: the number of CPUs, at most MAX_PROCESSES)
+        ahead: int: number of daily files read ahead of the writer, and so at most held in memory (default: READ_AHEAD;
+            no more than this number of processes read at the same time) """
+    time_var = dst.variables['time']
+    calendar = getattr(time_var, 'calendar', 'standard')
+    tasks = [(path, time_var.units, calendar, factor) for path in infiles]
+    processes = processes if processes is not None else min(os.cpu_count(), MAX_PROCESSES)
+    ahead = ahead if ahead is not None else READ_AHEAD
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        results = iter_read_ahead(pool, tasks, ahead)
+        for path, position in zip(infiles, positions):
+            print('Working on ' + path + ' ... ', flush=True)
+            # THE DAILY FILES ARE READ BY THE WORKERS, THIS STAGE IS THE TIME SPENT WAITING FOR THEM
+            with stage('read', file=path):
+                times, fields = next(results)
+            record_io(path, 'read', sum(values.nbytes for values in fields.values()))
+            t = slice(int(position), int(position) + len(times))
+            time_var[t] = times
+            for name, values in fields.items():
+                with stage('write', name):
+                    dst.variables[name][t] = values
+                record_io(dst.filepath(), 'write', values.nbytes)
+
+def update_daily_files(infiles, outfile, gridfile, manifest_path, attrs=None, variable_attrs=None, factor=UNIT_FACTOR,
+                       processes=None, ahead=None, checksum=False):
+    """ Function to keep a merged file up to date with its daily files, using a manifest of the files merged before:
+    new days are appended along the (unlimited) time dimension and changed days are rewritten in place. The file is
+    merged from scratch if it or its manifest does not exist, if a new day falls before the end of the file or if a
+    changed day has other time steps than before (only the last day of the file may get more time steps, the time
+    dimension cannot shrink).
+    Input:
+        infiles: list: paths to all daily files
+        outfile: str: path of the merged file
+        gridfile: str: path to the CDO grid description file (e.g. europe.grid)
+        manifest_path: str: path to the JSON manifest of the merged file
+        checksum: bool: if True, detect changed days by their checksum instead of their size and modification time
+        other arguments: see merge_daily_files()
+    Returns:
+        int: number of daily files that were written """
+    manifest = load_manifest(manifest_path)
+    todo = changed_files(manifest, infiles, checksum) if os.path.exists(outfile) else list(infiles)
+    if not todo:
+        print(outfile + ' is up to date')
+        return 0
+
+    rebuild = not os.path.exists(outfile) or not manifest['files']
+    if not rebuild:
+        dst = nc.Dataset(outfile, 'a')
+        try:
+            time_var = dst.variables['time']
+            calendar = getattr(time_var, 'calendar', 'standard')
+            days = [get_time_values(path, time_var.units, calendar) for path in todo]
+            order = sorted(range(len(todo)), key=lambda i: days[i][0])
+            todo, days = [todo[i] for i in order], [days[i] for i in order]
+            # ALL TIME VALUES OF THE FILE, EXTENDED WITH THOSE OF EVERY DAY THAT IS APPENDED
+            times = np.asarray(time_var[:])
+            nold = len(times)
+            positions = []
+            for path, day in zip(todo, days):
+                index = int(np.searchsorted(times, day[0]))
+                record = manifest['files'].get(os.path.abspath(path))
+                old = record['ntime'] if record is not None else 0
+                if record is not None and index + old <= nold and np.array_equal(times[index:index + old], day[:old]) and \
+                        (len(day) == old or index + old == len(times)):
+                    # CHANGED DAYS ARE REWRITTEN IN PLACE, ONLY THE LAST DAY OF THE FILE MAY GET MORE TIME STEPS
+                    positions.append(index)
+                    times = np.concatenate([times, day[old:]])
+                elif index == len(times) and (len(times) == 0 or day[0] > times[-1]):
+                    # NEW DAYS AFTER THE END OF THE FILE ARE APPENDED
+                    positions.append(len(times))
+                    times = np.concatenate([times, day])
+                else:
+                    # E.G. A CHANGED DAY WITH FEWER TIME STEPS, WHOSE OLD TRAILING STEPS WOULD STAY IN THE FILE
+                    rebuild = True
+                    break
+            if not rebuild:
+                print('Updating ' + outfile + ': ' + str(sum(p >= nold for p in positions)) + ' new and ' +
+                      str(sum(p < nold for p in positions)) + ' changed daily files')
+                write_daily_files(dst, todo, positions, factor, processes, ahead)
+        finally:
+            dst.close()
+        if not rebuild:
+            save_manifest(record_files(manifest, todo, positions, checksum), manifest_path)
+            return len(todo)
+
+    print('Merging ' + outfile + ' from scratch')
+    starts = [get_time_range(path) for path in infiles]
+    infiles = [infiles[i] for i in sorted(range(len(infiles)), key=lambda i: starts[i][0])]
+    merge_daily_files(infiles, outfile, gridfile, attrs, variable_attrs, factor, processes, ahead)
+    positions = np.cumsum([0] + [ntime for _, ntime in sorted(starts)])[:-1]
+    manifest = load_manifest(manifest_path)
+    manifest['files'] = {}
+    save_manifest(record_files(manifest, infiles, positions, checksum), manifest_path)
+    return len(infiles)
@@ -0,0 +1,193 @@
+# This file contains functions used by the flux perturbation scripts to read and write the
+# PARIS netCDF files in bounded time chunks.
+
+##############################################
+########## LOAD NECCESSARY PACKAGES ##########
+##############################################
+import os
+import netCDF4 as nc
+
+# Number of hourly time steps held in memory per variable when streaming a file (one day)
+CHUNK_SIZE = 24
+
+# Maximum size of the HDF5 chunk cache of each flux field (bytes). A stream reads and writes every chunk once, so
+# the cache only has to hold the chunks of one time chunk; the default of the netCDF library (64 MiB per variable)
+# keeps chunks that are never used again, and the memory use then grows with the length of the file up to 64 MiB
+# per flux field of every open file.
+CHUNK_CACHE_SIZE = 4 * 1024 ** 2
+
+# Storage profiles of the (time, latitude, longitude) flux fields in NETCDF4 files. 'chunks' gives the HDF5
+# chunk length per dimension (a missing dimension is stored whole), 'complevel' the deflate level (0: no
+# compression), 'shuffle' the byte shuffle filter and 'significant_digits' the number of significant digits
+# kept by quantization (None: lossless, needed to verify the perturbed flux sets bit by bit).
+# - map: one hourly map per chunk, for the perturbation and the quick-look plots that read whole maps
+# - timeseries: a month of hours for blocks of 10x10 cells, for sampling the fluxes at stations
+# - balanced: a day of hours for blocks of 50x50 cells, for both access patterns
+STORAGE_PROFILES = {
+    'map': {'chunks': {'time': 1}, 'complevel': 1, 'shuffle': True, 'significant_digits': None},
+    'timeseries': {'chunks': {'time': 744, 'latitude': 10, 'longitude': 10}, 'complevel': 4, 'shuffle': True, 'significant_digits': None},
+    'balanced': {'chunks': {'time': 24, 'latitude': 50, 'longitude': 50}, 'complevel': 2, 'shuffle': True, 'significant_digits': None},
+}
+
+def iter_time_chunks(ntime, chunk_size=CHUNK_SIZE):
+    """ Function to split a time axis into consecutive chunks of bounded length
+    Input:
+        ntime: int: length of the time axis
+        chunk_size: int: maximum number of time steps per chunk
+    Returns:
+        generator of slice objects covering range(ntime) in order """
+    for start in range(0, ntime, chunk_size):
+        yield slice(start, min(start + chunk_size, ntime))
+
+def window_slices(window):
+    """ Function to convert a window of the domain to index slices
+    Input:
+        window: tuple: (row_start, row_stop, col_start, col_stop)
+    Returns:
+        tuple: (slice of latitude indices, slice of longitude indices) """
+    return slice(window[0], window[1]), slice(window[2], window[3])
+
+def is_field(var):
+    """ Function to check whether a netCDF variable is a (time, latitude, longitude) flux field
+    Input:
+        var: nc.Variable: variable to check
+    Returns:
+        bool: True if the variable is a time-dependent 3D field """
+    return var.ndim == 3 and var.dimensions[0] == 'time'
+
+def get_storage_options(dimensions, sizes, profile):
+    """ Function to get the storage options of a flux field for nc.Dataset.createVariable()
+    Input:
+        dimensions: tuple: names of the dimensions of the variable
+        sizes: dict: length of each dimension (None for an unlimited dimension)
+        profile: str or dict: name of a profile in STORAGE_PROFILES, or a profile with the same keys
+    Returns:
+        dict: keyword arguments of createVariable() (zlib, complevel, shuffle, chunksizes and significant_digits) """
+    if isinstance(profile, str):
+        profile = STORAGE_PROFILES[profile]
+    chunksizes = []
+    for dim in dimensions:
+        size = sizes[dim]
+        chunk = profile['chunks'].get(dim, size if size else CHUNK_SIZE)
+        chunksizes.append(min(chunk, size) if size else chunk)
+    options = {'zlib': profile['complevel'] > 0, 'complevel': profile['complevel'], 'shuffle': profile['shuffle'], 'chunksizes': chunksizes}
+    if profile.get('significant_digits') is not None:
+        options['significant_digits'] = profile['significant_digits']
+    return options
+
+def set_chunk_cache(var, size=CHUNK_CACHE_SIZE):
+    """ Function to size the chunk cache of a chunked variable to the chunks of one chunk length along the first
+    (time) dimension, at most size bytes. Streams in time chunks that are aligned with the chunks of the variable
+    (see get_stream_chunk_size()) read and write every chunk whole and do not need more.
+    Input:
+        var: nc.Variable: chunked variable
+        size: int: maximum size of the cache in bytes """
+    chunksizes = var.chunking()
+    if chunksizes in (None, 'contiguous'):
+        return
+    nchunks = 1
+    for length, chunk in zip(var.shape[1:], chunksizes[1:]):
+        nchunks *= -(-length // chunk)
+    nbytes = nchunks * var.dtype.itemsize
+    for chunk in chunksizes:
+        nbytes *= chunk
+    var.set_var_chunk_cache(size=min(nbytes, size), nelems=max(2 * nchunks + 1, 1009))
+
+def set_chunk_caches(ds, size=CHUNK_CACHE_SIZE):
+    """ Function to size the chunk caches of all flux fields of a dataset with set_chunk_cache(), e.g. of a file
+    that is streamed once in time chunks (NETCDF3 and contiguous variables have no chunk cache)
+    Input:
+        ds: nc.Dataset: open dataset
+        size: int: maximum size of the cache of each flux field in bytes """
+    for var in ds.variables.values():
+        if is_field(var):
+            set_chunk_cache(var, size)
+
+def get_stream_chunk_size(variables, chunk_size=CHUNK_SIZE):
+    """ Function to get the number of time steps to stream at once, so that every read and write covers whole
+    chunks of the variables along the time dimension: chunk_size rounded up to a multiple of their longest chunk
+    length. Time chunks that cut through the chunks of a compressed variable (e.g. days of the month-long chunks of
+    the 'timeseries' profile) make the netCDF library decompress and recompress every chunk once per time chunk.
+    Input:
+        variables: list: nc.Variable flux fields that are read or written
+        chunk_size: int: minimum number of time steps per chunk
+    Returns:
+        int: number of time steps per chunk """
+    length = max([var.chunking()[0] for var in variables if var.chunking() not in (None, 'contiguous')], default=1)
+    return -(-chunk_size // length) * length
+
+def get_source_storage(var):
+    """ Function to get the storage options of an existing NETCDF4 variable, to create a copy with the same storage
+    Input:
+        var: nc.Variable: variable to copy the storage of
+    Returns:
+        dict: keyword arguments of createVariable(), empty for contiguous or NETCDF3 variables """
+    if not var.group().data_model.startswith('NETCDF4') or var.chunking() == 'contiguous':
+        return {}
+    filters = var.filters()
+    options = {'zlib': filters.get('zlib', False), 'complevel': filters.get('complevel', 0), 'shuffle': filters.get('shuffle', False),
+               'chunksizes': var.chunking()}
+    if filters.get('significant_digits') is not None:
+        options['significant_digits'] = filters['significant_digits']
+    return options
+
+def create_like(src, path, variables=None, profile=None):
+    """ Function to create an empty netCDF file with the same dimensions, variables and attributes as
+    a source dataset, without copying any of the data
+    Input:
+        src: nc.Dataset: dataset to copy the file structure from
+        path: str: path of the new file
+        variables: list: names of the variables to create (default: all variables of src)
+        profile: str or dict: storage profile of the flux fields (see STORAGE_PROFILES), written as NETCDF4
+            (default: the storage of the flux fields of src)
+    Returns:
+        nc.Dataset: the new dataset, opened in write mode """
+    dst = nc.Dataset(path, 'w', format=src.data_model if profile is None else 'NETCDF4')
+    dst.setncatts({name: src.getncattr(name) for name in src.ncattrs()})
+
+    sizes = {}
+    for name, dim in src.dimensions.items():
+        sizes[name] = None if dim.isunlimited() else len(dim)
+        dst.createDimension(name, sizes[name])
+
+    for name, var in src.variables.items():
+        if variables is not None and name not in variables:
+            continue
+        attrs = {key: var.getncattr(key) for key in var.ncattrs() if key != '_FillValue'}
+        fill_value = var.getncattr('_FillValue') if '_FillValue' in var.ncattrs() else None
+        options = {}
+        if is_field(var):
+            options = get_source_storage(var) if profile is None else get_storage_options(var.dimensions, sizes, profile)
+        new_var = dst.createVariable(name, var.dtype, var.dimensions, fill_value=fill_value, **options)
+        new_var.setncatts(attrs)
+        if is_field(new_var):
+            set_chunk_cache(new_var)
+    return dst
+
+def create_from_cdl(cdlpath, path, profile=None):
+    """ Function to create an empty netCDF file from a CDL template (e.g. paris_input.cdl), with the flux fields
+    stored according to a storage profile
+    Input:
+        cdlpath: str: path to the CDL template
+        path: str: path of the new file
+        profile: str or dict: storage profile of the flux fields (see STORAGE_PROFILES, default: netCDF defaults)
+    Returns:
+        nc.Dataset: the new dataset, opened in append mode """
+    if profile is None:
+        return nc.Dataset.fromcdl(cdlfilename=cdlpath, mode='a', ncfilename=path)
+    # THE TEMPLATE IS FIRST WRITTEN WITH DEFAULT STORAGE BY ncgen, AND ITS STRUCTURE THEN COPIED WITH THE PROFILE
+    tmp_path = path + '.cdl.nc'
+    with nc.Dataset.fromcdl(cdlfilename=cdlpath, mode='r', ncfilename=tmp_path) as template:
+        create_like(template, path, profile=profile).close()
+    os.remove(tmp_path)
+    return nc.Dataset(path, 'a')
+
+def copy_static_variables(src, dst):
+    """ Function to copy all variables that are not time-dependent flux fields (time, latitude,
+    longitude, country names etc.) from one dataset to another. These are small and copied at once.
+    Input:
+        src: nc.Dataset: dataset to copy from
+        dst: nc.Dataset: dataset to copy to, created with create_like() """
+    for name, var in src.variables.items():
+        if name in dst.variables and not is_field(var):
+            dst.variables[name][:] = var[:]
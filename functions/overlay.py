@@ -0,0 +1,149 @@
+# This file contains functions to write and read perturbed flux sets in the overlay format. An
+# overlay file only stores the variables that an experiment changes, restricted to the window of the
+# experiment (the bounding box of its countries, or the full domain for experiments without a country,
+# see get_window() in functions/perturbation.py), together with a reference to the BASE flux set. The
+# full perturbed flux set is composed from the BASE file and the overlay when it is read.
+
+##############################################
+########## LOAD NECCESSARY PACKAGES ##########
+##############################################
+import os
+import netCDF4 as nc
+import numpy as np
+from Experiments.functions.ncio import CHUNK_SIZE, iter_time_chunks, is_field, create_like, copy_static_variables, get_storage_options, set_chunk_cache
+
+def create_overlay(base, path, base_path, experimentcode, variables, window, profile=None):
+    """ Function to create an empty overlay file for an experiment
+    Input:
+        base: nc.Dataset: the BASE flux set
+        path: str: path of the overlay file to create
+        base_path: str: path to the BASE flux set, stored in the overlay as a reference
+        experimentcode: str: name of the experiment
+        variables: list: names of the (time, latitude, longitude) variables that the experiment changes
+        window: tuple: (row_start, row_stop, col_start, col_stop) of the part of the domain to store, from get_window()
+            in functions/perturbation.py
+        profile: str or dict: storage profile of the changed variables (see STORAGE_PROFILES in functions/ncio.py,
+            default: netCDF defaults)
+    Returns:
+        nc.Dataset: the overlay dataset, opened in write mode, with the time axis already filled in """
+    row_start, row_stop, col_start, col_stop = window
+    overlay = nc.Dataset(path, 'w', format='NETCDF4')
+    overlay.setncatts({name: base.getncattr(name) for name in base.ncattrs()})
+    overlay.base_file = os.path.abspath(base_path)
+    overlay.experiment = experimentcode
+    overlay.overlay_window = np.array(window, dtype='i4')
+    overlay.overlay_comment = 'Only the variables changed by the experiment are stored, for latitude indices ' + \
+        str(row_start) + ' to ' + str(row_stop) + ' and longitude indices ' + str(col_start) + ' to ' + str(col_stop) + \
+        ' of the BASE flux set. All other values are equal to those of the BASE flux set.'
+
+    overlay.createDimension('time', None)
+    overlay.createDimension('latitude', row_stop - row_start)
+    overlay.createDimension('longitude', col_stop - col_start)
+    sizes = {'time': None, 'latitude': row_stop - row_start, 'longitude': col_stop - col_start}
+    for name in ['time', 'latitude', 'longitude'] + list(variables):
+        var = base.variables[name]
+        attrs = {key: var.getncattr(key) for key in var.ncattrs() if key != '_FillValue'}
+        fill_value = var.getncattr('_FillValue') if '_FillValue' in var.ncattrs() else None
+        options = get_storage_options(var.dimensions, sizes, profile) if profile is not None and is_field(var) else {}
+        new_var = overlay.createVariable(name, var.dtype, var.dimensions, fill_value=fill_value, **options)
+        new_var.setncatts(attrs)
+        if is_field(new_var):
+            set_chunk_cache(new_var)
+
+    overlay.variables['time'][:] = base.variables['time'][:]
+    overlay.variables['latitude'][:] = base.variables['latitude'][row_start:row_stop]
+    overlay.variables['longitude'][:] = base.variables['longitude'][col_start:col_stop]
+    return overlay
+
+def get_overlay_window(overlay):
+    """ Function to get the window of the BASE domain that is stored in an overlay file
+    Input:
+        overlay: nc.Dataset: the overlay file
+    Returns:
+        tuple: (slice of latitude indices, slice of longitude indices) """
+    row_start, row_stop, col_start, col_stop = [int(i) for i in overlay.overlay_window]
+    return slice(row_start, row_stop), slice(col_start, col_stop)
+
+def open_overlay(overlay_path, base_path=None):
+    """ Function to open an overlay file together with the BASE flux set it refers to
+    Input:
+        overlay_path: str: path to the overlay file
+        base_path: str: path to the BASE flux set (default: the path stored in the overlay file)
+    Returns:
+        tuple: (BASE nc.Dataset, overlay nc.Dataset), both opened read-only """
+    overlay = nc.Dataset(overlay_path, 'r')
+    base = nc.Dataset(base_path if base_path is not None else overlay.base_file, 'r')
+    base.set_auto_mask(False)
+    overlay.set_auto_mask(False)
+    return base, overlay
+
+def compose_chunk(base, overlay, name, t=slice(None)):
+    """ Function to read a time chunk of a variable of the perturbed flux set, composed from the BASE
+    flux set and the overlay
+    Input:
+        base: nc.Dataset: the BASE flux set
+        overlay: nc.Dataset: the overlay file
+        name: str: name of the variable
+        t: slice: time steps to read
+    Returns:
+        np.ndarray: (time, latitude, longitude) chunk of the perturbed variable """
+    values = np.array(base.variables[name][t])
+    if name in overlay.variables and is_field(overlay.variables[name]):
+        rows, cols = get_overlay_window(overlay)
+        values[:, rows, cols] = overlay.variables[name][t]
+    return values
+
+def read_overlay(overlay_path, name, t=slice(None), base_path=None):
+    """ Function to read (part of) a variable of a perturbed flux set stored as an overlay
+    Input:
+        overlay_path: str: path to the overlay file
+        name: str: name of the variable
+        t: slice: time steps to read (default: all)
+        base_path: str: path to the BASE flux set (default: the path stored in the overlay file)
+    Returns:
+        np.ndarray: (time, latitude, longitude) array of the perturbed variable """
+    base, overlay = open_overlay(overlay_path, base_path)
+    try:
+        return compose_chunk(base, overlay, name, t)
+    finally:
+        base.close()
+        overlay.close()
+
+def open_flux_set(path):
+    """ Function to open a flux set for reading, composing an overlay file with its BASE flux set
+    Input:
+        path: str: path to the flux set or overlay file
+    Returns:
+        tuple: (nc.Dataset with the full layout, function(name, t) returning a time chunk of a variable,
+        list of the datasets to close) """
+    with nc.Dataset(path, 'r') as src:
+        is_overlay = 'base_file' in src.ncattrs()
+    if is_overlay:
+        base, overlay = open_overlay(path)
+        return base, lambda name, t: compose_chunk(base, overlay, name, t), [base, overlay]
+    src = nc.Dataset(path, 'r')
+    src.set_auto_mask(False)
+    return src, lambda name, t: src.variables[name][t], [src]
+
+def materialize_overlay(overlay_path, out_path, chunk_size=CHUNK_SIZE, base_path=None, profile=None):
+    """ Function to write the full perturbed flux set of an overlay to a regular netCDF file with the
+    same layout as the BASE flux set. Both files are streamed in bounded time chunks.
+    Input:
+        overlay_path: str: path to the overlay file
+        out_path: str: path of the full flux set to create
+        chunk_size: int: number of time steps read at once
+        base_path: str: path to the BASE flux set (default: the path stored in the overlay file)
+        profile: str or dict: storage profile of the flux fields (default: the storage of the BASE flux set) """
+    base, overlay = open_overlay(overlay_path, base_path)
+    try:
+        with create_like(base, out_path, profile=profile) as out:
+            out.set_auto_mask(False)
+            copy_static_variables(base, out)
+            fields = [name for name, var in base.variables.items() if is_field(var)]
+            for t in iter_time_chunks(len(base.dimensions['time']), chunk_size):
+                print('Working on ... ' + out_path + ', time steps ' + str(t.start) + ' to ' + str(t.stop))
+                for name in fields:
+                    out.variables[name][t] = compose_chunk(base, overlay, name, t)
+    finally:
+        base.close()
+        overlay.close()
@@ -0,0 +1,264 @@
+# This file contains the engine that creates the perturbed flux sets of the PARIS verification
+# games from the BASE flux set. The BASE file is streamed in bounded time chunks, and the chunk
+# caches of the flux fields of the BASE and output files are kept small (see set_chunk_cache() in
+# functions/ncio.py), so the memory use does not depend on the length of the time axis.
+
+##############################################
+########## LOAD NECCESSARY PACKAGES ##########
+##############################################
+import netCDF4 as nc
+import numpy as np
+from Experiments.functions.funs import get_lu
+from Experiments.functions.experiments import EXPERIMENTS, TOTALS, dependent_totals
+from Experiments.functions.masks import MASK_PATH, load_country_mask, load_country_bbox
+from Experiments.functions.ncio import CHUNK_SIZE, iter_time_chunks, window_slices, is_field, create_like, copy_static_variables, set_chunk_caches, get_stream_chunk_size
+from Experiments.functions.overlay import create_overlay
+from Experiments.functions.quantiles import streaming_percentile, get_threshold_chunk
+from Experiments.functions.totals import take_cells, put_cells, update_totals, check_totals as check_resum
+from Experiments.functions.instrument import stage, record_io
+
+# Scale fields that change less than this fraction of the cells of their window are only applied to the changed cells
+SPARSE_FRACTION = 0.5
+
+def get_window(experiment, var, mask_path=MASK_PATH):
+    """ Function to find the part of the domain that an experiment reads, perturbs and (as overlay) writes: the
+    bounding box of the cells with a non-zero fraction of the country (or of the union of the countries, if the
+    experiment lists several) for country-restricted experiments, and the full domain otherwise. The window is
+    not shrunk to the cells that actually change: cells in it can keep their BASE values, e.g. where the
+    land-use filter or the percentile threshold excludes them or where the flux is zero.
+    Input:
+        experiment: dict: experiment definition from EXPERIMENTS
+        var: nc.Variable: the perturbed variable of the BASE file (only its shape is used)
+        mask_path: str: path to the fractional country mask file
+    Returns:
+        tuple: (row_start, row_stop, col_start, col_stop) """
+    if experiment.get('country'):
+        return load_country_bbox(experiment['country'], mask_path)
+    return (0, var.shape[1], 0, var.shape[2])
+
+def build_scale(experiment, var, window, mask_path=MASK_PATH):
+    """ Function to build the multiplicative scale field of an experiment within its window. Cells outside
+    the country mask or land-use filter keep a scale of 1, fractional mask cells are scaled proportionally.
+    Input:
+        experiment: dict: experiment definition from EXPERIMENTS
+        var: nc.Variable: the perturbed variable of the BASE file (only its shape is used)
+        window: tuple: (row_start, row_stop, col_start, col_stop) from get_window()
+        mask_path: str: path to the fractional country mask file
+    Returns:
+        np.ndarray: 2D (latitude, longitude) array of scale factors for the cells of the window """
+    rows, cols = window_slices(window)
+    weight = np.ones((window[1] - window[0], window[3] - window[2]))
+    if experiment.get('country'):
+        weight = weight * load_country_mask(experiment['country'], mask_path, window)
+    if experiment.get('landuse'):
+        lu = get_lu(var)[rows, cols]
+        weight[~np.isin(lu, experiment['landuse'])] = 0
+    return 1.0 + (experiment['factor'] - 1.0) * weight
+
+def perturb_chunk(chunk, scale, threshold=None):
+    """ Function to apply the scale field of an experiment to a chunk of data
+    Input:
+        chunk: np.ndarray: (time, latitude, longitude) chunk of the perturbed variable
+        scale: np.ndarray: 2D scale field from build_scale()
+        threshold: float or np.ndarray: if given, only values above this threshold (broadcast against the
+            chunk) are scaled
+    Returns:
+        np.ndarray: perturbed chunk """
+    if threshold is None:
+        return chunk * scale
+    return np.where(chunk > threshold, chunk * scale, chunk)
+
+def get_cells(scale):
+    """ Function to find the grid cells that a scale field changes
+    Input:
+        scale: np.ndarray: 2D scale field from build_scale()
+    Returns:
+        tuple: (flat indices of the changed cells, scale factors of these cells), or None if the
+        changed cells are not sparse enough (see SPARSE_FRACTION) to be worth indexing """
+    cells = np.flatnonzero(scale != 1)
+    if cells.size >= SPARSE_FRACTION * scale.size:
+        return None
+    return cells, scale.ravel()[cells]
+
+def setup_experiment(experimentcode, base, chunk_size=CHUNK_SIZE, mask_path=MASK_PATH, check_totals=False, experiment=None):
+    """ Function to prepare everything that is needed to perturb the chunks of the BASE file for an experiment
+    Input:
+        experimentcode: str: name of the experiment in EXPERIMENTS
+        base: nc.Dataset: the BASE flux set
+        chunk_size: int: number of time steps read at once (used for the percentile passes)
+        mask_path: str: path to the fractional country mask file
+        check_totals: bool: if True, also read all variables the totals are made of, to check the
+            delta-updated totals against a full re-sum
+        experiment: dict: experiment definition with the keys of EXPERIMENTS (default: EXPERIMENTS[experimentcode])
+    Returns:
+        dict: the perturbed variable, the totals that depend on it, the variables that have to be read,
+        the window of the domain that can change, the scale field within that window, the changed cells
+        within the window (if sparse) and the (optional) percentile thresholds """
+    experiment = experiment if experiment is not None else EXPERIMENTS[experimentcode]
+    variable = experiment['variable']
+    totals = dependent_totals(variable)
+
+    thresholds = None
+    if experiment.get('percentile') is not None:
+        thresholds = streaming_percentile(base.variables[variable], experiment['percentile'],
+                                          groupby=experiment.get('percentile_groupby', 'global'),
+                                          method=experiment.get('percentile_method', 'exact'),
+                                          chunk_size=chunk_size, time_var=base.variables['time'], mask_path=mask_path)
+
+    needed = {variable}.union(totals)
+    if check_totals:
+        needed = needed.union(*[TOTALS[total] for total in totals])
+
+    window = get_window(experiment, base.variables[variable], mask_path)
+    scale = build_scale(experiment, base.variables[variable], window, mask_path)
+    return {
+        'variable': variable,
+        'totals': totals,
+        'needed': needed,
+        'check_totals': check_totals,
+        'scale': scale,
+        'cells': get_cells(scale) if thresholds is None else None,
+        'thresholds': thresholds,
+        'window': window,
+    }
+
+def apply_experiment(setup, data, t):
+    """ Function to perturb a chunk of the BASE file and update the totals that depend on the perturbed
+    variable by the change of that variable, within the window of the experiment
+    Input:
+        setup: dict: experiment setup from setup_experiment()
+        data: dict: (time, latitude, longitude) chunks of (at least) the variables in setup['needed'],
+            restricted to the window setup['window']
+        t: slice: time steps of the chunk
+    Returns:
+        dict: perturbed chunks of the perturbed variable and of its totals within the window """
+    variable = setup['variable']
+    if setup['cells'] is not None:
+        # ONLY THE CHANGED CELLS ARE SCALED, BROADCAST OVER ALL TIME STEPS OF THE CHUNK AT ONCE
+        cells, scale = setup['cells']
+        values = take_cells(data[variable], cells)
+        perturbed = values * scale
+        result = {variable: put_cells(data[variable], cells, perturbed)}
+        with stage('update_totals', variable):
+            update_totals(setup['totals'], data, result, {variable: perturbed - values}, cells)
+    else:
+        threshold = None
+        if setup['thresholds'] is not None:
+            threshold = get_threshold_chunk(setup['thresholds'], t, setup['window'])
+        result = {variable: perturb_chunk(data[variable], setup['scale'], threshold)}
+        with stage('update_totals', variable):
+            update_totals(setup['totals'], data, result, {variable: result[variable] - data[variable]})
+    if setup['check_totals']:
+        with stage('check_totals', variable):
+            check_resum(setup['totals'], data, result)
+    return result
+
+def perturb_experiments(base_path, out_paths, chunk_size=CHUNK_SIZE, mask_path=MASK_PATH, overlay=False, check_totals=False, profile=None):
+    """ Function to create the perturbed flux sets of several experiments in a single pass over the
+    BASE flux set. Each time chunk of each variable of the BASE file is read once and written to the
+    output file of every experiment, perturbed where needed. Totals that depend on a perturbed variable
+    (e.g. combustion, flux_ff_exchange_prior) are updated by the change of that variable, so the other
+    sectors of these totals do not have to be read. Each experiment only adds the (small) chunk caches of
+    its output file and its perturbed chunks to the memory use.
+    Input:
+        base_path: str: path to the BASE flux set
+        out_paths: dict: path of the perturbed flux set to create for each experiment name in EXPERIMENTS
+        chunk_size: int: number of time steps read at once (rounded up to whole chunks of the flux fields of the
+            BASE and output files along the time dimension, see get_stream_chunk_size() in functions/ncio.py)
+        mask_path: str: path to the fractional country mask file
+        overlay: bool: if True, write overlay files (see functions/overlay.py) that only contain the
+            changed variables within the window of the experiment (see get_window()), instead of full copies
+            of the BASE file
+        check_totals: bool: if True, check the updated totals against a full re-sum of their sectors
+        profile: str or dict: storage profile of the flux fields (see STORAGE_PROFILES in functions/ncio.py,
+            default: the storage of the BASE flux set) """
+    with nc.Dataset(base_path, 'r') as base:
+        base.set_auto_mask(False)
+        # EVERY CHUNK OF THE BASE FILE IS READ ONCE, SO ITS FIELDS ONLY NEED SMALL CHUNK CACHES
+        set_chunk_caches(base)
+        fields = [name for name, var in base.variables.items() if is_field(var)]
+        chunk_size = get_stream_chunk_size([base.variables[name] for name in fields], chunk_size)
+        setups = {}
+        for code in out_paths:
+            with stage('setup', code):
+                setups[code] = setup_experiment(code, base, chunk_size, mask_path, check_totals)
+        needed = set().union(*[setup['needed'] for setup in setups.values()])
+
+        outs = {}
+        try:
+            for code, out_path in out_paths.items():
+                if overlay:
+                    changed = [setups[code]['variable']] + setups[code]['totals']
+                    outs[code] = create_overlay(base, out_path, base_path, code, changed, setups[code]['window'], profile)
+                else:
+                    outs[code] = create_like(base, out_path, profile=profile)
+                    copy_static_variables(base, outs[code])
+                outs[code].set_auto_mask(False)
+            chunk_size = get_stream_chunk_size([var for out in outs.values() for var in out.variables.values() if is_field(var)], chunk_size)
+
+            for t in iter_time_chunks(len(base.dimensions['time']), chunk_size):
+                print('Working on ... ' + ', '.join(out_paths) + ', time steps ' + str(t.start) + ' to ' + str(t.stop))
+
+                if overlay:
+                    # ONLY READ, PERTURB AND WRITE THE WINDOW OF EACH EXPERIMENT
+                    window_data = {}
+                    for code, setup in setups.items():
+                        rows, cols = window_slices(setup['window'])
+                        data = {}
+                        for name in setup['needed']:
+                            if (name, setup['window']) not in window_data:
+                                with stage('read', name):
+                                    window_data[(name, setup['window'])] = base.variables[name][t, rows, cols]
+                                record_io(base_path, 'read', window_data[(name, setup['window'])].nbytes)
+                            data[name] = window_data[(name, setup['window'])]
+                        with stage('perturb', code):
+                            result = apply_experiment(setup, data, t)
+                        for name, values in result.items():
+                            with stage('write', name):
+                                outs[code].variables[name][t] = values
+                            record_io(out_paths[code], 'write', values.nbytes)
+                    continue
+
+                data = {}
+                for name in fields:
+                    with stage('read', name):
+                        values = base.variables[name][t]
+                    record_io(base_path, 'read', values.nbytes)
+                    if name in needed:
+                        data[name] = values
+                    else:
+                        for code, out in outs.items():
+                            with stage('write', name):
+                                out.variables[name][t] = values
+                            record_io(out_paths[code], 'write', values.nbytes)
+
+                # PERTURB THE VARIABLES WITHIN THE WINDOW OF EACH EXPERIMENT AND UPDATE THE TOTALS THAT DEPEND ON THEM
+                for code, setup in setups.items():
+                    rows, cols = window_slices(setup['window'])
+                    with stage('perturb', code):
+                        result = apply_experiment(setup, {name: data[name][:, rows, cols] for name in setup['needed']}, t)
+                    for name in needed:
+                        values = data[name]
+                        if name in result:
+                            values = values.copy()
+                            values[:, rows, cols] = result[name]
+                        with stage('write', name):
+                            outs[code].variables[name][t] = values
+                        record_io(out_paths[code], 'write', values.nbytes)
+        finally:
+            for out in outs.values():
+                out.close()
+
+def perturb_experiment(base_path, out_path, experimentcode, chunk_size=CHUNK_SIZE, mask_path=MASK_PATH, overlay=False, check_totals=False, profile=None):
+    """ Function to create the perturbed flux set of a single experiment from the BASE flux set, see
+    perturb_experiments()
+    Input:
+        base_path: str: path to the BASE flux set
+        out_path: str: path of the perturbed flux set to create
+        experimentcode: str: name of the experiment in EXPERIMENTS
+        chunk_size: int: number of time steps read at once
+        mask_path: str: path to the fractional country mask file
+        overlay: bool: if True, write an overlay file instead of a full copy of the BASE file
+        check_totals: bool: if True, check the updated totals against a full re-sum of their sectors
+        profile: str or dict: storage profile of the flux fields (default: the storage of the BASE flux set) """
+    perturb_experiments(base_path, {experimentcode: out_path}, chunk_size, mask_path, overlay, check_totals, profile)
@@ -0,0 +1,237 @@
+# This file contains functions to calculate percentiles of (time, latitude, longitude) variables
+# over a stream of time chunks, without holding the variable in memory. Values are binned on the
+# high bits of their float32 representation, which gives bins with a fixed relative width that do
+# not depend on the range of the data:
+#   - 'exact': two passes, a histogram of bin counts and a pass that only collects the values in
+#     the bins that contain the requested ranks. Gives the same result as np.percentile, also in
+#     the last bits: the two values at the requested ranks are interpolated in float32, as by
+#     np.percentile for float32 data.
+#   - 'sketch': one pass, interpolates within the histogram bins. The relative error is below
+#     2**-(NBITS - 9) and the memory use is fixed (NBINS counts per group).
+
+##############################################
+########## LOAD NECCESSARY PACKAGES ##########
+##############################################
+import netCDF4 as nc
+import numpy as np
+from Experiments.functions.masks import MASK_PATH, load_country_index
+from Experiments.functions.ncio import CHUNK_SIZE, iter_time_chunks
+
+# Number of high bits of the float32 representation used as histogram bin (sign, 8 exponent bits, 7 mantissa bits)
+NBITS = 16
+NBINS = 2 ** NBITS
+
+def float_keys(values):
+    """ Function to map float32 values to unsigned integer keys with the same order
+    Input:
+        values: np.ndarray: values to map, converted to float32
+    Returns:
+        np.ndarray: uint32 keys """
+    bits = np.ascontiguousarray(values, dtype=np.float32).view(np.uint32)
+    return np.where(bits & np.uint32(0x80000000), ~bits, bits | np.uint32(0x80000000))
+
+def key_values(keys):
+    """ Function to map keys from float_keys() back to float32 values
+    Input:
+        keys: np.ndarray: uint32 keys
+    Returns:
+        np.ndarray: float32 values """
+    keys = np.asarray(keys, dtype=np.uint32)
+    bits = np.where(keys & np.uint32(0x80000000), keys & np.uint32(0x7fffffff), ~keys)
+    return bits.view(np.float32)
+
+def get_month_labels(time_var):
+    """ Function to assign each time step of a time variable to its calendar month
+    Input:
+        time_var: nc.Variable: time variable with CF units and calendar attributes
+    Returns:
+        tuple: (np.ndarray with the month group of each time step, number of months) """
+    dates = nc.num2date(time_var[:], time_var.units, getattr(time_var, 'calendar', 'standard'))
+    months = np.array([date.year * 12 + date.month - 1 for date in dates])
+    _, labels = np.unique(months, return_inverse=True)
+    return labels, labels.max() + 1
+
+def iter_groups(var, time_labels, cell_labels, ncellgroups, nonzero, chunk_size):
+    """ Function to stream the valid values of a variable together with their group
+    Input:
+        var: nc.Variable: (time, latitude, longitude) variable
+        time_labels: np.ndarray: group of each time step
+        cell_labels: np.ndarray: 2D group of each grid cell (-1 to exclude a cell), or None
+        ncellgroups: int: number of cell groups
+        nonzero: bool: if True, zero values are excluded
+        chunk_size: int: number of time steps read at once
+    Returns:
+        generator of (group, value) arrays per time chunk """
+    for t in iter_time_chunks(len(var), chunk_size):
+        chunk = np.asarray(var[t], dtype=np.float32)
+        groups = time_labels[t][:, None, None] * ncellgroups
+        if cell_labels is not None:
+            groups = groups + cell_labels[None, :, :]
+        groups = np.broadcast_to(groups, chunk.shape)
+        valid = ~np.isnan(chunk)
+        if nonzero:
+            valid &= chunk != 0
+        if cell_labels is not None:
+            valid &= np.broadcast_to(cell_labels >= 0, chunk.shape)
+        yield groups[valid], chunk[valid]
+
+def histogram(var, time_labels, cell_labels, ngroups, ncellgroups, nonzero=True, chunk_size=CHUNK_SIZE):
+    """ Function to count the values of a variable per group and per float32 bin in one pass
+    Input:
+        see iter_groups(), ngroups is the total number of groups
+    Returns:
+        np.ndarray: (ngroups, NBINS) counts. Histograms of different records can be added. """
+    counts = np.zeros(ngroups * NBINS, dtype=np.int64)
+    for groups, values in iter_groups(var, time_labels, cell_labels, ncellgroups, nonzero, chunk_size):
+        bins = (float_keys(values) >> np.uint32(32 - NBITS)).astype(np.int64)
+        counts += np.bincount(groups * NBINS + bins, minlength=ngroups * NBINS)
+    return counts.reshape(ngroups, NBINS)
+
+def get_ranks(counts, q):
+    """ Function to find the ranks that np.percentile (linear interpolation) uses for each group
+    Input:
+        counts: np.ndarray: (ngroups, NBINS) histogram
+        q: float: percentile (0-100)
+    Returns:
+        tuple: (lower rank, upper rank, interpolation weight, number of values) per group """
+    n = counts.sum(axis=1)
+    position = (q / 100.) * (np.maximum(n, 1) - 1)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, np.maximum(n, 1) - 1)
+    return lower, upper, position - lower, n
+
+def interpolate(lower, upper, weight):
+    """ Function to interpolate linearly between two values in the same way as np.percentile, in the
+    precision of the values (the weight is a Python float, so that float32 values stay float32)
+    Input:
+        lower: float: value at the lower rank
+        upper: float: value at the upper rank
+        weight: float: interpolation weight (0-1)
+    Returns:
+        float: interpolated value """
+    weight = float(weight)
+    if weight >= 0.5:
+        return upper - (upper - lower) * (1 - weight)
+    return lower + (upper - lower) * weight
+
+def sketch_percentile(counts, q):
+    """ Function to estimate percentiles from a histogram, interpolating within the bins
+    Input:
+        counts: np.ndarray: (ngroups, NBINS) histogram from histogram()
+        q: float: percentile (0-100)
+    Returns:
+        np.ndarray: estimated percentile per group (NaN for groups without values) """
+    lower, upper, weight, n = get_ranks(counts, q)
+    cumulative = np.cumsum(counts, axis=1)
+    result = np.full(len(counts), np.nan)
+    for group in np.flatnonzero(n):
+        estimates = []
+        for rank in (lower[group], upper[group]):
+            b = np.searchsorted(cumulative[group], rank, side='right')
+            before = cumulative[group][b - 1] if b > 0 else 0
+            fraction = (rank - before + 0.5) / counts[group, b]
+            low = np.float64(key_values(np.uint32(b) << np.uint32(32 - NBITS)))
+            high = np.float64(key_values(((np.uint32(b) + np.uint32(1)) << np.uint32(32 - NBITS)) - np.uint32(1)))
+            estimates.append(low + fraction * (high - low))
+        result[group] = interpolate(estimates[0], estimates[1], weight[group])
+    return result
+
+def exact_percentile(var, counts, q, time_labels, cell_labels, ncellgroups, nonzero=True, chunk_size=CHUNK_SIZE):
+    """ Function to calculate exact percentiles in a second pass, collecting only the values in the
+    histogram bins that contain the requested ranks
+    Input:
+        var: nc.Variable: (time, latitude, longitude) variable
+        counts: np.ndarray: (ngroups, NBINS) histogram from histogram()
+        q: float: percentile (0-100)
+        other arguments: see iter_groups()
+    Returns:
+        np.ndarray: percentile per group (NaN for groups without values) """
+    lower, upper, weight, n = get_ranks(counts, q)
+    cumulative = np.cumsum(counts, axis=1)
+    lower_bin = np.array([np.searchsorted(c, r, side='right') for c, r in zip(cumulative, lower)])
+    upper_bin = np.array([np.searchsorted(c, r, side='right') for c, r in zip(cumulative, upper)])
+    groups = np.flatnonzero(n)
+    targets = np.unique(np.concatenate([groups * NBINS + lower_bin[groups], groups * NBINS + upper_bin[groups]]))
+
+    collected_ids, collected_values = [], []
+    for chunk_groups, values in iter_groups(var, time_labels, cell_labels, ncellgroups, nonzero, chunk_size):
+        ids = chunk_groups * NBINS + (float_keys(values) >> np.uint32(32 - NBITS)).astype(np.int64)
+        keep = np.isin(ids, targets)
+        collected_ids.append(ids[keep])
+        collected_values.append(values[keep])
+    collected_ids = np.concatenate(collected_ids)
+    collected_values = np.concatenate(collected_values)
+
+    result = np.full(len(counts), np.nan)
+    for group in groups:
+        selected = []
+        for rank, b in ((lower[group], lower_bin[group]), (upper[group], upper_bin[group])):
+            before = cumulative[group][b - 1] if b > 0 else 0
+            in_bin = collected_values[collected_ids == group * NBINS + b]
+            selected.append(np.partition(in_bin, rank - before)[rank - before])
+        result[group] = interpolate(selected[0], selected[1], weight[group])
+    return result
+
+def streaming_percentile(var, q, groupby='global', method='exact', nonzero=True, chunk_size=CHUNK_SIZE, time_var=None, mask_path=MASK_PATH):
+    """ Function to calculate a percentile of a (time, latitude, longitude) variable over a stream of
+    time chunks, globally or per group of time steps or grid cells
+    Input:
+        var: nc.Variable: (time, latitude, longitude) variable, float32 data
+        q: float: percentile (0-100)
+        groupby: str: 'global', 'timestep', 'month' or 'country' (dominant country of each grid cell)
+        method: str: 'exact' (two passes) or 'sketch' (one pass, bounded relative error)
+        nonzero: bool: if True, only non-zero values are used (as for the PTEN top-emitter threshold)
+        chunk_size: int: number of time steps read at once
+        time_var: nc.Variable: time variable, needed for groupby='month'
+        mask_path: str: path to the fractional country mask file, needed for groupby='country'
+    Returns:
+        dict: 'values' with the percentile per group, 'time_labels' with the group of each time step and
+        'cell_labels' with the group of each grid cell (or None), see get_threshold_chunk() """
+    if groupby == 'timestep':
+        # EVERY TIME STEP IS A GROUP: THE VALUES OF ONE TIME STEP ALWAYS FIT IN MEMORY
+        values = np.full(len(var), np.nan)
+        for t in iter_time_chunks(len(var), chunk_size):
+            chunk = np.asarray(var[t], dtype=np.float32)
+            for i, field in enumerate(chunk):
+                valid = field[~np.isnan(field) & ((field != 0) | (not nonzero))]
+                if valid.size:
+                    values[t.start + i] = np.percentile(valid, q)
+        return {'values': values, 'time_labels': np.arange(len(var)), 'cell_labels': None}
+
+    time_labels, ntimegroups = np.zeros(len(var), dtype=int), 1
+    cell_labels, ncellgroups = None, 1
+    if groupby == 'month':
+        time_labels, ntimegroups = get_month_labels(time_var)
+    elif groupby == 'country':
+        cell_labels, codes = load_country_index(mask_path)
+        ncellgroups = len(codes)
+
+    ngroups = ntimegroups * ncellgroups
+    counts = histogram(var, time_labels, cell_labels, ngroups, ncellgroups, nonzero, chunk_size)
+    if method == 'sketch':
+        values = sketch_percentile(counts, q)
+    else:
+        values = exact_percentile(var, counts, q, time_labels, cell_labels, ncellgroups, nonzero, chunk_size)
+    return {'values': values.reshape(ntimegroups, ncellgroups), 'time_labels': time_labels, 'cell_labels': cell_labels}
+
+def get_threshold_chunk(thresholds, t, window=None):
+    """ Function to get the percentile thresholds that apply to a time chunk, in a shape that
+    broadcasts against the (time, latitude, longitude) chunk
+    Input:
+        thresholds: dict: result of streaming_percentile()
+        t: slice: time steps of the chunk
+        window: tuple: (row_start, row_stop, col_start, col_stop) of the chunk (default: full domain)
+    Returns:
+        np.ndarray: thresholds of the chunk """
+    values = thresholds['values']
+    if values.ndim == 1:
+        return values[t][:, None, None]
+    per_time = values[thresholds['time_labels'][t]]
+    if thresholds['cell_labels'] is None:
+        return per_time[:, 0][:, None, None]
+    cell_labels = thresholds['cell_labels']
+    if window is not None:
+        cell_labels = cell_labels[window[0]:window[1], window[2]:window[3]]
+    # CELLS WITHOUT A COUNTRY ARE NEVER ABOVE THE THRESHOLD
+    per_cell = np.where(cell_labels >= 0, per_time[:, np.maximum(cell_labels, 0)], np.inf)
+    return per_cell
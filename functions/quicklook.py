@@ -0,0 +1,191 @@
+# This file contains functions to render quick-look figures of a perturbed flux set: the BASE
+# field, the perturbed field and their difference for each hour. The figure and its images are
+# built once per worker and only their data is replaced for each frame, on the headless Agg
+# canvas. Ranges of frames are rendered in parallel in a process pool. The frames can also be
+# written as an animation, and the monthly mean differences as one tiled overview figure.
+
+##############################################
+########## LOAD NECCESSARY PACKAGES ##########
+##############################################
+import os
+from concurrent.futures import ProcessPoolExecutor
+import netCDF4 as nc
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.animation import FuncAnimation, PillowWriter
+from Experiments.functions.ncio import CHUNK_SIZE, iter_time_chunks
+from Experiments.functions.quantiles import get_month_labels
+
+def get_time_labels(time_var):
+    """ Function to get a printable date for each time step
+    Input:
+        time_var: nc.Variable: time variable with CF units
+    Returns:
+        list: date of each time step as a string """
+    dates = nc.num2date(time_var[:], time_var.units, getattr(time_var, 'calendar', 'standard'))
+    return [str(date) for date in dates]
+
+def build_figure(shape, side_by_side=True, cmap='Reds_r', limits=(None, None), diff_limits=(None, None)):
+    """ Function to build the quick-look figure once, with empty images that are filled per frame
+    Input:
+        shape: tuple: (latitude, longitude) shape of the fields
+        side_by_side: bool: if True, show the BASE, perturbed and difference fields, else only the difference
+        cmap: str: colormap of the images
+        limits: tuple: (vmin, vmax) of the BASE and perturbed fields
+        diff_limits: tuple: (vmin, vmax) of the difference (BASE minus perturbed)
+    Returns:
+        tuple: (Figure, list of images in the order BASE, perturbed, difference or only the difference,
+        list with True for the images that are scaled to each frame because they have no fixed limits) """
+    fig = Figure(figsize=(16, 9))
+    FigureCanvasAgg(fig)
+    empty = np.zeros(shape)
+    if side_by_side:
+        ax1, ax2, ax3 = fig.subplots(nrows=1, ncols=3)
+        base = ax1.imshow(empty, cmap=cmap, origin='lower', vmin=limits[0], vmax=limits[1])
+        perturbed = ax2.imshow(empty, cmap=cmap, origin='lower', vmin=limits[0], vmax=limits[1])
+        dif = ax3.imshow(empty, cmap=cmap, origin='lower', vmin=diff_limits[0], vmax=diff_limits[1])
+        fig.colorbar(base, orientation='horizontal', pad=0.05, ax=[ax1, ax2])
+        fig.colorbar(dif, orientation='horizontal', pad=0.05, ax=ax3)
+        return fig, [base, perturbed, dif], [None in limits, None in limits, None in diff_limits]
+    ax = fig.subplots(nrows=1, ncols=1)
+    dif = ax.imshow(empty, cmap=cmap, origin='lower', vmin=diff_limits[0], vmax=diff_limits[1])
+    fig.colorbar(dif, location='right', pad=0.05, ax=ax)
+    return fig, [dif], [None in diff_limits]
+
+def update_figure(fig, images, autoscale, base, perturbed, title):
+    """ Function to replace the data of the images of a quick-look figure
+    Input:
+        fig: Figure: figure from build_figure()
+        images: list: images from build_figure()
+        autoscale: list: images that are scaled to each frame, from build_figure()
+        base: np.ndarray: (latitude, longitude) BASE field
+        perturbed: np.ndarray: (latitude, longitude) perturbed field
+        title: str: title of the figure """
+    fields = [base, perturbed, base - perturbed] if len(images) == 3 else [base - perturbed]
+    for image, scale, field in zip(images, autoscale, fields):
+        image.set_data(field)
+        if scale:
+            image.autoscale()
+    fig.suptitle(title)
+
+def render_frames(base_path, perturbed_path, variable, frames, plotpath, prefix, side_by_side=True, cmap='Reds_r', limits=(None, None), diff_limits=(None, None)):
+    """ Function to render a range of quick-look frames with a single figure
+    Input:
+        base_path: str: path to the BASE flux set
+        perturbed_path: str: path to the perturbed flux set
+        variable: str: name of the variable to plot
+        frames: range: time steps to render (consecutive)
+        plotpath: str: directory of the figures, written to {plotpath}{prefix}_{time step}.png
+        prefix: str: prefix of the file names (e.g. the experiment code)
+        other arguments: see build_figure()
+    Returns:
+        list: paths of the rendered figures """
+    paths = []
+    with nc.Dataset(base_path, 'r') as base_nc, nc.Dataset(perturbed_path, 'r') as perturbed_nc:
+        titles = get_time_labels(base_nc.variables['time'])
+        fig, images, autoscale = build_figure(base_nc.variables[variable].shape[1:], side_by_side, cmap, limits, diff_limits)
+        for t in iter_time_chunks(len(frames), CHUNK_SIZE):
+            steps = slice(frames[t.start], frames[t.stop - 1] + 1)
+            base = base_nc.variables[variable][steps]
+            perturbed = perturbed_nc.variables[variable][steps]
+            for i in range(len(base)):
+                time = steps.start + i
+                update_figure(fig, images, autoscale, base[i], perturbed[i], titles[time])
+                path = plotpath + prefix + '_' + str(time) + '.png'
+                fig.savefig(path, bbox_inches='tight')
+                paths.append(path)
+    return paths
+
+def _render_worker(args):
+    """ Function to unpack the arguments of render_frames() in the process pool """
+    return render_frames(*args)
+
+def render_quicklook(base_path, perturbed_path, variable, plotpath, prefix, times=None, processes=None, frames_per_task=CHUNK_SIZE,
+                     side_by_side=True, cmap='Reds_r', limits=(None, None), diff_limits=(None, None)):
+    """ Function to render quick-look frames of a perturbed flux set in a process pool
+    Input:
+        base_path: str: path to the BASE flux set
+        perturbed_path: str: path to the perturbed flux set
+        variable: str: name of the variable to plot
+        plotpath: str: directory of the figures, created if it does not exist
+        prefix: str: prefix of the file names (e.g. the experiment code)
+        times: range: time steps to render (default: all)
+        processes: int: number of worker processes (default: number of CPUs, 1 to run without a pool)
+        frames_per_task: int: number of consecutive frames rendered by one worker task
+        other arguments: see build_figure()
+    Returns:
+        list: paths of the rendered figures """
+    if not os.path.exists(plotpath):
+        os.makedirs(plotpath)
+    if times is None:
+        with nc.Dataset(base_path, 'r') as base_nc:
+            times = range(len(base_nc.dimensions['time']))
+    tasks = [(base_path, perturbed_path, variable, times[t], plotpath, prefix, side_by_side, cmap, limits, diff_limits)
+             for t in iter_time_chunks(len(times), frames_per_task)]
+    if processes == 1:
+        results = [_render_worker(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(_render_worker, tasks))
+    return [path for paths in results for path in paths]
+
+def write_animation(base_path, perturbed_path, variable, out_path, times=None, fps=6, side_by_side=True, cmap='Reds_r', limits=(None, None), diff_limits=(None, None)):
+    """ Function to write the quick-look frames of a perturbed flux set as an animation (e.g. a .gif)
+    Input:
+        base_path: str: path to the BASE flux set
+        perturbed_path: str: path to the perturbed flux set
+        variable: str: name of the variable to plot
+        out_path: str: path of the animation
+        times: range: time steps to animate (default: all)
+        fps: int: frames per second
+        other arguments: see build_figure() """
+    with nc.Dataset(base_path, 'r') as base_nc, nc.Dataset(perturbed_path, 'r') as perturbed_nc:
+        titles = get_time_labels(base_nc.variables['time'])
+        if times is None:
+            times = range(len(base_nc.dimensions['time']))
+        fig, images, autoscale = build_figure(base_nc.variables[variable].shape[1:], side_by_side, cmap, limits, diff_limits)
+
+        def update(time):
+            update_figure(fig, images, autoscale, base_nc.variables[variable][time], perturbed_nc.variables[variable][time], titles[time])
+            return images
+
+        animation = FuncAnimation(fig, update, frames=times, blit=False)
+        animation.save(out_path, writer=PillowWriter(fps=fps))
+
+def monthly_overview(base_path, perturbed_path, variable, out_path, chunk_size=CHUNK_SIZE, ncols=4, cmap='RdBu_r'):
+    """ Function to plot the monthly mean difference (BASE minus perturbed) of a variable as tiles of one figure
+    Input:
+        base_path: str: path to the BASE flux set
+        perturbed_path: str: path to the perturbed flux set
+        variable: str: name of the variable to plot
+        out_path: str: path of the figure
+        chunk_size: int: number of time steps read at once
+        ncols: int: number of tiles per row
+        cmap: str: colormap, centred around zero """
+    with nc.Dataset(base_path, 'r') as base_nc, nc.Dataset(perturbed_path, 'r') as perturbed_nc:
+        time_var = base_nc.variables['time']
+        labels, nmonths = get_month_labels(time_var)
+        dates = nc.num2date(time_var[:], time_var.units, getattr(time_var, 'calendar', 'standard'))
+        sums = np.zeros((nmonths,) + base_nc.variables[variable].shape[1:])
+        for t in iter_time_chunks(len(time_var), chunk_size):
+            dif = np.asarray(base_nc.variables[variable][t], dtype=np.float64) - perturbed_nc.variables[variable][t]
+            for month in np.unique(labels[t]):
+                sums[month] += dif[labels[t] == month].sum(axis=0)
+        means = sums / np.bincount(labels, minlength=nmonths)[:, None, None]
+        titles = [dates[np.argmax(labels == month)].strftime('%Y-%m') for month in range(nmonths)]
+
+    nrows = int(np.ceil(nmonths / ncols))
+    fig = Figure(figsize=(4 * ncols, 4 * nrows))
+    FigureCanvasAgg(fig)
+    axes = np.atleast_1d(fig.subplots(nrows=nrows, ncols=ncols, squeeze=False)).ravel()
+    limit = np.nanmax(np.abs(means)) or 1
+    for month, ax in enumerate(axes):
+        if month >= nmonths:
+            ax.set_axis_off()
+            continue
+        image = ax.imshow(means[month], cmap=cmap, origin='lower', vmin=-limit, vmax=limit)
+        ax.set_title(titles[month])
+    fig.colorbar(image, orientation='horizontal', pad=0.05, ax=list(axes))
+    fig.suptitle(variable + ': monthly mean BASE minus perturbed')
+    fig.savefig(out_path, bbox_inches='tight')
@@ -0,0 +1,185 @@
+# This file contains functions to rasterize country geometries to fractional country masks on a
+# regular latitude/longitude grid, as used by templates/landmask/extract_countrymasks_Europe.ipynb.
+# Only the grid cells within the envelope of a country are considered. The cells that are fully
+# inside or fully outside the country are classified in bulk with a spatial index, and the exact
+# intersection is only calculated for the cells on the border of the country. Countries are
+# rasterized in parallel in a process pool.
+
+##############################################
+########## LOAD NECCESSARY PACKAGES ##########
+##############################################
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import shapely
+
+# Domain of the CTE-HR Europe grid (lower-left corners of the first and upper-right corners of the last grid cells)
+LON_BOUNDS = [-14.9, 35.1]
+LAT_BOUNDS = [33.05, 72.05]
+
+# Countries that are selected on their SOV_A3 code instead of their ADM0_ISO code in the Natural Earth data set
+SOV_A3_COUNTRIES = ['PRT', 'CYN', 'CYP', 'KOS', 'SRB']
+
+def globarea(im=360, jm=180, silent=True):
+    """ Function that calculates the surface area for each grid cell globally according to TM5 definitions
+    Input:
+        im: int: number of longitudes
+        jm: int: number of latitudes
+        silent: bool: if False, the total area of the field and of the earth are printed
+    Returns:
+        np.ndarray: (jm, im) area of each grid cell in m2 """
+    radius = 6.371e6  # the earth radius in meters
+    deg2rad = np.pi / 180.
+
+    dxx = 360.0 / im * deg2rad
+    dyy = 180.0 / jm * deg2rad
+    lat = np.arange(-90 * deg2rad, 90 * deg2rad, dyy)
+    dxy = dxx * (np.sin(lat + dyy) - np.sin(lat)) * radius ** 2
+    area = np.resize(np.repeat(dxy, im, axis=0), [jm, im])
+    if not silent:
+        print('total area of field = ', np.sum(area.flat))
+        print('total earth area    = ', 4 * np.pi * radius ** 2)
+    return area
+
+def get_grid(lon_bounds=LON_BOUNDS, lat_bounds=LAT_BOUNDS, res_lon=0.2, res_lat=0.1):
+    """ Function to get the lower-left corners of the grid cells of a regular latitude/longitude grid
+    Input:
+        lon_bounds: list: western and eastern edge of the grid
+        lat_bounds: list: southern and northern edge of the grid
+        res_lon: float: longitude resolution in degrees
+        res_lat: float: latitude resolution in degrees
+    Returns:
+        tuple: (1D np.ndarray of longitudes, 1D np.ndarray of latitudes) """
+    nx = int(round((lon_bounds[1] - lon_bounds[0]) / res_lon))
+    ny = int(round((lat_bounds[1] - lat_bounds[0]) / res_lat))
+    return lon_bounds[0] + np.arange(nx) * res_lon, lat_bounds[0] + np.arange(ny) * res_lat
+
+def bboxarea(lon_bounds=LON_BOUNDS, lat_bounds=LAT_BOUNDS, res_lon=0.2, res_lat=0.1, silent=True):
+    """ Function that calculates the surface area for each grid cell of a regional grid according to TM5 definitions
+    Input:
+        lon_bounds: list: western and eastern edge of the grid
+        lat_bounds: list: southern and northern edge of the grid
+        res_lon: float: longitude resolution in degrees
+        res_lat: float: latitude resolution in degrees
+        silent: bool: if False, the total area of the field and of the earth are printed
+    Returns:
+        np.ndarray: (latitude, longitude) area of each grid cell in m2 """
+    radius = 6.371e6  # the earth radius in meters
+    deg2rad = np.pi / 180.
+
+    lons, lats = get_grid(lon_bounds, lat_bounds, res_lon, res_lat)
+    dxx = res_lon * deg2rad
+    dyy = res_lat * deg2rad
+    lat = lats * deg2rad
+    dxy = dxx * (np.sin(lat + dyy) - np.sin(lat)) * radius ** 2
+    area = np.repeat(dxy[:, None], len(lons), axis=1)
+    if not silent:
+        print('total area of field      = ', np.sum(area.flat))
+        print('total earth area         = ', 4 * np.pi * radius ** 2)
+        print('fields fraction of earth = ', (np.sum(area.flat) / (4 * np.pi * radius ** 2)))
+    return area
+
+def get_cell_range(edges, low, high, res):
+    """ Function to find the grid cells along one axis that overlap with an interval
+    Input:
+        edges: np.ndarray: lower edges of the grid cells
+        low: float: start of the interval
+        high: float: end of the interval
+        res: float: size of the grid cells
+    Returns:
+        tuple: (start, stop) indices of the overlapping grid cells """
+    start = int(np.clip(np.floor((low - edges[0]) / res), 0, len(edges)))
+    stop = int(np.clip(np.ceil((high - edges[0]) / res), 0, len(edges)))
+    return start, stop
+
+def rasterize_geometry(geometry, lons, lats, res_lon, res_lat):
+    """ Function to calculate the fraction of each grid cell that is covered by a geometry
+    Input:
+        geometry: shapely geometry: (multi)polygon of the country, in degrees
+        lons: np.ndarray: lower-left longitudes of the grid cells, see get_grid()
+        lats: np.ndarray: lower-left latitudes of the grid cells, see get_grid()
+        res_lon: float: longitude resolution in degrees
+        res_lat: float: latitude resolution in degrees
+    Returns:
+        np.ndarray: (latitude, longitude) fraction of each grid cell inside the geometry """
+    frac = np.zeros((len(lats), len(lons)))
+    xmin, ymin, xmax, ymax = shapely.bounds(geometry)
+    col_start, col_stop = get_cell_range(lons, xmin, xmax, res_lon)
+    row_start, row_stop = get_cell_range(lats, ymin, ymax, res_lat)
+    if col_start >= col_stop or row_start >= row_stop:
+        return frac
+
+    # GRID CELLS WITHIN THE ENVELOPE OF THE GEOMETRY
+    xv, yv = np.meshgrid(lons[col_start:col_stop], lats[row_start:row_stop])
+    boxes = shapely.box(xv.ravel(), yv.ravel(), xv.ravel() + res_lon, yv.ravel() + res_lat)
+    shapely.prepare(geometry)
+    tree = shapely.STRtree(boxes)
+
+    # CELLS THAT ARE FULLY INSIDE OR TOUCH THE GEOMETRY, CLASSIFIED IN BULK
+    inside = tree.query(geometry, predicate='contains_properly')
+    touching = tree.query(geometry, predicate='intersects')
+    border = np.setdiff1d(touching, inside)
+    values = np.zeros(len(boxes))
+    values[inside] = 1
+
+    # EXACT INTERSECTION FOR THE BORDER CELLS ONLY, AGAINST THE PART OF THE GEOMETRY IN THEIR ROW
+    ncols = col_stop - col_start
+    for row in np.unique(border // ncols):
+        cells = border[border // ncols == row]
+        y0 = lats[row_start + row]
+        strip = shapely.clip_by_rect(geometry, lons[col_start] - res_lon, y0 - res_lat, lons[col_stop - 1] + 2 * res_lon, y0 + 2 * res_lat)
+        values[cells] = shapely.area(shapely.intersection(boxes[cells], strip)) / shapely.area(boxes[cells])
+
+    frac[row_start:row_stop, col_start:col_stop] = np.minimum(values, 1).reshape(xv.shape)
+    return frac
+
+def _rasterize_worker(args):
+    """ Function to unpack the arguments of rasterize_geometry() in the process pool """
+    return rasterize_geometry(*args)
+
+def rasterize_countries(geometries, lon_bounds=LON_BOUNDS, lat_bounds=LAT_BOUNDS, res_lon=0.2, res_lat=0.1, processes=None, fill=0):
+    """ Function to create the fractional country masks of a list of countries in a process pool
+    Input:
+        geometries: list: shapely geometry of each country, see load_country_geometries()
+        lon_bounds: list: western and eastern edge of the grid
+        lat_bounds: list: southern and northern edge of the grid
+        res_lon: float: longitude resolution in degrees
+        res_lat: float: latitude resolution in degrees
+        processes: int: number of worker processes (default: number of CPUs, 1 to run without a pool)
+        fill: float: value of the grid cells outside the country (0 or np.nan)
+    Returns:
+        list: (latitude, longitude) fractional mask of each country, in the order of geometries """
+    lons, lats = get_grid(lon_bounds, lat_bounds, res_lon, res_lat)
+    tasks = [(geometry, lons, lats, res_lon, res_lat) for geometry in geometries]
+    if processes == 1:
+        frac_list = [_rasterize_worker(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            frac_list = list(pool.map(_rasterize_worker, tasks))
+    if fill != 0:
+        for frac in frac_list:
+            frac[frac == 0] = fill
+    return frac_list
+
+def load_country_geometries(countrylist, natural_earth_res=10):
+    """ Function to select the geometries of the countries in a country list from the Natural Earth admin_0_countries data set
+    Input:
+        countrylist: pd.DataFrame: country list with a 'code' column (ISO codes), as in country_list.csv
+        natural_earth_res: int: resolution of the Natural Earth data set (10, 50 or 110 m)
+    Returns:
+        tuple: (list of shapely geometries, list of country names) """
+    # ONLY NEEDED TO READ THE NATURAL EARTH DATA, NOT TO RASTERIZE
+    import cartopy.io.shapereader as shpreader
+    import geopandas
+
+    shpfilename = shpreader.natural_earth(resolution=str(natural_earth_res) + 'm',
+                                          category='cultural',
+                                          name='admin_0_countries')
+    NEcountries = geopandas.read_file(shpfilename)
+
+    geometries, name_list = [], []
+    for country in countrylist['code']:
+        column = 'SOV_A3' if country in SOV_A3_COUNTRIES else 'ADM0_ISO'
+        selection = NEcountries.loc[NEcountries[column] == country]
+        geometries.append(selection.geometry.values[0])
+        name_list.append(selection.SOVEREIGNT.values[0])
+    return geometries, name_list
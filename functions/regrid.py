@@ -0,0 +1,205 @@
+# This file contains functions to conservatively regrid a BASE or perturbed flux set (full file or
+# overlay) to another regular latitude/longitude grid, e.g. the grid of a transport model of a PARIS
+# partner. The weight of each pair of source and target grid cells is their overlap area divided by
+# the area of the target cell. On a regular grid the overlap separates into a longitude part and a
+# sin(latitude) part, so the sparse (target cell x source cell) weight matrix is the Kronecker product
+# of two small 1D overlap matrices. It is cached on disk per pair of grids and applied to each time
+# chunk of each flux field as one sparse matrix product. Because the weights are area-weighted, the
+# total of a flux (flux x area, summed) over the part of the source grid covered by the target grid
+# is preserved, and so are country totals when the country masks are regridded with the same weights.
+# The latitude and longitude of the flux sets are the cell centers (as set from europe.grid by
+# functions/mergetime.py), and the regridded flux sets hold the centers of the target cells.
+
+##############################################
+########## LOAD NECCESSARY PACKAGES ##########
+##############################################
+import hashlib
+import os
+import netCDF4 as nc
+import numpy as np
+import scipy.sparse as sp
+from Experiments.functions.ncio import CHUNK_SIZE, iter_time_chunks, is_field
+from Experiments.functions.mergetime import read_griddes
+from Experiments.functions.overlay import open_flux_set
+
+# Directory of the cached weights (None: no cache), passed by the scripts that regrid
+REGRID_CACHE_DIR = None
+EARTH_RADIUS = 6.371e6  # the earth radius in meters, as in functions/rasterize.py
+
+def get_grid_edges(lon_bounds, lat_bounds, res_lon, res_lat):
+    """ Function to get the cell edges of a regular latitude/longitude grid
+    Input:
+        lon_bounds: list: western and eastern edge of the grid
+        lat_bounds: list: southern and northern edge of the grid
+        res_lon, res_lat: float: resolution in degrees
+    Returns:
+        tuple: (1D np.ndarray of longitude edges, 1D np.ndarray of latitude edges) """
+    nx = int(round((lon_bounds[1] - lon_bounds[0]) / res_lon))
+    ny = int(round((lat_bounds[1] - lat_bounds[0]) / res_lat))
+    return lon_bounds[0] + np.arange(nx + 1) * res_lon, lat_bounds[0] + np.arange(ny + 1) * res_lat
+
+def get_coordinate_edges(coords, position='center'):
+    """ Function to get the cell edges of a regular axis from its coordinates
+    Input:
+        coords: np.ndarray: coordinates of the grid cells, increasing
+        position: str: 'center' if the coordinates are the centers of the cells (as in the PARIS flux sets, which
+            get the cell centers of europe.grid in the CDO convention) or 'corner' if they are the lower-left corners
+            (as returned by get_grid() in functions/rasterize.py)
+    Returns:
+        np.ndarray: the len(coords) + 1 edges """
+    coords = np.asarray(coords, dtype=np.float64)
+    res = (coords[-1] - coords[0]) / (len(coords) - 1) if len(coords) > 1 else 1.
+    first = coords[0] - (res / 2 if position == 'center' else 0.)
+    return np.round(first + np.arange(len(coords) + 1) * res, 10)
+
+def get_griddes_edges(griddes):
+    """ Function to get the cell edges of the grid of a CDO grid description, whose xfirst and yfirst are
+    the centers of the first cells
+    Input:
+        griddes: dict: result of read_griddes() in functions/mergetime.py
+    Returns:
+        tuple: (1D np.ndarray of longitude edges, 1D np.ndarray of latitude edges) """
+    lon_edges = griddes['xfirst'] - griddes['xinc'] / 2 + np.arange(griddes['xsize'] + 1) * griddes['xinc']
+    lat_edges = griddes['yfirst'] - griddes['yinc'] / 2 + np.arange(griddes['ysize'] + 1) * griddes['yinc']
+    return np.round(lon_edges, 10), np.round(lat_edges, 10)
+
+def overlap_matrix(src_edges, dst_edges):
+    """ Function to calculate the overlap of the cells of two 1D axes
+    Input:
+        src_edges: np.ndarray: increasing edges of the source cells
+        dst_edges: np.ndarray: increasing edges of the target cells
+    Returns:
+        sp.csr_matrix: (target cell x source cell) length of the overlap of each pair of cells """
+    rows, cols, values = [], [], []
+    for i in range(len(dst_edges) - 1):
+        low, high = dst_edges[i], dst_edges[i + 1]
+        first = max(np.searchsorted(src_edges, low, side='right') - 1, 0)
+        last = min(np.searchsorted(src_edges, high, side='left'), len(src_edges) - 1)
+        for j in range(first, last):
+            overlap = min(high, src_edges[j + 1]) - max(low, src_edges[j])
+            if overlap > 0:
+                rows.append(i)
+                cols.append(j)
+                values.append(overlap)
+    return sp.csr_matrix((values, (rows, cols)), shape=(len(dst_edges) - 1, len(src_edges) - 1))
+
+def cell_areas(lon_edges, lat_edges):
+    """ Function to calculate the area of the cells of a regular latitude/longitude grid
+    Input:
+        lon_edges, lat_edges: np.ndarray: edges of the grid in degrees
+    Returns:
+        np.ndarray: (latitude, longitude) area of each grid cell in m2 """
+    deg2rad = np.pi / 180.
+    dlon = np.diff(lon_edges) * deg2rad
+    dsin = np.diff(np.sin(np.asarray(lat_edges) * deg2rad))
+    return EARTH_RADIUS ** 2 * dsin[:, None] * dlon[None, :]
+
+def build_weights(src_edges, dst_edges):
+    """ Function to build the conservative regridding weights between two regular grids
+    Input:
+        src_edges: tuple: (longitude edges, latitude edges) of the source grid
+        dst_edges: tuple: (longitude edges, latitude edges) of the target grid
+    Returns:
+        sp.csr_matrix: (target cell x source cell) weights, for fields flattened in (latitude, longitude) order """
+    deg2rad = np.pi / 180.
+    lon_overlap = overlap_matrix(src_edges[0], dst_edges[0]) * deg2rad
+    sin_overlap = overlap_matrix(np.sin(np.asarray(src_edges[1]) * deg2rad), np.sin(np.asarray(dst_edges[1]) * deg2rad))
+    overlap = sp.kron(sin_overlap, lon_overlap, format='csr') * EARTH_RADIUS ** 2
+    dst_area = cell_areas(dst_edges[0], dst_edges[1]).ravel()
+    return sp.diags(1. / dst_area) @ overlap
+
+def get_weights(src_edges, dst_edges, cache_dir=REGRID_CACHE_DIR):
+    """ Function to get the conservative regridding weights between two regular grids, cached on disk
+    Input:
+        src_edges: tuple: (longitude edges, latitude edges) of the source grid
+        dst_edges: tuple: (longitude edges, latitude edges) of the target grid
+        cache_dir: str: directory of the cached weights (None: no cache)
+    Returns:
+        sp.csr_matrix: (target cell x source cell) weights, see build_weights() """
+    cache_file = None
+    if cache_dir is not None:
+        key = hashlib.sha1()
+        for edges in list(src_edges) + list(dst_edges):
+            key.update(np.asarray(edges, dtype=np.float64).tobytes())
+        cache_file = os.path.join(cache_dir, 'regrid_' + key.hexdigest() + '.npz')
+        if os.path.exists(cache_file):
+            return sp.load_npz(cache_file).tocsr()
+
+    weights = build_weights(src_edges, dst_edges).tocsr()
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = cache_file + '.' + str(os.getpid()) + '.tmp.npz'
+        sp.save_npz(tmp_file, weights)
+        os.replace(tmp_file, cache_file)
+    return weights
+
+def regrid_chunk(weights, values, dst_shape, fill_value=None):
+    """ Function to regrid a time chunk of a flux field
+    Input:
+        weights: sp.csr_matrix: weights from get_weights()
+        values: np.ndarray: (time, latitude, longitude) chunk on the source grid
+        dst_shape: tuple: (latitude, longitude) shape of the target grid
+        fill_value: float: fill value of the field, counted as zero flux like NaN
+    Returns:
+        np.ndarray: (time, latitude, longitude) chunk on the target grid """
+    flat = np.asarray(values, dtype=np.float64).reshape(len(values), -1)
+    if fill_value is not None:
+        flat = np.where(flat == fill_value, 0., flat)
+    flat = np.nan_to_num(flat)
+    return (weights @ flat.T).T.reshape((len(values),) + tuple(dst_shape)).astype(values.dtype)
+
+def regrid_flux_set(path, out_path, lon_bounds, lat_bounds, res_lon, res_lat, variables=None, chunk_size=CHUNK_SIZE, cache_dir=REGRID_CACHE_DIR, gridfile=None):
+    """ Function to conservatively regrid a flux set to another regular grid, streaming it in time chunks
+    Input:
+        path: str: path to the BASE or perturbed flux set (or overlay file)
+        out_path: str: path of the regridded flux set to create
+        lon_bounds, lat_bounds: list: western/eastern and southern/northern edge of the target grid
+        res_lon, res_lat: float: resolution of the target grid in degrees
+        variables: list: names of the flux fields to regrid (default: all)
+        chunk_size: int: number of time steps read at once
+        cache_dir: str: directory of the cached weights (None: no cache)
+        gridfile: str: path to the CDO grid description of the flux set (e.g. europe.grid) to take the source cell
+            edges from (default: from the latitude and longitude of the flux set, which are the cell centers)
+    Returns:
+        sp.csr_matrix: the weights that were applied; the regridded flux set holds the centers of the target cells """
+    dst_edges = get_grid_edges(lon_bounds, lat_bounds, res_lon, res_lat)
+    dst_shape = (len(dst_edges[1]) - 1, len(dst_edges[0]) - 1)
+    src, read_chunk, datasets = open_flux_set(path)
+    try:
+        if gridfile is not None:
+            src_edges = get_griddes_edges(read_griddes(gridfile))
+        else:
+            src_edges = (get_coordinate_edges(src.variables['longitude'][:]), get_coordinate_edges(src.variables['latitude'][:]))
+        weights = get_weights(src_edges, dst_edges, cache_dir)
+        if variables is None:
+            variables = [name for name, var in src.variables.items() if is_field(var)]
+
+        with nc.Dataset(out_path, 'w', format='NETCDF4') as dst:
+            dst.setncatts({name: src.getncattr(name) for name in src.ncattrs()})
+            dst.geospatial_lat_resolution = str(res_lat) + ' degree'
+            dst.geospatial_lon_resolution = str(res_lon) + ' degree'
+            dst.regrid_comment = 'Conservatively (area-weighted) regridded from ' + os.path.abspath(path)
+            dst.createDimension('time', None)
+            dst.createDimension('latitude', dst_shape[0])
+            dst.createDimension('longitude', dst_shape[1])
+            dst_centers = [(edges[:-1] + edges[1:]) / 2 for edges in dst_edges]
+            for name, coords in (('time', src.variables['time'][:]), ('latitude', dst_centers[1]), ('longitude', dst_centers[0])):
+                var = src.variables[name]
+                new_var = dst.createVariable(name, var.dtype, var.dimensions)
+                new_var.setncatts({key: var.getncattr(key) for key in var.ncattrs() if key != '_FillValue'})
+                new_var[:] = coords
+            fill_values = {}
+            for name in variables:
+                var = src.variables[name]
+                fill_values[name] = var.getncattr('_FillValue') if '_FillValue' in var.ncattrs() else None
+                new_var = dst.createVariable(name, var.dtype, var.dimensions, fill_value=fill_values[name])
+                new_var.setncatts({key: var.getncattr(key) for key in var.ncattrs() if key != '_FillValue'})
+
+            for t in iter_time_chunks(len(src.dimensions['time']), chunk_size):
+                print('Working on ... ' + out_path + ', time steps ' + str(t.start) + ' to ' + str(t.stop))
+                for name in variables:
+                    dst.variables[name][t] = regrid_chunk(weights, read_chunk(name, t), dst_shape, fill_values[name])
+    finally:
+        for dataset in datasets:
+            dataset.close()
+    return weights
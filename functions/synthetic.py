@@ -0,0 +1,258 @@
+# This file contains functions to generate synthetic CTE-HR data with the layout of the real data, so
+# that the pipeline can be run and timed without the /projects/0/ctdas tree: daily CTE-HR output files
+# of the four flux streams, the europe.grid description, a BASE flux set with the layout of
+# paris_input.cdl, a fractional country mask file and a 0.05 degree land-use file. The fields are
+# random but have the structure the pipeline relies on: positive, skewed emissions with a diurnal
+# cycle (so percentiles are meaningful), totals that are the sum of their sectors, and countries that
+# are fractional on their borders. All generators are seeded, so repeated runs write identical files.
+
+##############################################
+########## LOAD NECCESSARY PACKAGES ##########
+##############################################
+import datetime as dt
+import os
+import netCDF4 as nc
+import numpy as np
+from Experiments.functions import funs
+from Experiments.functions.experiments import FF_LIST
+from Experiments.functions.ncio import CHUNK_SIZE, iter_time_chunks, get_storage_options
+from Experiments.functions.rasterize import LON_BOUNDS, LAT_BOUNDS, get_grid, bboxarea
+from Experiments.functions.maskpyramid import write_mask_file
+
+# Shape of the CTE-HR Europe grid (latitude, longitude)
+SHAPE = (390, 250)
+START_DATE = dt.datetime(2021, 1, 1)
+TIME_UNITS = 'seconds since 2000-01-01T00:00:00Z'
+
+# Synthetic countries: ISO code, name, timezone and a disc (centre longitude, centre latitude, radius in degrees)
+SYNTHETIC_COUNTRIES = [
+    ('FRA', 'France', 'CET', 2.5, 46.5, 4.0),
+    ('DEU', 'Germany', 'CET', 10.5, 51.0, 3.0),
+    ('FIN', 'Finland', 'EET', 26.0, 64.0, 3.5),
+    ('ESP', 'Spain', 'CET', -3.5, 40.0, 3.5),
+    ('ITA', 'Italy', 'CET', 12.5, 42.5, 2.5),
+    ('POL', 'Poland', 'CET', 19.5, 52.0, 2.5),
+    ('SWE', 'Sweden', 'CET', 16.0, 61.0, 3.0),
+    ('NLD', 'Netherlands', 'CET', 5.5, 52.3, 1.0),
+]
+
+# Daily CTE-HR files: name of each stream and the variables in it (the flux of the stream is the last variable)
+STREAMS = {
+    'regional.nep': ['nep'],
+    'ff_emissions_CO2': FF_LIST + ['cement', 'anthropogenic'],
+    'regional.ocean': ['ocean'],
+    'regional.fire': ['fire'],
+}
+
+# Variables of the BASE flux set that are generated for each stream variable
+BASE_VARIABLES = {'nep': 'flux_bio_exchange_prior', 'ocean': 'flux_ocean_exchange_prior', 'fire': 'flux_fire_exchange_prior'}
+
+def get_resolution(shape=SHAPE):
+    """ Function to get the resolution of a grid with the given shape over the CTE-HR domain
+    Input:
+        shape: tuple: (latitude, longitude) shape of the grid
+    Returns:
+        tuple: (res_lon, res_lat) in degrees """
+    return (LON_BOUNDS[1] - LON_BOUNDS[0]) / shape[1], (LAT_BOUNDS[1] - LAT_BOUNDS[0]) / shape[0]
+
+def get_country_fractions(shape=SHAPE, countries=SYNTHETIC_COUNTRIES, subcells=4):
+    """ Function to calculate fractional masks of the synthetic countries, by sampling each grid cell at
+    subcells x subcells points; points that fall in several discs belong to the nearest centre
+    Input:
+        shape: tuple: (latitude, longitude) shape of the grid
+        countries: list: entries of SYNTHETIC_COUNTRIES
+        subcells: int: number of sample points per grid cell along each axis
+    Returns:
+        list: (latitude, longitude) fraction of each grid cell inside each country """
+    res_lon, res_lat = get_resolution(shape)
+    lons, lats = get_grid(LON_BOUNDS, LAT_BOUNDS, res_lon, res_lat)
+    offsets = (np.arange(subcells) + 0.5) / subcells
+    sub_lons = (lons[:, None] + offsets[None, :] * res_lon).ravel()
+    sub_lats = (lats[:, None] + offsets[None, :] * res_lat).ravel()
+    distance = np.stack([np.hypot(sub_lons[None, :] - lon, sub_lats[:, None] - lat) / radius for _, _, _, lon, lat, radius in countries])
+    nearest = np.where(distance.min(axis=0) < 1, distance.argmin(axis=0), -1)
+    blocks = nearest.reshape(shape[0], subcells, shape[1], subcells)
+    return [(blocks == i).mean(axis=(1, 3)) for i in range(len(countries))]
+
+def synthetic_fields(rng, names, t, shape=SHAPE):
+    """ Function to generate a time chunk of synthetic fluxes in mol m-2 s-1
+    Input:
+        rng: np.random.Generator: random generator (its state advances with every chunk)
+        names: list: names of the variables, as in the daily files or the BASE flux set
+        t: slice: time steps (hours since the start) of the chunk
+        shape: tuple: (latitude, longitude) shape of the grid
+    Returns:
+        dict: (time, latitude, longitude) float32 field of each variable """
+    hours = np.arange(t.start, t.stop)
+    cycle = np.sin(2 * np.pi * (hours % 24) / 24)[:, None, None]
+    fields = {}
+    for name in names:
+        if name in FF_LIST or name == 'cement':
+            # SKEWED POSITIVE EMISSIONS WITH A DIURNAL CYCLE
+            spatial = rng.lognormal(mean=-16, sigma=1.5, size=shape)
+            fields[name] = spatial[None] * (1 + 0.3 * cycle) * rng.uniform(0.9, 1.1, size=(len(hours),) + shape)
+        elif name in ('nep', 'flux_bio_exchange_prior'):
+            # UPTAKE DURING THE DAY, RESPIRATION AT NIGHT
+            fields[name] = 5e-6 * (-cycle + 0.2 * rng.standard_normal((len(hours),) + shape))
+        elif name in ('ocean', 'flux_ocean_exchange_prior'):
+            fields[name] = -1e-7 * np.abs(rng.standard_normal((len(hours),) + shape))
+        elif name in ('fire', 'flux_fire_exchange_prior'):
+            fields[name] = np.where(rng.random((len(hours),) + shape) < 0.001, 1e-6, 0.)
+        elif name == 'anthropogenic':
+            # TOTAL OF THE SECTORS, AS IN THE CTE-HR EMISSION FILES
+            fields[name] = sum(fields[part] for part in names if part in FF_LIST or part == 'cement')
+    return {name: fields[name].astype(np.float32) for name in names}
+
+def write_grid_file(path, shape=SHAPE):
+    """ Function to write a CDO grid description of the synthetic grid, as europe.grid
+    Input:
+        path: str: path of the grid description file
+        shape: tuple: (latitude, longitude) shape of the grid """
+    res_lon, res_lat = get_resolution(shape)
+    with open(path, 'w') as f:
+        f.write('gridtype = lonlat\nyname     = latitude\nxname     = longitude\n' +
+                'xsize    = ' + str(shape[1]) + '\nysize    = ' + str(shape[0]) + '\n' +
+                'xfirst   = ' + str(LON_BOUNDS[0]) + '\nxinc     = ' + str(round(res_lon, 6)) + '\n' +
+                'yfirst   = ' + str(LAT_BOUNDS[0]) + '\nyinc     = ' + str(round(res_lat, 6)) + '\n')
+
+def write_daily_files(out_dir, ndays, shape=SHAPE, start=START_DATE, seed=0):
+    """ Function to write synthetic daily CTE-HR output files of all streams, in micromol m-2 s-1 as CTE-HR does,
+    in one directory per month as in the CTE-HR output directory
+    Input:
+        out_dir: str: CTE-HR output directory
+        ndays: int: number of days
+        shape: tuple: (latitude, longitude) shape of the grid
+        start: datetime: first day
+        seed: int: seed of the random generator
+    Returns:
+        dict: paths of the daily files of each stream """
+    rng = np.random.default_rng(seed)
+    paths = {stream: [] for stream in STREAMS}
+    for day in range(ndays):
+        date = start + dt.timedelta(days=day)
+        day_dir = os.path.join(out_dir, date.strftime('%Y%m'))
+        os.makedirs(day_dir, exist_ok=True)
+        for stream, names in STREAMS.items():
+            path = os.path.join(day_dir, stream + '.' + date.strftime('%Y%m%d') + '.nc')
+            fields = synthetic_fields(rng, names, slice(24 * day, 24 * (day + 1)), shape)
+            with nc.Dataset(path, 'w') as ds:
+                ds.createDimension('time', None)
+                ds.createDimension('latitude', shape[0])
+                ds.createDimension('longitude', shape[1])
+                time_var = ds.createVariable('time', 'f8', ('time',))
+                time_var.units = 'seconds since 2000-01-01 00:00:00'
+                time_var.calendar = 'standard'
+                time_var[:] = nc.date2num([date + dt.timedelta(hours=h) for h in range(24)], time_var.units, time_var.calendar)
+                for name in names:
+                    var = ds.createVariable(name, 'f4', ('time', 'latitude', 'longitude'))
+                    var.units = 'micromol m-2 s-1'
+                    var[:] = fields[name] * 1e6
+            paths[stream].append(path)
+    return paths
+
+def create_base_layout(path, ntime=None, shape=SHAPE, sectors=FF_LIST, countries=SYNTHETIC_COUNTRIES, start=START_DATE, profile=None):
+    """ Function to create an empty file with the layout of paris_input.cdl (without ncgen)
+    Input:
+        path: str: path of the file
+        ntime: int: number of hourly time steps to fill the time axis with (None: empty time axis)
+        shape: tuple: (latitude, longitude) shape of the grid
+        sectors: list: fossil fuel sectors (a subset of FF_LIST)
+        countries: list: entries of SYNTHETIC_COUNTRIES
+        start: datetime: first hour
+        profile: str or dict: storage profile of the flux fields (see STORAGE_PROFILES in functions/ncio.py)
+    Returns:
+        nc.Dataset: the new dataset, opened in write mode """
+    res_lon, res_lat = get_resolution(shape)
+    lons, lats = get_grid(LON_BOUNDS, LAT_BOUNDS, res_lon, res_lat)
+    ds = nc.Dataset(path, 'w', format='NETCDF4')
+    ds.summary = 'Synthetic CTE-HR flux set with the layout of paris_input.cdl, for benchmarks'
+    ds.createDimension('time', None)
+    ds.createDimension('longitude', shape[1])
+    ds.createDimension('latitude', shape[0])
+    ds.createDimension('countrynumber', len(countries))
+
+    time_var = ds.createVariable('time', 'i4', ('time',))
+    time_var.standard_name = 'time'
+    time_var.units = TIME_UNITS
+    time_var.calendar = 'standard'
+    time_var.axis = 'T'
+    if ntime is not None:
+        time_var[:] = nc.date2num([start + dt.timedelta(hours=h) for h in range(ntime)], TIME_UNITS, 'standard')
+    for name, coords, units, axis in (('longitude', lons, 'degrees_east', 'X'), ('latitude', lats, 'degrees_north', 'Y')):
+        var = ds.createVariable(name, 'f8', (name,))
+        var.standard_name = name
+        var.units = units
+        var.axis = axis
+        var[:] = coords
+    ds.createVariable('country_name', str, ('countrynumber',))[:] = np.array([country[1] for country in countries], dtype=object)
+    ds.createVariable('country_abbrev', str, ('countrynumber',))[:] = np.array([country[0] for country in countries], dtype=object)
+
+    dimensions = ('time', 'latitude', 'longitude')
+    sizes = {'time': None, 'latitude': shape[0], 'longitude': shape[1]}
+    options = get_storage_options(dimensions, sizes, profile) if profile is not None else {}
+    for name in list(sectors) + ['cement', 'combustion', 'flux_ff_exchange_prior'] + list(BASE_VARIABLES.values()):
+        var = ds.createVariable(name, 'f4', dimensions, **options)
+        var.units = 'mol m-2 s-1'
+    return ds
+
+def write_base_file(path, nhours, shape=SHAPE, sectors=FF_LIST, start=START_DATE, seed=0, chunk_size=CHUNK_SIZE, profile=None):
+    """ Function to write a synthetic BASE flux set with the layout of paris_input.cdl, in time chunks
+    Input:
+        path: str: path of the BASE flux set
+        nhours: int: number of hourly time steps
+        shape: tuple: (latitude, longitude) shape of the grid
+        sectors: list: fossil fuel sectors (a subset of FF_LIST); combustion is the sum of these sectors
+        start: datetime: first hour
+        seed: int: seed of the random generator
+        chunk_size: int: number of time steps generated at once
+        profile: str or dict: storage profile of the flux fields (see STORAGE_PROFILES in functions/ncio.py) """
+    rng = np.random.default_rng(seed)
+    names = list(sectors) + ['cement'] + list(BASE_VARIABLES.values())
+    with create_base_layout(path, nhours, shape, sectors, start=start, profile=profile) as ds:
+        for t in iter_time_chunks(nhours, chunk_size):
+            fields = synthetic_fields(rng, names, t, shape)
+            fields['combustion'] = sum(fields[sector] for sector in sectors)
+            fields['flux_ff_exchange_prior'] = fields['combustion'] + fields['cement']
+            for name, values in fields.items():
+                ds.variables[name][t] = values
+
+def write_synthetic_masks(path, shape=SHAPE, countries=SYNTHETIC_COUNTRIES):
+    """ Function to write a fractional country mask file of the synthetic countries, in the format of
+    paris_countrymask_0.2x0.1deg_2D.nc
+    Input:
+        path: str: path of the mask file
+        shape: tuple: (latitude, longitude) shape of the grid
+        countries: list: entries of SYNTHETIC_COUNTRIES """
+    res_lon, res_lat = get_resolution(shape)
+    area = bboxarea(LON_BOUNDS, LAT_BOUNDS, res_lon, res_lat)
+    write_mask_file(path, get_country_fractions(shape, countries), [country[0] for country in countries],
+                    [country[1] for country in countries], [country[2] for country in countries], area,
+                    LON_BOUNDS, LAT_BOUNDS, res_lon, res_lat, area_comment='synthetic countries')
+
+def write_synthetic_landuse(path, shape=SHAPE, seed=0, nclasses=12, patch=8):
+    """ Function to write a synthetic 0.05 degree land-use file in the format read by get_lu() (functions/funs.py):
+    patches of random CORINE PFT classes, stored upside down as the real file
+    Input:
+        path: str: path of the land-use file
+        shape: tuple: (latitude, longitude) shape of the flux grid; the land-use grid has the same extent at 0.05 degree
+        seed: int: seed of the random generator
+        nclasses: int: number of land-use classes (1 to nclasses)
+        patch: int: size of the patches of one class, in land-use cells """
+    res_lon, res_lat = get_resolution(shape)
+    lu_shape = (int(round(shape[0] * res_lat / 0.05)), int(round(shape[1] * res_lon / 0.05)))
+    rng = np.random.default_rng(seed)
+    patches = rng.integers(1, nclasses + 1, size=(-(-lu_shape[0] // patch), -(-lu_shape[1] // patch)))
+    landuse = np.repeat(np.repeat(patches, patch, axis=0), patch, axis=1)[:lu_shape[0], :lu_shape[1]]
+    with nc.Dataset(path, 'w') as ds:
+        ds.createDimension('lat', lu_shape[0])
+        ds.createDimension('lon', lu_shape[1])
+        ds.createVariable('landuse', 'i2', ('lat', 'lon'))[:] = np.flipud(landuse)
+
+def use_synthetic_landuse(lu_path, cache_dir):
+    """ Function to make get_lu() (and so the land-use filter of the experiments) read a synthetic land-use file
+    in this process
+    Input:
+        lu_path: str: path of the land-use file from write_synthetic_landuse()
+        cache_dir: str: directory of the land-use cache """
+    funs.LU_PATH = lu_path
+    funs.LU_CACHE_DIR = cache_dir
@@ -0,0 +1,87 @@
+# This file contains functions to keep the totals of the PARIS flux sets (combustion and
+# flux_ff_exchange_prior, see TOTALS in functions/experiments.py) consistent with the sectors
+# they are made of after one of these sectors is perturbed.
+
+##############################################
+########## LOAD NECCESSARY PACKAGES ##########
+##############################################
+import numpy as np
+from Experiments.functions.experiments import TOTALS
+
+# Relative tolerance of the consistency check of delta-updated totals against a full re-sum
+TOTALS_RTOL = 1e-5
+
+def take_cells(chunk, cells):
+    """ Function to select grid cells from a (time, latitude, longitude) chunk
+    Input:
+        chunk: np.ndarray: (time, latitude, longitude) chunk
+        cells: np.ndarray: flat indices of the grid cells
+    Returns:
+        np.ndarray: (time, cells) values """
+    return chunk.reshape(len(chunk), -1)[:, cells]
+
+def put_cells(chunk, cells, values):
+    """ Function to replace grid cells of a (time, latitude, longitude) chunk, without changing the input
+    Input:
+        chunk: np.ndarray: (time, latitude, longitude) chunk
+        cells: np.ndarray: flat indices of the grid cells
+        values: np.ndarray: (time, cells) new values
+    Returns:
+        np.ndarray: copy of chunk with the new values """
+    chunk = chunk.copy()
+    chunk.reshape(len(chunk), -1)[:, cells] = values
+    return chunk
+
+def update_totals(totals, data, result, deltas, cells=None):
+    """ Function to update totals by adding the change of the variables they are made of, so that
+    the unchanged sectors do not have to be read
+    Input:
+        totals: list: names of the totals to update, in the order of TOTALS (see dependent_totals())
+        data: dict: BASE chunks of (at least) the totals
+        result: dict: perturbed chunks, the updated totals are added to it
+        deltas: dict: change (perturbed minus BASE) of each perturbed variable, same shape as the chunks,
+            or (time, cells) if cells is given
+        cells: np.ndarray: flat indices of the only grid cells that changed (default: all cells)
+    Returns:
+        dict: result, including the updated totals """
+    deltas = dict(deltas)
+    for total in totals:
+        delta = 0
+        for part in TOTALS[total]:
+            if part in deltas:
+                delta = delta + deltas[part]
+        deltas[total] = delta
+        if cells is None:
+            result[total] = data[total] + delta
+        else:
+            result[total] = put_cells(data[total], cells, take_cells(data[total], cells) + delta)
+    return result
+
+def resum_totals(totals, data, result):
+    """ Function to re-calculate totals as the full sum of the variables they are made of
+    Input:
+        totals: list: names of the totals to re-calculate, in the order of TOTALS
+        data: dict: BASE chunks of all variables the totals are made of
+        result: dict: perturbed chunks, used instead of the BASE chunks where present
+    Returns:
+        dict: re-calculated chunk of each total """
+    sums = {}
+    for total in totals:
+        dummy = np.zeros(data[total].shape)
+        for part in TOTALS[total]:
+            dummy = dummy + sums.get(part, result.get(part, data[part]))
+        sums[total] = dummy
+    return sums
+
+def check_totals(totals, data, result, rtol=TOTALS_RTOL):
+    """ Function to check delta-updated totals against a full re-sum of the variables they are made of
+    Input:
+        totals: list: names of the totals to check
+        data: dict: BASE chunks of all variables the totals are made of
+        result: dict: perturbed chunks, including the delta-updated totals
+        rtol: float: tolerance relative to the largest absolute value of the re-summed total """
+    for total, dummy in resum_totals(totals, data, result).items():
+        difference = np.abs(result[total] - dummy).max()
+        if difference > rtol * np.abs(dummy).max():
+            raise ValueError('Delta-updated ' + total + ' differs from the sum of ' + ', '.join(TOTALS[total]) +
+                             ' by up to ' + str(difference) + ' (relative tolerance ' + str(rtol) + ')')
@@ -0,0 +1,268 @@
+# This file contains functions to verify a perturbed flux set against the BASE flux set and the
+# definition of its experiment. Both files are streamed in time chunks: the expected values are
+# calculated from each BASE chunk and compared to the perturbed file for every flux variable.
+# Differences are counted per variable and per (dominant) country, and the expected and actual
+# change of the total of each variable are compared per country. The result is a machine-readable
+# summary, optionally written to a JSON file.
+# The expected values do not use the perturbation engine (functions/perturbation.py), so that an
+# error in its masks, windows, sparse cells or total updates is not repeated in the check: the
+# scale field is built on the full grid from the country masks as stored in the mask file, the
+# land-use filter of get_lu() and the factor in EXPERIMENTS, and applied with plain numpy. Only the
+# percentile thresholds of e.g. PTEN are taken from functions/quantiles.py.
+
+##############################################
+########## LOAD NECCESSARY PACKAGES ##########
+##############################################
+import json
+import netCDF4 as nc
+import numpy as np
+from Experiments.functions.funs import get_lu
+from Experiments.functions.experiments import EXPERIMENTS, TOTALS, dependent_totals
+from Experiments.functions.masks import MASK_PATH, load_mask_registry
+from Experiments.functions.ncio import CHUNK_SIZE, iter_time_chunks, is_field
+from Experiments.functions.overlay import open_overlay, compose_chunk
+from Experiments.functions.quantiles import streaming_percentile, get_threshold_chunk
+from Experiments.functions.regrid import get_coordinate_edges, cell_areas
+from Experiments.functions.zonalstats import get_area_weights
+
+# Tolerance of the comparison of the perturbed file with the expected values (both float32)
+VERIFY_RTOL = 1e-6
+VERIFY_ATOL = 0.
+
+def read_country_fraction(codes, mask_path=MASK_PATH):
+    """ Function to read the fraction of each grid cell inside one or more countries directly from the mask file
+    Input:
+        codes: str or list: ISO code(s) of the countries
+        mask_path: str: path to the fractional country mask file
+    Returns:
+        np.ndarray: 2D (latitude, longitude) fractions, at most 1 """
+    with nc.Dataset(mask_path, 'r') as mask:
+        fraction = sum(np.nan_to_num(np.ma.filled(mask.variables[code][:, :], 0).astype(np.float64)) for code in np.atleast_1d(codes))
+    return np.minimum(fraction, 1.)
+
+def setup_expected(experimentcode, base, chunk_size=CHUNK_SIZE, mask_path=MASK_PATH):
+    """ Function to prepare the expected perturbation of an experiment on the full grid, independently of the
+    perturbation engine
+    Input:
+        experimentcode: str: name of the experiment in EXPERIMENTS
+        base: nc.Dataset: the BASE flux set
+        chunk_size: int: number of time steps read at once (used for the percentile passes)
+        mask_path: str: path to the fractional country mask file
+    Returns:
+        dict: the perturbed variable, the totals that depend on it, the 2D scale field and the (optional)
+        percentile thresholds """
+    experiment = EXPERIMENTS[experimentcode]
+    var = base.variables[experiment['variable']]
+    weight = np.ones(var.shape[1:])
+    if experiment.get('country'):
+        weight = read_country_fraction(experiment['country'], mask_path)
+    if experiment.get('landuse'):
+        weight = np.where(np.isin(get_lu(var), experiment['landuse']), weight, 0.)
+    thresholds = None
+    if experiment.get('percentile') is not None:
+        thresholds = streaming_percentile(var, experiment['percentile'], groupby=experiment.get('percentile_groupby', 'global'),
+                                          method=experiment.get('percentile_method', 'exact'), chunk_size=chunk_size,
+                                          time_var=base.variables['time'], mask_path=mask_path)
+    return {
+        'variable': experiment['variable'],
+        'totals': dependent_totals(experiment['variable']),
+        'scale': 1. + (experiment['factor'] - 1.) * weight,
+        'thresholds': thresholds,
+    }
+
+def expected_chunk(expectations, data, t):
+    """ Function to calculate the expected values of a time chunk of the perturbed file from the BASE chunk
+    Input:
+        expectations: list: expected perturbations from setup_expected(), applied in order
+        data: dict: (time, latitude, longitude) BASE chunks of (at least) the perturbed variables and their totals
+        t: slice: time steps of the chunk
+    Returns:
+        dict: the expected chunk of each variable of data (the BASE chunk itself if it does not change) """
+    expected = dict(data)
+    for expectation in expectations:
+        variable = expectation['variable']
+        values = expected[variable]
+        scaled = values * expectation['scale']
+        if expectation['thresholds'] is not None:
+            scaled = np.where(values > get_threshold_chunk(expectation['thresholds'], t), scaled, values)
+        change = {variable: scaled - values}
+        expected[variable] = scaled
+        for total in expectation['totals']:
+            change[total] = sum(change[part] for part in TOTALS[total] if part in change)
+            expected[total] = expected[total] + change[total]
+    return expected
+
+def time_sum(values):
+    """ Function to sum a (time, latitude, longitude) chunk over the time steps in float64, skipping NaN values
+    Input:
+        values: np.ndarray: chunk to sum
+    Returns:
+        np.ndarray: 1D sum per grid cell """
+    values = values.reshape(len(values), -1)
+    total = values.sum(axis=0, dtype=np.float64)
+    invalid = np.isnan(total)
+    if invalid.any():
+        total[invalid] = np.nansum(values[:, invalid], axis=0, dtype=np.float64)
+    return total
+
+def get_cell_area(base):
+    """ Function to calculate the area of the grid cells of a flux set from its latitude and longitude, which
+    are the cell centers, for mask files without an area variable
+    Input:
+        base: nc.Dataset: the BASE flux set
+    Returns:
+        np.ndarray: (latitude, longitude) area of each grid cell in m2 """
+    return cell_areas(get_coordinate_edges(base.variables['longitude'][:]), get_coordinate_edges(base.variables['latitude'][:]))
+
+def new_report(names, codes):
+    """ Function to create an empty verification report
+    Input:
+        names: list: names of the verified variables
+        codes: list: ISO codes of the countries of the mask file
+    Returns:
+        dict: per variable the number of cells that differ from the expected values and the largest
+        difference, and per region (country, 'none' for cells outside all countries and 'domain')
+        the totals of the BASE, expected and actual fields """
+    regions = list(codes) + ['none', 'domain']
+    report = {}
+    for name in names:
+        report[name] = {
+            'violations': 0,
+            'max_abs_diff': 0.,
+            'violations_per_country': {region: 0 for region in regions[:-1]},
+            'totals': {region: {'base': 0., 'expected': 0., 'actual': 0.} for region in regions},
+        }
+    return report
+
+def finish_report(report):
+    """ Function to add the expected and actual change and their ratio per region to a report
+    Input:
+        report: dict: report from new_report(), filled by verify_experiment()
+    Returns:
+        dict: the same report """
+    for entry in report.values():
+        for totals in entry['totals'].values():
+            totals['expected_change'] = totals['expected'] - totals['base']
+            totals['actual_change'] = totals['actual'] - totals['base']
+            totals['ratio'] = totals['actual_change'] / totals['expected_change'] if totals['expected_change'] != 0 else None
+    return report
+
+def verify_experiment(base_path, perturbed_path, experimentcodes, variables=None, chunk_size=CHUNK_SIZE, mask_path=MASK_PATH,
+                      rtol=VERIFY_RTOL, atol=VERIFY_ATOL, stop_early=False, summary_path=None):
+    """ Function to verify a perturbed flux set (full file or overlay) against the BASE flux set, in bounded memory
+    Input:
+        base_path: str: path to the BASE flux set
+        perturbed_path: str: path to the perturbed flux set or overlay file
+        experimentcodes: str or list: name(s) of the experiment(s) in EXPERIMENTS that were applied (an empty list
+            checks that the files are equal)
+        variables: list: names of the variables to verify (default: all time-dependent flux fields)
+        chunk_size: int: number of time steps read at once
+        mask_path: str: path to the fractional country mask file
+        rtol, atol: float: relative and absolute tolerance of the comparison
+        stop_early: bool: if True, stop at the first time chunk with a difference
+        summary_path: str: path of a JSON file to write the summary to (optional)
+    Returns:
+        dict: summary with 'ok', 'complete' (False if stopped early), 'first_violation' (variable, time step, row,
+        column, expected and actual value), 'area' (source of the cell area of the totals: the mask file, or the
+        grid of the BASE flux set if the mask file has no area) and 'variables' (see new_report() and finish_report()) """
+    if isinstance(experimentcodes, str):
+        experimentcodes = [experimentcodes]
+    registry = load_mask_registry(mask_path)
+    dominant = registry['dominant'].ravel()
+    codes = registry['codes']
+
+    summary = {'base': base_path, 'perturbed': perturbed_path, 'experiments': experimentcodes, 'rtol': rtol, 'atol': atol,
+               'ok': True, 'complete': True, 'first_violation': None,
+               'area': 'mask file' if registry['area'] is not None else 'grid of the BASE flux set'}
+    with nc.Dataset(base_path, 'r') as base:
+        base.set_auto_mask(False)
+        # THE CELL AREA OF THE TOTALS, FROM THE GRID IF THE MASK FILE HAS NONE (THE CELL-WISE COMPARISON DOES NOT NEED IT)
+        area = np.asarray(registry['area'] if registry['area'] is not None else get_cell_area(base), dtype=np.float64)
+        weights = get_area_weights(registry, area)
+        overlay_base, overlay, perturbed = None, None, None
+        try:
+            with nc.Dataset(perturbed_path, 'r') as src:
+                is_overlay = 'base_file' in src.ncattrs()
+            if is_overlay:
+                overlay_base, overlay = open_overlay(perturbed_path, base_path)
+            else:
+                perturbed = nc.Dataset(perturbed_path, 'r')
+                perturbed.set_auto_mask(False)
+
+            if variables is None:
+                variables = [name for name, var in base.variables.items() if is_field(var)]
+            expectations = [setup_expected(code, base, chunk_size, mask_path) for code in experimentcodes]
+            # THE BASE CHUNK OF EVERY VARIABLE IS READ ONCE, ALSO FOR THE PERTURBED VARIABLES AND TOTALS THAT ARE NOT VERIFIED
+            names = list(variables) + [name for expectation in expectations for name in [expectation['variable']] + expectation['totals']
+                                       if name not in variables]
+            report = new_report(variables, codes)
+
+            for t in iter_time_chunks(len(base.dimensions['time']), chunk_size):
+                print('Working on ... time steps ' + str(t.start) + ' to ' + str(t.stop))
+                data = {name: base.variables[name][t] for name in dict.fromkeys(names)}
+                expected = expected_chunk(expectations, data, t)
+                for name in variables:
+                    if overlay is not None:
+                        actual = compose_chunk(overlay_base, overlay, name, t)
+                    else:
+                        actual = perturbed.variables[name][t]
+                    wanted = expected[name].astype(actual.dtype, copy=False)
+                    entry = report[name]
+                    if np.array_equal(actual, wanted, equal_nan=True):
+                        # NOTHING TO COUNT: THE USUAL CASE FOR THE VARIABLES THAT THE EXPERIMENTS DO NOT CHANGE
+                        bad = None
+                    else:
+                        bad = ~np.isclose(actual, wanted, rtol=rtol, atol=atol, equal_nan=True)
+                        entry['max_abs_diff'] = max(entry['max_abs_diff'], float(np.nanmax(np.abs(actual.astype(np.float64) - wanted))))
+                    if bad is not None and bad.any():
+                        entry['violations'] += int(bad.sum())
+                        per_cell = bad.reshape(len(bad), -1).sum(axis=0)
+                        per_country = np.bincount(dominant + 1, weights=per_cell, minlength=len(codes) + 1)
+                        entry['violations_per_country']['none'] += int(per_country[0])
+                        for i, code in enumerate(codes):
+                            entry['violations_per_country'][code] += int(per_country[i + 1])
+                        if summary['first_violation'] is None:
+                            step, row, col = np.unravel_index(np.argmax(bad), bad.shape)
+                            summary['first_violation'] = {'variable': name, 'time': int(t.start + step), 'row': int(row), 'col': int(col),
+                                                          'expected': float(wanted[step, row, col]), 'actual': float(actual[step, row, col])}
+                        summary['ok'] = False
+
+                    # TOTALS PER COUNTRY AND OVER THE DOMAIN (FLUX X AREA, SUMMED OVER THE TIME STEPS); CHUNKS THAT
+                    # ARE THE SAME ARRAY OR EQUAL WITHOUT A CONVERSION ARE ONLY SUMMED ONCE
+                    sums = {'base': time_sum(data[name])}
+                    sums['expected'] = sums['base'] if expected[name] is data[name] else time_sum(expected[name])
+                    sums['actual'] = sums['expected'] if bad is None and wanted is expected[name] else time_sum(actual)
+                    for key, flat in sums.items():
+                        per_country = weights @ flat
+                        for i, code in enumerate(codes):
+                            entry['totals'][code][key] += float(per_country[i])
+                        entry['totals']['domain'][key] += float(flat @ area.ravel())
+                        entry['totals']['none'][key] += float(flat[dominant < 0] @ area.ravel()[dominant < 0])
+
+                if stop_early and not summary['ok']:
+                    summary['complete'] = False
+                    break
+        finally:
+            for dataset in (overlay_base, overlay, perturbed):
+                if dataset is not None:
+                    dataset.close()
+
+    summary['variables'] = finish_report(report)
+    if summary_path is not None:
+        with open(summary_path, 'w') as f:
+            json.dump(summary, f, indent=1)
+    return summary
+
+def print_summary(summary):
+    """ Function to print a short overview of a verification summary
+    Input:
+        summary: dict: result of verify_experiment() """
+    print(('OK' if summary['ok'] else 'FAILED') + ': ' + summary['perturbed'] + ' against ' + summary['base'] +
+          ' (' + ', '.join(summary['experiments']) + ')' + ('' if summary['complete'] else ', stopped at the first difference'))
+    if summary['first_violation'] is not None:
+        print('First difference: ' + str(summary['first_violation']))
+    for name, entry in summary['variables'].items():
+        changed = {region: totals['ratio'] for region, totals in entry['totals'].items() if totals['ratio'] is not None}
+        if entry['violations'] or changed:
+            print(name + ': ' + str(entry['violations']) + ' cells differ, actual/expected change ' +
+                  ', '.join(region + ' ' + format(ratio, '.6f') for region, ratio in changed.items()))
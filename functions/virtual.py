@@ -0,0 +1,122 @@
+# This file contains functions to read a perturbed flux set without writing it: a virtual experiment
+# is the BASE flux set plus an experiment definition (perturbed variable, country mask, land-use filter,
+# factor and the totals that depend on the variable), and the perturbed values are only calculated for
+# the time steps and cells that are read. The experiment is set up once with setup_experiment() and
+# applied per time chunk with apply_experiment() (functions/perturbation.py), so the values are the
+# same as in the materialized flux set. Only the chunks of the window of the experiment are perturbed;
+# the most recently used perturbed chunks are kept in memory up to cache_bytes (least recently used
+# first out), and reads of unchanged variables or of cells outside the window go straight to the BASE file.
+
+##############################################
+########## LOAD NECCESSARY PACKAGES ##########
+##############################################
+from collections import OrderedDict
+import netCDF4 as nc
+import numpy as np
+from Experiments.functions.masks import MASK_PATH
+from Experiments.functions.ncio import CHUNK_SIZE, window_slices
+from Experiments.functions.perturbation import setup_experiment, apply_experiment
+
+# Memory of the perturbed time chunks kept per virtual experiment, in bytes. One time chunk holds the perturbed
+# variable and its totals within the window, e.g. 4 x 24 x 390 x 250 float32 values (37 MB) for ATEN on the
+# full CTE-HR grid, so the default keeps one such chunk, or several of the smaller windows of a single country
+VIRTUAL_CACHE_BYTES = 64 * 1024 ** 2
+
+def get_indices(index, size):
+    """ Function to get the indices selected by an index along an axis
+    Input:
+        index: int, slice or list: index along the axis
+        size: int: length of the axis
+    Returns:
+        np.ndarray: 1D array of the selected indices """
+    return np.atleast_1d(np.arange(size)[index])
+
+def open_virtual_experiment(base_path, experimentcode, chunk_size=CHUNK_SIZE, mask_path=MASK_PATH, cache_bytes=VIRTUAL_CACHE_BYTES, experiment=None):
+    """ Function to open a virtual perturbed flux set for reading. Percentile experiments read the perturbed
+    variable once to calculate their thresholds, all other experiments read nothing until values are requested.
+    Input:
+        base_path: str: path to the BASE flux set
+        experimentcode: str: name of the experiment in EXPERIMENTS (or a name for the experiment argument)
+        chunk_size: int: number of time steps perturbed (and cached) at once
+        mask_path: str: path to the fractional country mask file
+        cache_bytes: int: memory of the perturbed time chunks kept in memory, in bytes. The most recently used
+            chunk is always kept, so the cache holds at most max(cache_bytes, the size of one chunk)
+        experiment: dict: experiment definition with the keys of EXPERIMENTS, to evaluate a scenario that is not
+            in EXPERIMENTS (default: EXPERIMENTS[experimentcode])
+    Returns:
+        tuple: (nc.Dataset of the BASE flux set, function(name, t, rows=slice(None), cols=slice(None)) returning
+        the perturbed values of a variable as from the netCDF variable, list of the datasets to close). The
+        function has a cache_info() that returns the hits, misses, chunks and bytes of the cache. """
+    base = nc.Dataset(base_path, 'r')
+    base.set_auto_mask(False)
+    setup = setup_experiment(experimentcode, base, chunk_size, mask_path, experiment=experiment)
+    changed = [setup['variable']] + setup['totals']
+    ntime = len(base.dimensions['time'])
+    window_rows, window_cols = window_slices(setup['window'])
+
+    cache = OrderedDict()
+    info = {'hits': 0, 'misses': 0, 'bytes': 0}
+
+    def perturbed_chunk(k):
+        # THE PERTURBED VARIABLE AND ITS TOTALS WITHIN THE WINDOW, FOR TIME CHUNK k
+        if k in cache:
+            info['hits'] += 1
+            cache.move_to_end(k)
+            return cache[k]
+        info['misses'] += 1
+        t = slice(k * chunk_size, min((k + 1) * chunk_size, ntime))
+        data = {name: base.variables[name][t, window_rows, window_cols] for name in setup['needed']}
+        chunk = apply_experiment(setup, data, t)
+        cache[k] = chunk
+        info['bytes'] += sum(values.nbytes for values in chunk.values())
+        # DROP THE LEAST RECENTLY USED CHUNKS ABOVE THE MEMORY BOUND, BUT KEEP THE CHUNK THAT IS BEING READ
+        while info['bytes'] > cache_bytes and len(cache) > 1:
+            _, dropped = cache.popitem(last=False)
+            info['bytes'] -= sum(values.nbytes for values in dropped.values())
+        return chunk
+
+    def read(name, t=slice(None), rows=slice(None), cols=slice(None)):
+        values = base.variables[name][t, rows, cols]
+        if name not in changed:
+            return values
+
+        # PATCH THE REQUESTED CELLS THAT ARE INSIDE THE WINDOW WITH THE PERTURBED CHUNKS
+        var = base.variables[name]
+        times, row_indices, col_indices = get_indices(t, var.shape[0]), get_indices(rows, var.shape[1]), get_indices(cols, var.shape[2])
+        in_rows = (row_indices >= setup['window'][0]) & (row_indices < setup['window'][1])
+        in_cols = (col_indices >= setup['window'][2]) & (col_indices < setup['window'][3])
+        if not in_rows.any() or not in_cols.any() or len(times) == 0:
+            return values
+        shape = values.shape
+        values = values.reshape(len(times), len(row_indices), len(col_indices)).copy()
+        chunk_rows = row_indices[in_rows] - setup['window'][0]
+        chunk_cols = col_indices[in_cols] - setup['window'][2]
+        for k in np.unique(times // chunk_size):
+            in_chunk = np.flatnonzero(times // chunk_size == k)
+            chunk = perturbed_chunk(int(k))[name]
+            values[np.ix_(in_chunk, np.flatnonzero(in_rows), np.flatnonzero(in_cols))] = \
+                chunk[np.ix_(times[in_chunk] - k * chunk_size, chunk_rows, chunk_cols)]
+        return values.reshape(shape)
+
+    read.cache_info = lambda: dict(info, chunks=len(cache), max_bytes=cache_bytes)
+    return base, read, [base]
+
+def read_virtual(base_path, experimentcode, name, t=slice(None), rows=slice(None), cols=slice(None), mask_path=MASK_PATH, experiment=None):
+    """ Function to read part of a variable of a virtual perturbed flux set (opening it for a single read, see
+    open_virtual_experiment() to read repeatedly)
+    Input:
+        base_path: str: path to the BASE flux set
+        experimentcode: str: name of the experiment in EXPERIMENTS
+        name: str: name of the variable
+        t: slice, int or list: time steps to read
+        rows, cols: slice, int or list: latitude and longitude indices to read
+        mask_path: str: path to the fractional country mask file
+        experiment: dict: experiment definition (default: EXPERIMENTS[experimentcode])
+    Returns:
+        np.ndarray: the perturbed values """
+    base, read, datasets = open_virtual_experiment(base_path, experimentcode, mask_path=mask_path, experiment=experiment)
+    try:
+        return read(name, t, rows, cols)
+    finally:
+        for dataset in datasets:
+            dataset.close()
@@ -0,0 +1,116 @@
+# This file contains functions to calculate country totals of every flux variable of a PARIS flux
+# set (BASE or perturbed) in one streaming read. Each time chunk of a variable is multiplied by the
+# sparse (country x grid cell) weight matrix of the mask registry times the cell area, which gives
+# the total per country and time step. These are then summed to daily, monthly and annual totals.
+
+##############################################
+########## LOAD NECCESSARY PACKAGES ##########
+##############################################
+import netCDF4 as nc
+import numpy as np
+import pandas as pd
+from Experiments.functions.masks import MASK_PATH, load_mask_registry
+from Experiments.functions.ncio import CHUNK_SIZE, iter_time_chunks, is_field
+
+# pandas frequency of each aggregation level of the zonal statistics (None: no aggregation)
+FREQUENCIES = {
+    'hourly': None,
+    'daily': 'D',
+    'monthly': 'MS',
+    'annual': 'YS',
+}
+
+def get_area_weights(registry, area=None):
+    """ Function to combine the fractional country masks with the cell area into one sparse matrix
+    Input:
+        registry: dict: result of load_mask_registry()
+        area: np.ndarray: (latitude, longitude) area of each grid cell in m2 (default: the area of the mask file)
+    Returns:
+        scipy.sparse.csr_matrix: (country, grid cell) area of each grid cell inside each country in m2 """
+    if area is None:
+        area = registry['area']
+    if area is None:
+        raise ValueError('The mask file ' + registry['path'] + ' has no area variable, pass the cell area explicitly')
+    return registry['weights'].multiply(np.asarray(area, dtype=np.float64).reshape(1, -1)).tocsr()
+
+def get_timestep_seconds(time_var):
+    """ Function to get the length of each time step of a time variable, to convert fluxes (per second) to totals
+    Input:
+        time_var: nc.Variable: time variable with CF units
+    Returns:
+        np.ndarray: length of each time step in seconds (the last step has the length of the step before it,
+        and a single time step is taken to be one hour) """
+    dates = nc.num2date(time_var[:], time_var.units, getattr(time_var, 'calendar', 'standard'),
+                        only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+    if len(dates) < 2:
+        return np.full(len(dates), 3600.)
+    seconds = np.array([(b - a).total_seconds() for a, b in zip(dates[:-1], dates[1:])])
+    return np.append(seconds, seconds[-1])
+
+def stream_country_totals(path, variables=None, mask_path=MASK_PATH, chunk_size=CHUNK_SIZE, area=None):
+    """ Function to calculate the total of each flux variable per country and time step in one streaming read
+    Input:
+        path: str: path to the BASE or perturbed flux file (fluxes in mol m-2 s-1)
+        variables: list: names of the variables (default: all time-dependent flux fields)
+        mask_path: str: path to the fractional country mask file, on the same grid as the flux file
+        chunk_size: int: number of time steps read at once
+        area: np.ndarray: (latitude, longitude) area of each grid cell in m2 (default: the area of the mask file)
+    Returns:
+        pd.DataFrame: total per time step in mol, with a (time, country) index and one column per variable """
+    registry = load_mask_registry(mask_path)
+    weights = get_area_weights(registry, area)
+
+    with nc.Dataset(path, 'r') as src:
+        src.set_auto_mask(False)
+        if variables is None:
+            variables = [name for name, var in src.variables.items() if is_field(var)]
+        time_var = src.variables['time']
+        dates = pd.DatetimeIndex(nc.num2date(time_var[:], time_var.units, getattr(time_var, 'calendar', 'standard'),
+                                             only_use_cftime_datetimes=False, only_use_python_datetimes=True))
+        seconds = get_timestep_seconds(time_var)
+
+        totals = {}
+        for name in variables:
+            print('Working on ' + name + ' ... ', flush=True)
+            var = src.variables[name]
+            if var.shape[1:] != registry['shape']:
+                raise ValueError(name + ' has shape ' + str(var.shape[1:]) + ', the masks of ' + registry['path'] +
+                                 ' have shape ' + str(registry['shape']))
+            total = np.zeros((len(var), len(registry['codes'])))
+            for t in iter_time_chunks(len(var), chunk_size):
+                chunk = np.asarray(var[t], dtype=np.float64).reshape(t.stop - t.start, -1)
+                # (COUNTRY, CELL) X (CELL, TIME): TOTAL FLUX PER COUNTRY IN MOL S-1, TIMES THE LENGTH OF THE TIME STEP
+                total[t] = (weights @ chunk.T).T * seconds[t][:, None]
+            totals[name] = total.ravel()
+
+    index = pd.MultiIndex.from_product([dates, registry['codes']], names=['time', 'country'])
+    return pd.DataFrame(totals, index=index)
+
+def aggregate_totals(totals, frequency):
+    """ Function to sum the totals per time step to a coarser time resolution
+    Input:
+        totals: pd.DataFrame: result of stream_country_totals()
+        frequency: str: one of FREQUENCIES
+    Returns:
+        pd.DataFrame: total per period in mol, with a (time, country) index where time is the start of the period """
+    if FREQUENCIES[frequency] is None:
+        return totals
+    grouper = [pd.Grouper(level='time', freq=FREQUENCIES[frequency]), pd.Grouper(level='country')]
+    return totals.groupby(grouper, sort=False).sum().sort_index(level='time', sort_remaining=False)
+
+def write_zonal_stats(path, out_prefix, frequencies=('hourly', 'daily', 'monthly', 'annual'), variables=None, mask_path=MASK_PATH, chunk_size=CHUNK_SIZE, area=None):
+    """ Function to write the country totals of a flux file at several time resolutions to CSV tables,
+    reading the flux file only once
+    Input:
+        path: str: path to the BASE or perturbed flux file
+        out_prefix: str: path prefix of the tables, written to {out_prefix}_{frequency}.csv
+        frequencies: list: aggregation levels, see FREQUENCIES
+        other arguments: see stream_country_totals()
+    Returns:
+        dict: pd.DataFrame with the totals (mol) per aggregation level """
+    totals = stream_country_totals(path, variables, mask_path, chunk_size, area)
+    tables = {}
+    for frequency in frequencies:
+        tables[frequency] = aggregate_totals(totals, frequency)
+        tables[frequency].to_csv(out_prefix + '_' + frequency + '.csv')
+    return tables
@@ -0,0 +1,42 @@
+# Shared fixtures of the tests: a small synthetic BASE flux set with country masks, a land-use file and
+# a grid description (functions/synthetic.py), written once per test session. The library is imported
+# as the Experiments package, as on the cluster; if the checkout is not importable under that name,
+# it is registered as such here.
+
+##############################################
+########## LOAD NECCESSARY PACKAGES ##########
+##############################################
+import importlib.util
+import os
+import sys
+import types
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if importlib.util.find_spec('Experiments') is None:
+    package = types.ModuleType('Experiments')
+    package.__path__ = [ROOT]
+    sys.modules['Experiments'] = package
+
+from Experiments.functions import funs, synthetic
+
+# Small grid over the CTE-HR domain (0.5 x 1 degree) and a record length that is not a multiple of the time chunks
+SHAPE = (78, 50)
+NHOURS = 60
+CHUNK_SIZE = 16
+
+@pytest.fixture(scope='session')
+def flux_set(tmp_path_factory):
+    """ Fixture with the paths of a synthetic BASE flux set ('base'), its country masks ('mask'), land use
+    ('landuse') and grid description ('grid'). get_lu() reads the synthetic land use during the session. """
+    workdir = tmp_path_factory.mktemp('flux_set')
+    paths = {name: str(workdir / filename) for name, filename in
+             (('base', 'paris_ctehr_yr1_BASE.nc'), ('mask', 'countrymask.nc'), ('landuse', 'landuse.nc'), ('grid', 'europe.grid'))}
+    synthetic.write_base_file(paths['base'], NHOURS, SHAPE)
+    synthetic.write_synthetic_masks(paths['mask'], SHAPE)
+    synthetic.write_synthetic_landuse(paths['landuse'], SHAPE)
+    synthetic.write_grid_file(paths['grid'], SHAPE)
+    lu_path, lu_cache_dir = funs.LU_PATH, funs.LU_CACHE_DIR
+    synthetic.use_synthetic_landuse(paths['landuse'], str(workdir / 'lu_cache'))
+    yield paths
+    funs.LU_PATH, funs.LU_CACHE_DIR = lu_path, lu_cache_dir
@@ -0,0 +1,99 @@
+# Tests of the perturbation engine (functions/perturbation.py): the perturbed flux sets of the first-year
+# experiments against the arithmetic of the original per-experiment scripts, the delta-updated totals,
+# several experiments in one pass and the overlay format.
+
+##############################################
+########## LOAD NECCESSARY PACKAGES ##########
+##############################################
+import netCDF4 as nc
+import numpy as np
+import pytest
+from Experiments.functions.experiments import FF_LIST
+from Experiments.functions.funs import get_lu
+from Experiments.functions.overlay import materialize_overlay
+from Experiments.functions.perturbation import perturb_experiment, perturb_experiments
+from conftest import CHUNK_SIZE
+
+FIELDS = FF_LIST + ['cement', 'combustion', 'flux_ff_exchange_prior', 'flux_bio_exchange_prior']
+
+def read_fields(path, names=FIELDS):
+    """ Function to read the whole time axis of the given variables of a flux set """
+    with nc.Dataset(path, 'r') as ds:
+        ds.set_auto_mask(False)
+        return {name: ds.variables[name][:] for name in names}
+
+def baseline_experiment(experimentcode, base, mask_path):
+    """ Function to calculate a perturbed flux set with the arithmetic of the original yr1/{experiment}/paris_{experiment}.py
+    scripts (the re-summed combustion of PTEN starts from zero, not from the ones of the original script) """
+    result = {name: values.copy() for name, values in base.items()}
+    with nc.Dataset(mask_path, 'r') as mask:
+        masks = {code: mask.variables[code][:, :].data for code in ('FRA', 'FIN')}
+
+    if experimentcode == 'ATEN':
+        result['combustion'] = base['combustion'] * 1.1
+    elif experimentcode == 'HFRA':
+        result['B_Industry'] = base['B_Industry'] - (base['B_Industry'] * masks['FRA'] * 0.5)
+    elif experimentcode == 'PTEN':
+        energy = base['A_Public_power'].copy()
+        energy[energy > np.percentile(energy[energy != 0], 90)] = 0
+        result['A_Public_power'] = energy
+    elif experimentcode == 'DFIN':
+        nep = base['flux_bio_exchange_prior']
+        forest = np.isin(get_lu(nep), [2, 5, 8])
+        masked = nep * masks['FIN'] * 2
+        masked[:, ~forest] = 0
+        result['flux_bio_exchange_prior'] = nep + masked
+        return result
+
+    if experimentcode != 'ATEN':
+        dummy = np.zeros(base['combustion'].shape)
+        for var in FF_LIST:
+            dummy = dummy + result[var]
+        result['combustion'] = dummy.astype(np.float32)
+    result['flux_ff_exchange_prior'] = result['combustion'] + result['cement']
+    return result
+
+def assert_flux_equal(actual, expected, name):
+    """ Function to compare two fields up to float32 rounding of sums (relative to the largest value of the field) """
+    np.testing.assert_allclose(actual, expected, rtol=1e-6, atol=1e-6 * np.abs(expected).max(), err_msg=name)
+
+@pytest.mark.parametrize('experimentcode', ['ATEN', 'HFRA', 'PTEN', 'DFIN'])
+def test_experiment_matches_baseline_scripts(flux_set, tmp_path, experimentcode):
+    out_path = str(tmp_path / (experimentcode + '.nc'))
+    perturb_experiment(flux_set['base'], out_path, experimentcode, chunk_size=CHUNK_SIZE, mask_path=flux_set['mask'])
+    base = read_fields(flux_set['base'])
+    expected = baseline_experiment(experimentcode, base, flux_set['mask'])
+    actual = read_fields(out_path)
+    changed = [name for name in FIELDS if not np.array_equal(expected[name], base[name])]
+    assert changed, 'the experiment does not change the synthetic flux set'
+    for name in FIELDS:
+        assert_flux_equal(actual[name], expected[name], name)
+
+def test_delta_totals_pass_the_resum_check(flux_set, tmp_path):
+    # check_totals RAISES A ValueError IF A DELTA-UPDATED TOTAL DIFFERS FROM THE RE-SUM OF ITS PARTS
+    out_paths = {code: str(tmp_path / (code + '.nc')) for code in ('HFRA', 'PTEN', 'HGER')}
+    perturb_experiments(flux_set['base'], out_paths, chunk_size=CHUNK_SIZE, mask_path=flux_set['mask'], check_totals=True)
+    for out_path in out_paths.values():
+        actual = read_fields(out_path)
+        assert_flux_equal(actual['combustion'], sum(actual[name].astype(np.float64) for name in FF_LIST), 'combustion')
+        assert_flux_equal(actual['flux_ff_exchange_prior'], actual['combustion'] + actual['cement'], 'flux_ff_exchange_prior')
+
+def test_single_pass_equals_separate_runs(flux_set, tmp_path):
+    codes = ['ATEN', 'HFRA', 'PTEN']
+    perturb_experiments(flux_set['base'], {code: str(tmp_path / (code + '_all.nc')) for code in codes},
+                        chunk_size=CHUNK_SIZE, mask_path=flux_set['mask'])
+    for code in codes:
+        perturb_experiment(flux_set['base'], str(tmp_path / (code + '.nc')), code, chunk_size=CHUNK_SIZE, mask_path=flux_set['mask'])
+        together, alone = read_fields(str(tmp_path / (code + '_all.nc'))), read_fields(str(tmp_path / (code + '.nc')))
+        for name in FIELDS:
+            np.testing.assert_array_equal(together[name], alone[name], err_msg=code + ' ' + name)
+
+@pytest.mark.parametrize('experimentcode', ['HFRA', 'PTEN'])
+def test_overlay_equals_full_flux_set(flux_set, tmp_path, experimentcode):
+    full_path, overlay_path, materialized_path = [str(tmp_path / (experimentcode + suffix)) for suffix in ('.nc', '_overlay.nc', '_materialized.nc')]
+    perturb_experiment(flux_set['base'], full_path, experimentcode, chunk_size=CHUNK_SIZE, mask_path=flux_set['mask'])
+    perturb_experiment(flux_set['base'], overlay_path, experimentcode, chunk_size=CHUNK_SIZE, mask_path=flux_set['mask'], overlay=True)
+    materialize_overlay(overlay_path, materialized_path, chunk_size=CHUNK_SIZE)
+    full, materialized = read_fields(full_path), read_fields(materialized_path)
+    for name in FIELDS:
+        np.testing.assert_array_equal(materialized[name], full[name], err_msg=name)
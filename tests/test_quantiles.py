@@ -0,0 +1,44 @@
+# Tests of the streaming percentiles (functions/quantiles.py) against np.percentile.
+
+##############################################
+########## LOAD NECCESSARY PACKAGES ##########
+##############################################
+import numpy as np
+import pytest
+from Experiments.functions.quantiles import NBITS, histogram, exact_percentile, sketch_percentile
+
+def random_fluxes(seed, shape=(30, 20, 25)):
+    """ Function to draw skewed float32 fluxes of both signs, with many zeros as in the sector emissions """
+    rng = np.random.default_rng(seed)
+    values = rng.lognormal(-12, 2, shape) * rng.choice([-1, 1, 1], shape)
+    values[rng.random(shape) < 0.3] = 0
+    return values.astype(np.float32)
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('q', [0.001, 10, 50, 90, 99.9])
+def test_exact_percentile_equals_numpy(seed, q):
+    values = random_fluxes(seed)
+    time_labels = np.zeros(len(values), dtype=int)
+    counts = histogram(values, time_labels, None, 1, 1, nonzero=True, chunk_size=7)
+    result = exact_percentile(values, counts, q, time_labels, None, 1, nonzero=True, chunk_size=7)
+    # BIT FOR BIT, IN THE FLOAT32 OF THE DATA
+    assert np.float32(result[0]) == np.percentile(values[values != 0], q)
+
+def test_exact_percentile_per_group():
+    values = random_fluxes(0)
+    time_labels = np.arange(len(values)) // 10
+    cell_labels = np.where(np.arange(values.shape[2]) < 12, 0, 1)[None, :].repeat(values.shape[1], axis=0)
+    cell_labels[:3] = -1
+    counts = histogram(values, time_labels, cell_labels, 6, 2, nonzero=True, chunk_size=7)
+    result = exact_percentile(values, counts, 90, time_labels, cell_labels, 2, nonzero=True, chunk_size=7)
+    for group in range(6):
+        selected = values[time_labels == group // 2][:, cell_labels == group % 2]
+        assert np.float32(result[group]) == np.percentile(selected[selected != 0], 90)
+
+@pytest.mark.parametrize('q', [10, 90, 99.9])
+def test_sketch_percentile_error_bound(q):
+    values = random_fluxes(1)
+    time_labels = np.zeros(len(values), dtype=int)
+    counts = histogram(values, time_labels, None, 1, 1, nonzero=True, chunk_size=7)
+    expected = np.percentile(values[values != 0].astype(np.float64), q)
+    assert abs(sketch_percentile(counts, q)[0] - expected) <= 2. ** -(NBITS - 9) * abs(expected)
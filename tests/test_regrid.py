@@ -0,0 +1,58 @@
+# Tests of the conservative regridder (functions/regrid.py): conservation of the flux x area total, the
+# cell-centre convention of the flux sets and the agreement with area-weighted block means.
+
+##############################################
+########## LOAD NECCESSARY PACKAGES ##########
+##############################################
+import netCDF4 as nc
+import numpy as np
+from Experiments.functions.mergetime import read_griddes
+from Experiments.functions.rasterize import LON_BOUNDS, LAT_BOUNDS
+from Experiments.functions.regrid import regrid_flux_set, get_coordinate_edges, get_griddes_edges, cell_areas
+from Experiments.functions.synthetic import get_resolution
+from conftest import SHAPE, CHUNK_SIZE
+
+def read_field(path, name='combustion'):
+    """ Function to read a flux field and the edges of its cells (from the cell-centre coordinates) """
+    with nc.Dataset(path, 'r') as ds:
+        edges = (get_coordinate_edges(ds.variables['longitude'][:]), get_coordinate_edges(ds.variables['latitude'][:]))
+        return np.asarray(ds.variables[name][:], dtype=np.float64), edges
+
+def test_grid_description_edges_match_coordinates(flux_set):
+    _, edges = read_field(flux_set['base'])
+    griddes_edges = get_griddes_edges(read_griddes(flux_set['grid']))
+    for axis in range(2):
+        np.testing.assert_allclose(griddes_edges[axis], edges[axis], atol=1e-6)
+    # THE FIRST COORDINATES OF THE FLUX SET (AS xfirst AND yfirst OF europe.grid) ARE CELL CENTRES
+    res_lon, res_lat = get_resolution(SHAPE)
+    np.testing.assert_allclose([edges[0][0], edges[1][0]], [LON_BOUNDS[0] - res_lon / 2, LAT_BOUNDS[0] - res_lat / 2], atol=1e-6)
+
+def test_regrid_conserves_total(flux_set, tmp_path):
+    # A MISALIGNED TARGET GRID THAT COVERS THE WHOLE SOURCE DOMAIN
+    out_path = str(tmp_path / 'regridded.nc')
+    regrid_flux_set(flux_set['base'], out_path, [-16., 36.], [32., 73.], 0.7, 0.45, variables=['combustion'],
+                    chunk_size=CHUNK_SIZE, cache_dir=str(tmp_path / 'cache'), gridfile=flux_set['grid'])
+    src, src_edges = read_field(flux_set['base'])
+    dst, dst_edges = read_field(out_path)
+    src_total = (src * cell_areas(*src_edges)).sum(axis=(1, 2))
+    dst_total = (dst * cell_areas(*dst_edges)).sum(axis=(1, 2))
+    np.testing.assert_allclose(dst_total, src_total, rtol=1e-6)
+
+def test_regrid_block_aligned_equals_area_weighted_mean(flux_set, tmp_path):
+    # A 1 X 1 DEGREE GRID WHOSE CELLS EACH COVER A BLOCK OF WHOLE SOURCE CELLS
+    out_path = str(tmp_path / 'regridded_1x1.nc')
+    src, src_edges = read_field(flux_set['base'])
+    lon_bounds, lat_bounds = [src_edges[0][0], src_edges[0][-1]], [src_edges[1][0], src_edges[1][-1]]
+    regrid_flux_set(flux_set['base'], out_path, lon_bounds, lat_bounds, 1.0, 1.0, variables=['combustion'],
+                    chunk_size=CHUNK_SIZE, cache_dir=None)
+    dst, _ = read_field(out_path)
+    with nc.Dataset(out_path, 'r') as ds:
+        # THE REGRIDDED FLUX SET HOLDS THE CENTRES OF THE TARGET CELLS
+        np.testing.assert_allclose(ds.variables['longitude'][:], lon_bounds[0] + 0.5 + np.arange(dst.shape[2]), atol=1e-6)
+        np.testing.assert_allclose(ds.variables['latitude'][:], lat_bounds[0] + 0.5 + np.arange(dst.shape[1]), atol=1e-6)
+
+    by, bx = SHAPE[0] // dst.shape[1], SHAPE[1] // dst.shape[2]
+    area = cell_areas(*src_edges)
+    blocks = (src * area).reshape(len(src), dst.shape[1], by, dst.shape[2], bx).sum(axis=(2, 4))
+    expected = blocks / area.reshape(dst.shape[1], by, dst.shape[2], bx).sum(axis=(1, 3))
+    np.testing.assert_allclose(dst, expected, rtol=1e-5, atol=1e-6 * np.abs(expected).max())
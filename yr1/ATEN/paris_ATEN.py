@@ -1,14 +1,11 @@
 # IMPORT NECESSARY PACKAGES
-import netCDF4 as nc
-import numpy as np
 import pandas as pd
 import datetime as dt
-#import sys
-#from Experiments.scripts.functions.functions import get_lu
-#sys.path.insert(0, '/projects/0/ctdas/PARIS/Experiments/scripts/functions/')
-from Experiments.functions.funs import *
+from Experiments.functions.perturbation import perturb_experiment
+from Experiments.functions.verify import verify_experiment, print_summary
+from Experiments.functions.quicklook import render_quicklook
+from Experiments.functions.instrument import start_run, stage, finish_run
 import os
-import shutil
 
 os.chdir('/projects/0/ctdas/PARIS/Experiments/scripts/yr1/ATEN/')
 
@@ -25,82 +22,36 @@ paris_base_path = inpath + 'paris_ctehr_yr1_BASE.nc'
 if not os.path.exists(paris_perturbation_path):
     os.mkdir(paris_perturbation_path)
 
-# COPY BASE FILE SO THAT WE CAN PERTURB IT
-shutil.copyfile(paris_base_path, paris_perturbation_file)
-
-paris_base = nc.Dataset(paris_base_path, 'r', format='NETCDF3_CLASSSIC')
-paris_perturbation = nc.Dataset(paris_perturbation_file, 'r+', format='NETCDF3_CLASSSIC')
-mask_01_02 = nc.Dataset('/projects/0/ctdas/PARIS/Experiments/landmask/paris_countrymask_0.2x0.1deg_2D.nc', 'r', format='NETCDF3_CLASSIC')
-#mask_005 = nc.Dataset('/projects/0/ctdas/PARIS/Experiments/landmask/paris_countrymask_0.05deg_2D.nc', 'r', format='NETCDF3_CLASSIC')
-
-lon_bounds = [paris_base.variables['longitude'][0], paris_base.variables['longitude'][-1]]
-lat_bounds = [paris_base.variables['latitude'][0], paris_base.variables['latitude'][-1]]
-res_lon, res_lat = round((paris_base.variables['longitude'][1]-paris_base.variables['longitude'][0]),1), round((paris_base.variables['latitude'][1] - paris_base.variables['latitude'][0]),1)
-nx = int((lon_bounds[1] + res_lon - lon_bounds[0])/res_lon)
-ny = int((lat_bounds[1] + res_lat - lat_bounds[0])/res_lat)
-#nx = paris_base.variables['F_On-road'][:,:,:].shape[-1]
-#ny = paris_base.variables['F_On-road'][:,:,:].shape[-2]
-#lon_list = np.arange(lon_bounds[0],lon_bounds[1], res_lon)
-#lat_list = np.arange(lat_bounds[0],lat_bounds[1], res_lat)
-#month_list = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October', 'November', 'December']
-
-## EXPERIMENT-SPECIFIC PART
-ff_list = [
-    'A_Public_power',
-    'B_Industry',
-    'C_Other_stationary_combustion_consumer',
-    'F_On-road',
-    'H_Aviation',
-    'I_Off-road',
-    'G_Shipping'
-]
+# INSTRUMENTATION, SEE functions/instrument.py (profile_stages: STAGES TO PROFILE WITH cProfile, E.G. 'write')
+profile_stages = []
+start_run('paris_' + experimentcode, log_path = paris_perturbation_path + 'run_' + experimentcode + '.log.jsonl',
+          report_path = paris_perturbation_path + 'run_' + experimentcode + '.json', profile_stages = profile_stages)
 
 # %%
-## INCREASE TOTAL EMISSIONS BY 10% AND SAVE FLUX PERTRUBATION TO NEWLY COPIED FLUX SET
-paris_perturbation.variables['combustion'][:,:,:] = paris_perturbation.variables['combustion'][:,:,:] * 1.1
-
-# RE-CALCULATE TOTAL EMISSIONS INCLUDING CEMENT PRODUCTION
-paris_perturbation.variables['flux_ff_exchange_prior'][:] = paris_perturbation.variables['combustion'][:] + paris_perturbation.variables['cement'][:]
+## INCREASE TOTAL EMISSIONS BY 10% AND RE-CALCULATE TOTAL EMISSIONS INCLUDING CEMENT PRODUCTION
+## (SEE EXPERIMENTS['ATEN'] IN functions/experiments.py)
+with stage('experiment', experimentcode):
+    perturb_experiment(paris_base_path, paris_perturbation_file, experimentcode)
 
-# CLOSE FILES
-paris_base.close()
-paris_perturbation.close()
+# %%
+# VERIFY THE PERTURBED FLUXES AGAINST THE BASE FLUXES AND THE EXPERIMENT DEFINITION, CHUNK BY CHUNK
+# (SEE functions/verify.py). THE SUMMARY IS WRITTEN NEXT TO THE PERTURBED FLUX SET.
+with stage('verify', experimentcode):
+    summary = verify_experiment(paris_base_path, paris_perturbation_file, experimentcode,
+                                summary_path = paris_perturbation_path + 'verify_' + experimentcode + '.json')
+print_summary(summary)
 
 # %%
 # PLOT
-# If the target directory does not yet exist, create it
-if not os.path.exists(plotpath):
-    os.mkdir(plotpath)
+# QUICK-LOOK FIGURES OF THE BASE FLUXES, THE PERTURBED FLUXES AND THEIR DIFFERENCE, RENDERED IN PARALLEL
+# (SEE functions/quicklook.py)
+time_list = pd.date_range(dt.datetime(2021,1,1,0,0,0), dt.datetime(2021,1,2,0,0,0), freq='1H')
+with stage('quicklook', experimentcode):
+    render_quicklook(paris_base_path, paris_perturbation_file, 'flux_ff_exchange_prior', plotpath, experimentcode,
+                     times = range(0, len(time_list)), side_by_side = True, limits = (0, 5e-6),
+                     diff_limits = (-1e-7, 0))
 
-side_by_side = True
-time_list = pd.date_range(dt.datetime(2021,1,1,0,0,0), dt.datetime(2021,1,2,0,0,0), freq='1H') 
-for time in range(0, len(time_list)):
-        print('Busy with ... ' + str(time))
-        
-        ff_emis_total = paris_base.variables['flux_ff_exchange_prior'][time,:,:]
-        ff_emis_total_scaled = paris_perturbation.variables['flux_ff_exchange_prior'][time,:,:]
-        #ff_emis_total_scaled = paris_base.variables['flux_ff_exchange_prior'][time,:,:] * 1.1
-        dif = paris_base.variables['flux_ff_exchange_prior'][time,:,:] - paris_perturbation.variables['flux_ff_exchange_prior'][time,:,:]
-        
-        if np.array_equal(ff_emis_total_scaled, ff_emis_total):
-            print('Arrays are equal')
-        else:
-            print('Arrays are not equal')
-
-        if side_by_side == True:
-            fig, (ax1, ax2, ax3) = plt.subplots(nrows = 1, ncols = 3, figsize = (16, 9))
-            base = ax1.imshow(ff_emis_total, cmap ='Reds_r', origin='lower', vmin = 0, vmax = 5e-6)
-            half = ax2.imshow(ff_emis_total_scaled, cmap ='Reds_r', origin='lower', vmin = 0, vmax = 5e-6)
-            dif = ax3.imshow(ff_emis_total - ff_emis_total_scaled, cmap ='Reds_r', origin='lower', vmin = 0, vmax = -1e-7)
-            fig.colorbar(base, orientation='horizontal', pad = 0.05, ax = [ax1, ax2])
-            fig.colorbar(dif, orientation='horizontal', pad = 0.05, ax = ax3)
-            
-        else:
-            fig, ax = plt.subplots(nrows = 1, ncols = 1, figsize = (16, 9))
-            dif = ax.imshow(ff_emis_total[time,:,:] - ff_emis_total_scaled, cmap ='Reds_r', origin='lower', vmin = 0, vmax = -1e-7)
-            fig.colorbar(dif, location='right', pad = 0.05, ax = ax)
+# %%
 
-        fig.suptitle(str(time_list[time]))
-        plt.savefig(plotpath + experimentcode + '_' + str(time) + '.png', bbox_inches = 'tight')
-        plt.show()
-# %%
\ No newline at end of file
+# WRITE THE RUN REPORT (AND THE cProfile STATISTICS OF THE PROFILED STAGES)
+finish_run()
\ No newline at end of file
@@ -1,15 +1,15 @@
 import sys
 import netCDF4 as nc
 import datetime
-import numpy as np
 import subprocess
 from glob import glob
 import platform
 import os
 import pandas as pd
-from cdo import Cdo
-
-cdo = Cdo()
+from Experiments.functions.manifest import load_manifest, save_manifest, changed_time_steps
+from Experiments.functions.combine import get_stream_variables, combine_streams
+from Experiments.functions.ncio import create_from_cdl
+from Experiments.functions.instrument import start_run, stage, finish_run
 
 paris_dir = '/projects/0/ctdas/PARIS/'
 cte_dir = paris_dir + 'CTE-HR/'
@@ -20,6 +20,9 @@ outpath =  cte_dir + 'PARIS_OUTPUT/'
 outname = outpath + 'paris_input.nc'
 
 cdlpath = template_dir + 'cdl_template/paris_input.cdl'
+# STORAGE OF THE FLUX FIELDS: 'map', 'timeseries' OR 'balanced' (SEE STORAGE_PROFILES IN functions/ncio.py),
+# INHERITED BY THE PERTURBED FLUX SETS
+storage_profile = 'balanced'
 landmaskpath = template_dir + 'landmask/country_list.csv'
 landmaskfile = pd.read_csv(landmaskpath, sep = ',')
 
@@ -60,36 +63,62 @@ paris_files=[]
 for inname in innames_PARIS:
     paris_files += sorted(glob(f'{outpath}/*{inname}*.nc'))
 
-## LOAD TEMPLATE FILE
-with nc.Dataset.fromcdl(cdlfilename = cdlpath, mode = 'a', ncfilename = outname) as template:
-
-    ## BASIC VARIABLES (TIME, LAT, LON) + FOSSIL FUEL EMISSIONS
+## INSTRUMENTATION, SEE functions/instrument.py (profile_stages: STAGES TO PROFILE WITH cProfile, E.G. 'write')
+profile_stages = []
+start_run('combine_for_paris', log_path = outpath + 'combine_for_paris.log.jsonl',
+          report_path = outpath + 'combine_for_paris.json', profile_stages = profile_stages)
+
+## INCREMENTAL UPDATE: THE MANIFEST OF paris_input.nc HOLDS THE REVISION OF THE MANIFEST OF EACH STREAM FILE
+## (WRITTEN BY daily_to_single_ctehr.py) THAT WAS LAST COPIED, SO THAT ONLY NEW AND CHANGED TIME STEPS ARE COPIED
+manifest_path = outname.replace('.nc', '.manifest.json')
+manifest = load_manifest(manifest_path)
+update = os.path.exists(outname) and bool(manifest['files'])
+
+def get_time_slices(file):
+    """ Function to get the time steps of a stream file that changed since it was last copied to paris_input.nc,
+    and the revision of its manifest (0 if the stream file has no manifest: then all time steps are copied) """
+    stream_manifest = load_manifest(file.replace('.nc', '.manifest.json'))
+    if not update or not stream_manifest['files']:
+        return [slice(None)], stream_manifest['revision']
+    copied = manifest['files'].get(os.path.abspath(file), {}).get('revision', 0)
+    return changed_time_steps(stream_manifest, copied), stream_manifest['revision']
+
+## LOAD TEMPLATE FILE (ONLY CREATED FROM THE CDL TEMPLATE IF paris_input.nc DOES NOT EXIST YET)
+if update:
+    template = nc.Dataset(outname, 'a')
+else:
+    template = create_from_cdl(cdlpath, outname, profile = storage_profile)
+    manifest = {'revision': 0, 'files': {}}
+
+with template:
+
+    ## BASIC VARIABLES (TIME, LAT, LON) + FOSSIL FUEL EMISSIONS + THE FLUX OF EACH STREAM, COPIED IN TIME CHUNKS
+    ## THAT ARE READ FROM ALL STREAMS AT THE SAME TIME (SEE functions/combine.py)
+    streams = []
     for file in paris_files:
-        print('Working on ... ' + file)
-        paris_file = nc.Dataset(file)
-        
-        sectorname = list(paris_file.variables.keys())[-1]
-        sectorindex = varnames_PARIS.index(sectorname)
-        new_varname = varnames_PARIS_out[sectorindex]
-
-        if template.variables[new_varname] == None:
-            print('Requested variables already present, skipping variable extraction!')
-        else:
-            print('Extracting variable information from template file to output file')
-            if 'ff_emissions_CO2' in file:
-                for name, var in paris_file.variables.items():
-                    print('Working on: ' + str(name))
-                    if name != 'anthropogenic':
-                        template.variables[name][:] = paris_file.variables[name][:]
-            
-            print('Working on: ' + str(new_varname))
-            template.variables[new_varname][:] = paris_file.variables[sectorname][:]
-            template.variables[new_varname].comment = comments_PARIS[new_varname]
-
-    ## FILL IN COUNTRY MASK DATA
-    for i in range(0,len(landmaskfile)):
-        template.variables['country_name'][i] = landmaskfile['name'][i]
-        template.variables['country_abbrev'][i] = landmaskfile['code'][i]
+        time_slices, revision = get_time_slices(file)
+        manifest['files'][os.path.abspath(file)] = {'revision': revision}
+        if not time_slices:
+            print('No new or changed time steps, skipping ' + file)
+            continue
+        variables = get_stream_variables(file, varnames_PARIS, varnames_PARIS_out, copy_all = 'ff_emissions_CO2' in file)
+        print('Working on ... ' + file + ': ' + ', '.join(new_varname for _, new_varname in variables))
+        template.variables[variables[-1][1]].comment = comments_PARIS[variables[-1][1]]
+        streams.append({'path': file, 'variables': variables, 'time_slices': time_slices})
+
+    # STATIC VARIABLES (LAT, LON) ARE ONLY COPIED WHEN THE FILE IS CREATED
+    with stage('combine'):
+        combine_streams(template, streams, copy_static = not update)
+
+    if not update:
+        ## FILL IN COUNTRY MASK DATA
+        for i in range(0,len(landmaskfile)):
+            template.variables['country_name'][i] = landmaskfile['name'][i]
+            template.variables['country_abbrev'][i] = landmaskfile['code'][i]
 
     # Update creation date of template file
-    template.creation_date = now.strftime("%Y-%m-%d %H:%M")
\ No newline at end of file
+    template.creation_date = now.strftime("%Y-%m-%d %H:%M")
+
+manifest['revision'] += 1
+save_manifest(manifest, manifest_path)
+finish_run()
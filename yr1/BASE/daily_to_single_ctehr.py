@@ -1,17 +1,15 @@
 import sys
-import netCDF4 as nc
 import datetime
-import numpy as np
 import subprocess
-from cdo import Cdo
 from glob import glob
 import platform
 import os
 import pandas as pd
+from Experiments.functions.mergetime import update_daily_files
+from Experiments.functions.instrument import start_run, stage, finish_run
 
 os.chdir('/projects/0/ctdas/PARIS/Experiments/scripts/yr1/BASE/')
 
-cdo = Cdo()
 INPATH = '/projects/0/ctdas/PARIS/CTE-HR/output'
 OUTPATH = '/projects/0/ctdas/PARIS/CTE-HR/PARIS_OUTPUT'
 cdlpath = '/projects/0/ctdas/PARIS/cdl_template/paris_input.cdl'
@@ -87,33 +85,26 @@ ICOS Carbon Portal, Lund, Sweden',
 'source': f'CTE-HR 1.0. Created using the code from https://git.wageningenur.nl/ctdas/CTDAS/-/tree/near-real-time, hash {GIT_HASH}',
 }
 
+# INSTRUMENTATION, SEE functions/instrument.py (profile_stages: STAGES TO PROFILE WITH cProfile, E.G. 'write')
+profile_stages = []
+start_run('daily_to_single_ctehr', log_path = f'{OUTPATH}/daily_to_single_ctehr.{year}.log.jsonl',
+          report_path = f'{OUTPATH}/daily_to_single_ctehr.{year}.json', profile_stages = profile_stages)
+
 for inname, outname, varname in zip(innames, outnames, varnames):
     infiles = sorted(glob(f'{INPATH}/*/{inname}*'))
-    paris_files = sorted(glob(f'{OUTPATH}/*{inname}.nc'))
     outfile = f'{OUTPATH}/paris_input_{inname}.{year}.nc'
-
-    if not any(inname in s for s in paris_files):
-        print ('WARNING: No existing output files found. Creating new output files')
-        print(f'Merging {len(infiles)} files for {inname}, year {year}')
-        tmpfile = cdo.mergetime(input=infiles, output='tmp.nc')
-        
-        print(f'Setting grid on {outfile}')
-        if os.path.exists(outfile):
-            os.remove(outfile)
-        outfile = cdo.setgrid(gridfile, input=tmpfile, output=outfile)
-        os.remove(tmpfile)
-
-        attrs['comment'] = comments[varname]
-        with nc.Dataset(outfile, 'r+') as ds:
-            print('Setting attributes')
-            for name, value in attrs.items():
-                setattr(ds, name, value)
-            for k, v in ds.variables.items():
-                if v.ndim == 3:
-                    ds[k][:] = ds[k][:] * 1e-6
-                    ds[k].units = 'mol m-2 s-1'
-            if 'anthrop' in outname:
-                print('Changing longname of cement')
-                ds['cement'].long_name = 'Emissions from the calcination of cement'
-    else:
-        print ('WARNING: Found existing output files. Skipping file creation.')
\ No newline at end of file
+    manifest_path = f'{OUTPATH}/paris_input_{inname}.{year}.manifest.json'
+
+    # MERGE ALONG TIME, SET THE GRID OF europe.grid AND CONVERT THE FLUXES TO mol m-2 s-1 IN ONE PASS.
+    # THE MANIFEST KEEPS TRACK OF THE DAILY FILES THAT WERE MERGED: NEW DAYS ARE APPENDED AND CHANGED
+    # DAYS REWRITTEN, THE WHOLE YEAR IS ONLY MERGED IF THE OUTPUT DOES NOT EXIST YET
+    # (SEE functions/mergetime.py AND functions/manifest.py)
+    print(f'Updating {outfile} from {len(infiles)} files for {inname}, year {year}')
+    attrs['comment'] = comments[varname]
+    variable_attrs = {}
+    if 'anthrop' in varname:
+        variable_attrs['cement'] = {'long_name': 'Emissions from the calcination of cement'}
+    with stage('merge', inname):
+        update_daily_files(infiles, outfile, gridfile, manifest_path, attrs = attrs, variable_attrs = variable_attrs)
+
+finish_run()
@@ -0,0 +1,30 @@
+# IMPORT NECESSARY PACKAGES
+from Experiments.functions.aggregate import aggregate_flux_set
+import os
+import sys
+
+os.chdir('/projects/0/ctdas/PARIS/Experiments/scripts/yr1/')
+
+# Flux sets to aggregate to the monthly protocol layout, e.g. 'python aggregate_flux_sets.py BASE HFRA'
+# (default: the BASE flux set and all experiments of the first modelling year)
+experimentcodes = sys.argv[1:] if len(sys.argv) > 1 else ['BASE', 'ATEN', 'PTEN', 'HFRA', 'HGER', 'DFIN']
+
+# Frequencies of the mean fluxes: 'monthly' as in the protocol, optionally also 'weekly' and/or 'daily'
+frequencies = ['monthly']
+
+inpath = '/projects/0/ctdas/PARIS/CTE-HR/PARIS_OUTPUT/'
+
+for experimentcode in experimentcodes:
+    if experimentcode == 'BASE':
+        paris_file = inpath + 'paris_ctehr_yr1_BASE.nc'
+    else:
+        paris_file = inpath + experimentcode + '/paris_ctehr_perturbedflux_yr1_' + experimentcode + '.nc'
+        if not os.path.exists(paris_file):
+            paris_file = paris_file.replace('.nc', '_overlay.nc')
+
+    # STREAM THE HOURLY FILE ONCE PER FREQUENCY, KEEPING ONLY THE RUNNING SUM OF THE CURRENT PERIOD
+    # (SEE functions/aggregate.py)
+    for frequency in frequencies:
+        out_name = os.path.dirname(paris_file) + '/paris_ctehr_yr1_' + experimentcode + '_' + frequency + '.nc'
+        print('Aggregating ' + paris_file + ' to ' + out_name)
+        aggregate_flux_set(paris_file, out_name, frequency)
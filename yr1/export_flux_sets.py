@@ -0,0 +1,33 @@
+# IMPORT NECESSARY PACKAGES
+from Experiments.functions.export import export_flux_set
+import os
+import sys
+
+os.chdir('/projects/0/ctdas/PARIS/Experiments/scripts/yr1/')
+
+# Flux sets to export for random access by the transport model runs, e.g. 'python export_flux_sets.py BASE HFRA'
+# (default: the BASE flux set and all experiments of the first modelling year)
+experimentcodes = sys.argv[1:] if len(sys.argv) > 1 else ['BASE', 'ATEN', 'PTEN', 'HFRA', 'HGER', 'DFIN']
+
+# 'raw': one memory-mappable binary file per variable plus an index.json (read with functions/export.py, open_export)
+# 'zarr': a chunked Zarr store (needs the zarr package)
+layout = 'raw'
+
+inpath = '/projects/0/ctdas/PARIS/CTE-HR/PARIS_OUTPUT/'
+outpath = inpath + 'export/'
+
+# If the target directory does not yet exist, create it
+if not os.path.exists(outpath):
+    os.mkdir(outpath)
+
+for experimentcode in experimentcodes:
+    if experimentcode == 'BASE':
+        paris_file = inpath + 'paris_ctehr_yr1_BASE.nc'
+    else:
+        # FULL FLUX SETS AND OVERLAY FILES ARE BOTH EXPORTED AS FULL FLUX SETS
+        paris_file = inpath + experimentcode + '/paris_ctehr_perturbedflux_yr1_' + experimentcode + '.nc'
+        if not os.path.exists(paris_file):
+            paris_file = paris_file.replace('.nc', '_overlay.nc')
+    out_name = outpath + 'paris_ctehr_yr1_' + experimentcode + ('.zarr' if layout == 'zarr' else '')
+    print('Exporting ' + paris_file + ' to ' + out_name)
+    export_flux_set(paris_file, out_name, layout = layout)
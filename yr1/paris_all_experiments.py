@@ -0,0 +1,45 @@
+# IMPORT NECESSARY PACKAGES
+from Experiments.functions import funs
+from Experiments.functions.perturbation import perturb_experiments
+from Experiments.functions.instrument import start_run, stage, finish_run
+import os
+import sys
+
+os.chdir('/projects/0/ctdas/PARIS/Experiments/scripts/yr1/')
+
+# Experiments to create in a single pass over the BASE file, e.g. 'python paris_all_experiments.py HFRA HGER'
+# (default: all experiments of the first modelling year)
+experimentcodes = sys.argv[1:] if len(sys.argv) > 1 else ['ATEN', 'PTEN', 'HFRA', 'HGER', 'DFIN']
+
+# Write overlay files that only contain the changed variables within the bounding box of the countries of each
+# experiment, instead of full copies of the BASE file. Use functions/overlay.py to read or materialize them.
+overlay = False
+
+inpath = '/projects/0/ctdas/PARIS/CTE-HR/PARIS_OUTPUT/'
+paris_base_path = inpath + 'paris_ctehr_yr1_BASE.nc'
+
+# CACHE OF THE LAND USE AGGREGATED TO THE FLUX GRID, FOR THE LAND-USE FILTER OF E.G. DFIN (SEE get_lu() IN functions/funs.py)
+funs.LU_CACHE_DIR = '/projects/0/ctdas/PARIS/Experiments/landmask/lu_cache/'
+
+paris_perturbation_files = {}
+for experimentcode in experimentcodes:
+    paris_perturbation_path = inpath + experimentcode + '/'
+    if overlay:
+        paris_perturbation_files[experimentcode] = paris_perturbation_path + 'paris_ctehr_perturbedflux_yr1_' + experimentcode + '_overlay.nc'
+    else:
+        paris_perturbation_files[experimentcode] = paris_perturbation_path + 'paris_ctehr_perturbedflux_yr1_' + experimentcode + '.nc'
+
+    # If the target directory does not yet exist, create it
+    if not os.path.exists(paris_perturbation_path):
+        os.mkdir(paris_perturbation_path)
+
+# INSTRUMENTATION, SEE functions/instrument.py (profile_stages: STAGES TO PROFILE WITH cProfile, E.G. 'write')
+profile_stages = []
+start_run('paris_all_experiments', log_path=inpath + 'run_all_experiments.log.jsonl',
+          report_path=inpath + 'run_all_experiments.json', profile_stages=profile_stages)
+
+# READ EACH TIME CHUNK OF THE BASE FILE ONCE AND WRITE IT TO THE OUTPUT FILES OF ALL EXPERIMENTS
+with stage('experiments', '+'.join(experimentcodes)):
+    perturb_experiments(paris_base_path, paris_perturbation_files, overlay=overlay)
+
+finish_run()
@@ -0,0 +1,42 @@
+# IMPORT NECESSARY PACKAGES
+from Experiments.functions.ensemble import generate_ensemble
+from Experiments.functions.experiments import FF_LIST
+from Experiments.functions.instrument import start_run, stage, finish_run
+import os
+import sys
+
+os.chdir('/projects/0/ctdas/PARIS/Experiments/scripts/yr1/')
+
+# Ensemble of random country x sector scale factors around existing experiments, e.g.
+# 'python paris_ensemble.py 50 HFRA HGER' for 50 members around the HFRA and HGER factors
+# (default: 20 members around ATEN, HFRA and HGER)
+nmembers = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+experimentcodes = sys.argv[2:] if len(sys.argv) > 2 else ['ATEN', 'HFRA', 'HGER']
+
+# Scaled sectors, seed of the random generator and standard deviation of the logarithm of the factors
+sectors = FF_LIST + ['cement']
+seed = 0
+sigma = 0.1
+
+# Write the perturbed sectors and totals of all members (one file with a member dimension), or only the
+# totals per country, member and time step
+write_members = False
+
+inpath = '/projects/0/ctdas/PARIS/CTE-HR/PARIS_OUTPUT/'
+paris_base_path = inpath + 'paris_ctehr_yr1_BASE.nc'
+ensemble_path = inpath + 'ENSEMBLE/'
+ensemble_name = 'paris_ctehr_yr1_ensemble_' + '_'.join(experimentcodes) + '_' + str(nmembers) + '_seed' + str(seed)
+
+# If the target directory does not yet exist, create it
+if not os.path.exists(ensemble_path):
+    os.mkdir(ensemble_path)
+
+start_run('paris_ensemble', log_path=ensemble_path + ensemble_name + '.log.jsonl', report_path=ensemble_path + ensemble_name + '.run.json')
+
+# READ EACH TIME CHUNK OF THE BASE FILE ONCE AND APPLY THE SCALE FACTORS OF ALL MEMBERS (SEE functions/ensemble.py)
+with stage('ensemble', str(nmembers)):
+    generate_ensemble(paris_base_path, nmembers, sectors, experimentcodes, seed=seed, sigma=sigma,
+                      members_path=ensemble_path + ensemble_name + '.nc' if write_members else None,
+                      summary_path=ensemble_path + ensemble_name + '_summary.nc')
+
+finish_run()
@@ -0,0 +1,33 @@
+# IMPORT NECESSARY PACKAGES
+from Experiments.functions.regrid import regrid_flux_set
+import os
+import sys
+
+os.chdir('/projects/0/ctdas/PARIS/Experiments/scripts/yr1/')
+
+# Flux sets to regrid to the grid of a transport model, e.g. 'python regrid_flux_sets.py BASE HFRA'
+# (default: the BASE flux set and all experiments of the first modelling year)
+experimentcodes = sys.argv[1:] if len(sys.argv) > 1 else ['BASE', 'ATEN', 'PTEN', 'HFRA', 'HGER', 'DFIN']
+
+# Target grid: edges of the domain and resolution in degrees (here a 1x1 degree grid over the CTE-HR domain).
+# The conservative weights are computed once per pair of grids and cached in regrid_cache_dir.
+grid_name = '1x1deg'
+lon_bounds = [-15., 35.]
+lat_bounds = [33., 72.]
+res_lon, res_lat = 1.0, 1.0
+
+inpath = '/projects/0/ctdas/PARIS/CTE-HR/PARIS_OUTPUT/'
+# CDO grid description of the flux sets, from which the edges of their cells are taken
+gridfile = '/projects/0/ctdas/PARIS/Experiments/scripts/yr1/BASE/europe.grid'
+regrid_cache_dir = '/projects/0/ctdas/PARIS/Experiments/landmask/regrid_cache/'
+
+for experimentcode in experimentcodes:
+    if experimentcode == 'BASE':
+        paris_file = inpath + 'paris_ctehr_yr1_BASE.nc'
+    else:
+        paris_file = inpath + experimentcode + '/paris_ctehr_perturbedflux_yr1_' + experimentcode + '.nc'
+        if not os.path.exists(paris_file):
+            paris_file = paris_file.replace('.nc', '_overlay.nc')
+    out_name = os.path.dirname(paris_file) + '/paris_ctehr_yr1_' + experimentcode + '_' + grid_name + '.nc'
+    print('Regridding ' + paris_file + ' to ' + out_name)
+    regrid_flux_set(paris_file, out_name, lon_bounds, lat_bounds, res_lon, res_lat, gridfile=gridfile, cache_dir=regrid_cache_dir)